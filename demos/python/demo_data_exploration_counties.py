@@ -106,7 +106,7 @@ hidden['Z']= hidden['Z'][:,feat_select]
 hidden['B']= hidden['B'][:,feat_select,:]
 
 sum(hidden['Z'])
-[patterns, C, L] = GLFM.get_feature_patterns_sorted(hidden['Z']) # returns sorted patterns
+[patterns, C, L] = GLFM.get_feature_patterns_sorted(hidden['Z'], verbose=1) # returns sorted patterns
 
 # choose patterns corresponding to activation of each feature
 Zp = np.eye(Kest)
@@ -98,7 +98,7 @@ hidden['Z']= hidden['Z'][:,feat_select]
 hidden['B']= hidden['B'][:,feat_select,:]
 
 sum(hidden['Z'])
-[patterns, C, L] = GLFM.get_feature_patterns_sorted(hidden['Z'])
+[patterns, C, L] = GLFM.get_feature_patterns_sorted(hidden['Z'], verbose=1)
 
 Kest = hidden['B'].shape[1] # number of inferred latent features
 D = hidden['B'].shape[0]    # number of dimensions
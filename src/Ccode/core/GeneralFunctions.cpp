@@ -4,6 +4,7 @@
 #include <stdio.h>
 #include <iostream>
 #include <time.h>
+#include <stdint.h>
 #include <gsl/gsl_sf_exp.h>
 #include <gsl/gsl_sf_log.h>
 #include <gsl/gsl_blas.h>
@@ -125,6 +126,20 @@ void matrix_multiply(gsl_matrix *A,gsl_matrix *B,gsl_matrix *C,double alpha,doub
     
 }
 
+gsl_matrix *matrix_resize(gsl_matrix *A, int size1, int size2) {
+    // Returns a size1 x size2 copy of A (zero-padded or cropped) and frees A
+    gsl_matrix *Anew= gsl_matrix_calloc(size1, size2);
+    int n1= (A->size1<size1) ? A->size1 : size1;
+    int n2= (A->size2<size2) ? A->size2 : size2;
+    if (n1>0 && n2>0){
+        gsl_matrix_view Aold_view= gsl_matrix_submatrix (A, 0, 0, n1, n2);
+        gsl_matrix_view Anew_view= gsl_matrix_submatrix (Anew, 0, 0, n1, n2);
+        gsl_matrix_memcpy (&Anew_view.matrix, &Aold_view.matrix);
+    }
+    gsl_matrix_free(A);
+    return Anew;
+}
+
 
 double *column_to_row_major_order(double *A,int nRows,int nCols) {
     
@@ -257,6 +272,53 @@ void inverse(gsl_matrix *Amat, int Asize)
 
 
 
+void inverse_rank_one_update(gsl_matrix *Ainv, gsl_vector *z, double sign, gsl_vector *v)
+{
+    // Sherman-Morrison: given Ainv = A^{-1}, overwrite it with (A + sign*z*z')^{-1}.
+    // v is a workspace vector of the same size as z (on return it holds Ainv*z
+    // for the input Ainv).
+    double zv;
+    gsl_blas_dgemv (CblasNoTrans, 1, Ainv, z, 0, v);
+    gsl_blas_ddot (z, v, &zv);
+    gsl_blas_dger (-sign/(1+sign*zv), v, v, Ainv);
+}
+
+void inverse_remove_index(gsl_matrix *Ainv, int Asize, int k)
+{
+    // Given Ainv = A^{-1} (Asize x Asize), overwrite the leading (Asize-1) block
+    // with the inverse of A after deleting its k-th row and column (Schur complement)
+    double akk= gsl_matrix_get (Ainv, k, k);
+    for (int i=0; i<Asize; i++){
+        if (i==k){continue;}
+        double aik= gsl_matrix_get (Ainv, i, k);
+        for (int j=0; j<Asize; j++){
+            if (j==k){continue;}
+            gsl_matrix_set (Ainv, i, j, gsl_matrix_get (Ainv, i, j) - aik*gsl_matrix_get (Ainv, k, j)/akk);
+        }
+    }
+    for (int i=k; i<Asize-1; i++){
+        for (int j=0; j<Asize; j++){
+            gsl_matrix_set (Ainv, i, j, gsl_matrix_get (Ainv, i+1, j));
+        }
+    }
+    for (int j=k; j<Asize-1; j++){
+        for (int i=0; i<Asize-1; i++){
+            gsl_matrix_set (Ainv, i, j, gsl_matrix_get (Ainv, i, j+1));
+        }
+    }
+}
+
+void inverse_append_index(gsl_matrix *Ainv, int Asize, double a)
+{
+    // Given Ainv = A^{-1} (Asize x Asize), grow it to the inverse of the
+    // block-diagonal matrix [A 0; 0 a]
+    for (int i=0; i<Asize; i++){
+        gsl_matrix_set (Ainv, i, Asize, 0);
+        gsl_matrix_set (Ainv, Asize, i, 0);
+    }
+    gsl_matrix_set (Ainv, Asize, Asize, 1/a);
+}
+
 double trace(gsl_matrix *Amat, int Asize)
 {
 	// Assume Amat is square
@@ -272,21 +334,36 @@ double trace(gsl_matrix *Amat, int Asize)
 }
 
 // Sampling functions
-int poissrnd(double lambda) {
+unsigned long rng_split_seed(unsigned long seed, unsigned long stream){
+    // splitmix64 mix of (seed, stream): seeds of distinct streams of the
+    // same run are decorrelated, and equal for the same (seed, stream)
+    uint64_t z= (uint64_t)seed + 0x9E3779B97F4A7C15ULL*(stream+1);
+    z= (z ^ (z >> 30)) * 0xBF58476D1CE4E5B9ULL;
+    z= (z ^ (z >> 27)) * 0x94D049BB133111EBULL;
+    return (unsigned long)(z ^ (z >> 31));
+}
+
+gsl_rng *rng_alloc_stream(unsigned long seed, unsigned long stream){
+    gsl_rng *r= gsl_rng_alloc(gsl_rng_taus);
+    gsl_rng_set(r, rng_split_seed(seed, stream));
+    return r;
+}
+
+int poissrnd(double lambda, const gsl_rng *seed) {
     double L = gsl_sf_exp(-lambda);
     int k = 0;
     double p = 1;
     do {
         k++;
-        p *= drand48();
+        p *= gsl_rng_uniform(seed);
     } while( p > L);
     return (k-1);
 }
 
-int mnrnd(double *p, int nK){
+int mnrnd(double *p, int nK, const gsl_rng *seed){
     double pMin=0;
     double pMax=p[0];
-    double s=drand48();
+    double s=gsl_rng_uniform(seed);
     int k=0;
     int flag=1;
     int Knew;
@@ -314,19 +391,67 @@ void mvnrnd(gsl_vector *x, gsl_matrix *Sigma,gsl_vector *Mu, int K, const gsl_rn
     
     gsl_blas_dtrmv (CblasLower, CblasNoTrans, CblasNonUnit, A, x);
     gsl_vector_add (x, Mu);
+    gsl_matrix_free(A);
     
     }
 
-double truncnormrnd(double mu, double sigma, double xlo, double xhi){
-    
-    if (xlo>xhi){printf("error: xlo<xhi");}
-    double plo=gsl_cdf_ugaussian_P((xlo-mu)/sigma);
-    double phi=gsl_cdf_ugaussian_P((xhi-mu)/sigma);
-    double r=drand48();
-    r=plo+(phi-plo)*r;
-    //printf("r= %f \n", r);
-    double z=gsl_cdf_ugaussian_Pinv(r);
-    //if (gsl_isnan(mu+z*sigma)){printf("mu=%f, xlo= %f, xhi= %f \n",mu, xlo,  xhi);}
-    return mu+z*sigma;
+void mvnrnd_precision(gsl_matrix *X, gsl_matrix *L, const gsl_rng *seed){
+    // L: lower Cholesky factor of a K x K precision matrix P (P = L*L')
+    // X: on input K x M matrix Lambda; on output, M independent samples
+    //    with column m ~ N(P^{-1}*Lambda_m, P^{-1})
+    gsl_blas_dtrsm (CblasLeft, CblasLower, CblasNoTrans, CblasNonUnit, 1, L, X);
+    for (size_t k=0; k<X->size1; k++){
+        for (size_t m=0; m<X->size2; m++){
+            gsl_matrix_set (X, k, m, gsl_matrix_get (X, k, m) + gsl_ran_ugaussian (seed));
+        }
+    }
+    gsl_blas_dtrsm (CblasLeft, CblasLower, CblasTrans, CblasNonUnit, 1, L, X);
+    }
+
+static double truncnorm_std(double a, double b, const gsl_rng *seed){
+    // Standard normal truncated to [a,b] by rejection (Robert, 1995): no
+    // cdf is evaluated, so it stays exact however far in the tails a, b are
+    if (a>=b){return a;}
+    if (b<=0){return -truncnorm_std(-b, -a, seed);}
+    double z;
+    if (a<0){
+        // [a,b] contains 0: plain normal draws if it is wide, else uniform
+        // draws accepted with probability exp(-z^2/2)
+        if (b-a>=2.5066282746310002){
+            do {z= gsl_ran_ugaussian(seed);} while (z<a || z>b);
+        }else{
+            do {z= a+(b-a)*gsl_rng_uniform(seed);} while (gsl_rng_uniform(seed)>exp(-0.5*z*z));
+        }
+        return z;
+    }
+    // 0<=a<b: exponential proposals of optimal rate lambda above a, unless
+    // [a,b] is so short that uniform ones are accepted more often
+    double lambda= 0.5*(a+sqrt(a*a+4));
+    if (b-a < exp(0.5*(a*a-a*lambda)+0.5)/lambda){
+        do {z= a+(b-a)*gsl_rng_uniform(seed);} while (gsl_rng_uniform(seed)>exp(0.5*(a*a-z*z)));
+        return z;
+    }
+    do {
+        z= a-log(gsl_rng_uniform_pos(seed))/lambda;
+    } while (z>b || gsl_rng_uniform(seed)>exp(-0.5*(z-lambda)*(z-lambda)));
+    return z;
+    }
+
+double truncnormrnd(double mu, double sigma, double xlo, double xhi, const gsl_rng *seed){
+    // nan if the interval is empty (xlo>xhi)
+    if (!(xlo<=xhi)){return GSL_NAN;}
+    return mu+sigma*truncnorm_std((xlo-mu)/sigma, (xhi-mu)/sigma, seed);
     
     }
+
+int truncnormrnd_n(int n, const double *mu, double sigma, const double *xlo, const double *xhi, double *x, const gsl_rng *seed){
+    // x[i] ~ N(mu[i], sigma^2) truncated to [xlo[i], xhi[i]], i<n; x may
+    // be mu. Returns the number of draws that are not finite (empty
+    // interval, or mu or sigma not finite)
+    int nerr=0;
+    for (int i=0; i<n; i++){
+        x[i]= truncnormrnd(mu[i], sigma, xlo[i], xhi[i], seed);
+        if (!gsl_finite(x[i])){nerr++;}
+    }
+    return nerr;
+    }
@@ -5,6 +5,7 @@
 //#include "laplaceEP.h"
 //#include "matrix.h"
 #include <time.h>
+#include <stdint.h>
 
 
 
@@ -37,21 +38,29 @@ double compute_vector_var(int N, double missing, gsl_vector *v);
 double compute_vector_max(int N, double missing, gsl_vector *v);
 double compute_vector_min(int N, double missing, gsl_vector *v);
 int factorial (int N);
-int poissrnd(double lambda);
+unsigned long rng_split_seed(unsigned long seed, unsigned long stream);
+gsl_rng *rng_alloc_stream(unsigned long seed, unsigned long stream);
+int poissrnd(double lambda, const gsl_rng *seed);
 //gsl_matrix *double2gsl(double *Amat, int nRows, int nCols);
 void matrix_multiply(gsl_matrix *A,gsl_matrix *B,gsl_matrix *C,double alpha,double beta,CBLAS_TRANSPOSE_t TransA,CBLAS_TRANSPOSE_t TransB);
+gsl_matrix *matrix_resize(gsl_matrix *A, int size1, int size2);
 double *column_to_row_major_order(double *A,int nRows,int nCols);
 //double *row_to_column_major_order(double *A,int nRows,int nCols);
 double det_get(gsl_matrix *Amat, int Arows, int Acols, int inPlace);
 double lndet_get(gsl_matrix *Amat, int Arows, int Acols, int inPlace);
 // gsl_matrix *inverse(gsl_matrix *Amat, int Asize);
 void inverse(gsl_matrix *Amat, int Asize);
+void inverse_rank_one_update(gsl_matrix *Ainv, gsl_vector *z, double sign, gsl_vector *v);
+void inverse_remove_index(gsl_matrix *Ainv, int Asize, int k);
+void inverse_append_index(gsl_matrix *Ainv, int Asize, double a);
 double trace(gsl_matrix *Amat, int Asize);
 double logFun(double x);
 double expFun(double x);
 //Sampling functions
-int mnrnd(double *p, int nK);
+int mnrnd(double *p, int nK, const gsl_rng *seed);
 void mvnrnd(gsl_vector *X, gsl_matrix *Sigma,gsl_vector *Mu, int K, const gsl_rng *seed);
-double truncnormrnd(double mu, double sigma, double xlo, double xhi);
+void mvnrnd_precision(gsl_matrix *X, gsl_matrix *L, const gsl_rng *seed);
+double truncnormrnd(double mu, double sigma, double xlo, double xhi, const gsl_rng *seed);
+int truncnormrnd_n(int n, const double *mu, double sigma, const double *xlo, const double *xhi, double *x, const gsl_rng *seed);
 
 
@@ -1,9 +1,12 @@
 #include "GeneralFunctions.h"
+#include "InferenceFunctions.h"
 
 #include <math.h>
 #include <stdio.h>
 #include <iostream>
 #include <time.h>
+#include <string.h>
+#include <chrono>
 #include <gsl/gsl_sf_exp.h>
 #include <gsl/gsl_sf_log.h>
 #include <gsl/gsl_blas.h>
@@ -13,89 +16,591 @@
 #include <gsl/gsl_math.h>
 #include "gsl/gsl_cdf.h"
 #include "gsl/gsl_randist.h"
+#ifdef _OPENMP
+#include <omp.h>
+#define THREAD_NUM omp_get_thread_num()
+#else
+#define THREAD_NUM 0
+#endif
+
+// seconds on a monotonic clock, for the telemetry of the sampler
+static inline double trace_clock (void){
+    return std::chrono::duration<double>(std::chrono::steady_clock::now().time_since_epoch()).count();
+}
+
+// lowest set bit of a nonzero word
+#if defined(__GNUC__)
+#define LOWEST_BIT(w) __builtin_ctzll(w)
+#else
+static inline int LOWEST_BIT (uint64_t w){
+    int b=0;
+    while (!(w&1)){w>>=1; b++;}
+    return b;
+}
+#endif
 
 // Functions
-int AcceleratedGibbs (int maxK,int bias, int N, int D, int K, char *C,  int *R, double alpha, double s2B, double *s2Y, gsl_matrix **Y, gsl_matrix *Z, int *nest, gsl_matrix *P, gsl_matrix *Pnon, gsl_matrix **lambda, gsl_matrix **lambdanon){
+SamplerWorkspace *workspace_alloc (int N, int cap, int maxR, int sumR){
+    SamplerWorkspace *ws= (SamplerWorkspace *) malloc(sizeof(SamplerWorkspace));
+    ws->Snon= gsl_matrix_alloc(cap,cap);
+    ws->Sz= gsl_vector_alloc(cap);
+    ws->aux= gsl_matrix_alloc(1,cap);
+    ws->muy= gsl_vector_alloc(sumR);
+    ws->yn= gsl_vector_alloc(sumR);
+    ws->L= gsl_matrix_alloc(cap,cap);
+    ws->LB= gsl_matrix_alloc(cap,sumR);
+    ws->Ymax= gsl_vector_alloc(maxR);
+    ws->Ymin= gsl_vector_alloc(maxR);
+    ws->ZB= gsl_matrix_alloc(maxR,N);
+    ws->zn= gsl_matrix_calloc(cap,1);
+    ws->TN= gsl_matrix_alloc(3,N);
+    return ws;
+}
+
+void workspace_free (SamplerWorkspace *ws){
+    gsl_matrix_free(ws->Snon);
+    gsl_vector_free(ws->Sz);
+    gsl_matrix_free(ws->aux);
+    gsl_vector_free(ws->muy);
+    gsl_vector_free(ws->yn);
+    gsl_matrix_free(ws->L);
+    gsl_matrix_free(ws->LB);
+    gsl_vector_free(ws->Ymax);
+    gsl_vector_free(ws->Ymin);
+    gsl_matrix_free(ws->ZB);
+    gsl_matrix_free(ws->zn);
+    gsl_matrix_free(ws->TN);
+    free(ws);
+}
+
+// Initial capacity for K features: room for the proposals of a few sweeps,
+// and never more than the maxK rows the sampler can touch
+int features_capacity (int K, int maxK){
+    int cap= 2*(K+2);
+    if (cap<16){cap=16;}
+    if (cap>maxK){cap=maxK;}
+    if (cap<K+1){cap=K+1;}
+    return cap;
+}
+
+FeatureBuffers *features_alloc (int cap, int maxK, int D, char *C, int *R){
+    FeatureBuffers *fb= (FeatureBuffers *) malloc(sizeof(FeatureBuffers));
+    fb->cap= cap;
+    fb->maxK= maxK;
+    fb->D= D;
+    fb->capped= 0;
+    // the model uses the first Rd-1 rows of Yd for categorical dimensions,
+    // only the first one for the others
+    fb->col= (int *) malloc((D+1)*sizeof(int));
+    fb->col[0]= 0;
+    for (int d=0; d<D; d++){
+        fb->col[d+1]= fb->col[d] + ((C[d]=='c') ? R[d]-1 : 1);
+    }
+    fb->P= gsl_matrix_calloc(cap,cap);
+    fb->Pnon= gsl_matrix_calloc(cap,cap);
+    fb->lambda= gsl_matrix_calloc(cap,fb->col[D]);
+    fb->lambdanon= gsl_matrix_calloc(cap,fb->col[D]);
+    fb->nest= (int *) calloc(cap, sizeof(int));
+    return fb;
+}
+
+void features_free (FeatureBuffers *fb){
+    gsl_matrix_free(fb->P);
+    gsl_matrix_free(fb->Pnon);
+    gsl_matrix_free(fb->lambda);
+    gsl_matrix_free(fb->lambdanon);
+    free(fb->col);
+    free(fb->nest);
+    free(fb);
+}
+
+// lambda(:,col[d]:col[d+1]) = Z*Yd' for the rows of Yd used by the model
+void features_lambda (FeatureBuffers *fb, int d, const BitMatrix *Z, int K, gsl_matrix *Yd){
+    int nr= fb->col[d+1]-fb->col[d];
+    gsl_matrix_view Yd_view= gsl_matrix_submatrix (Yd, 0, 0, nr, Yd->size2);
+    gsl_matrix_view lambdad= gsl_matrix_submatrix (fb->lambda, 0, fb->col[d], fb->cap, nr);
+    bitmatrix_mult (Z, K, &Yd_view.matrix, &lambdad.matrix);
+}
+
+// Removes feature k, inactive in every observation, out of K. Feature K-1
+// takes its place, so that Pnon and lambdanon just lose a row (and a column)
+// and their inverse S = ws->Snon is downdated in O(K^2); z_n, unpacked in
+// ws->zn, follows the same permutation. P and lambda are left as they are,
+// they are copied from Pnon and lambdanon once row n is added back.
+void features_remove (FeatureBuffers *fb, int K, int k, BitMatrix *Z, SamplerWorkspace *ws){
+    int l= K-1;
+    if (k!=l){
+        gsl_matrix_view V= gsl_matrix_submatrix (fb->Pnon, 0, 0, K, K);
+        gsl_matrix_swap_rows (&V.matrix, k, l);
+        gsl_matrix_swap_columns (&V.matrix, k, l);
+        V= gsl_matrix_submatrix (ws->Snon, 0, 0, K, K);
+        gsl_matrix_swap_rows (&V.matrix, k, l);
+        gsl_matrix_swap_columns (&V.matrix, k, l);
+        gsl_matrix_swap_rows (fb->lambdanon, k, l);
+        fb->nest[k]= fb->nest[l];
+        ws->zn->data[k*ws->zn->tda]= ws->zn->data[l*ws->zn->tda];
+        bitmatrix_move (Z, l, k);
+    }
+    inverse_remove_index (ws->Snon, K, l);
+    // the row of an empty feature is exactly e_l/s2B in Pnon, but only zero
+    // up to rounding in lambdanon
+    gsl_vector_view row= gsl_matrix_row (fb->lambdanon, l);
+    gsl_vector_set_zero (&row.vector);
+    fb->nest[l]= 0;
+    ws->zn->data[l*ws->zn->tda]= 0;
+}
+
+// Moves every buffer indexed by feature (those of fb, the feature-sized ones
+// of ws, the rows of B and Z) to capacity cap, keeping the content of the
+// features that still fit
+void features_resize (FeatureBuffers *fb, int cap, BitMatrix *Z, gsl_matrix **B, SamplerWorkspace *ws){
+    if (cap==fb->cap){return;}
+    fb->P= matrix_resize(fb->P, cap, cap);
+    fb->Pnon= matrix_resize(fb->Pnon, cap, cap);
+    fb->lambda= matrix_resize(fb->lambda, cap, fb->lambda->size2);
+    fb->lambdanon= matrix_resize(fb->lambdanon, cap, fb->lambdanon->size2);
+    for (int d=0; d<fb->D; d++){
+        B[d]= matrix_resize(B[d], cap, B[d]->size2);
+    }
+    int *nest= (int *) calloc(cap, sizeof(int));
+    memcpy(nest, fb->nest, ((cap<fb->cap) ? cap : fb->cap)*sizeof(int));
+    free(fb->nest);
+    fb->nest= nest;
+    ws->Snon= matrix_resize(ws->Snon, cap, cap);
+    gsl_vector_free(ws->Sz);
+    ws->Sz= gsl_vector_alloc(cap);
+    ws->aux= matrix_resize(ws->aux, 1, cap);
+    ws->L= matrix_resize(ws->L, cap, cap);
+    ws->LB= matrix_resize(ws->LB, cap, ws->LB->size2);
+    ws->zn= matrix_resize(ws->zn, cap, 1);
+    bitmatrix_resize(Z, cap);
+    fb->cap= cap;
+}
+
+BitMatrix *bitmatrix_alloc (int N, int cap){
+    BitMatrix *Z= (BitMatrix *) malloc(sizeof(BitMatrix));
+    Z->N= N;
+    Z->cap= cap;
+    Z->nw= (cap+63)/64;
+    Z->bits= (uint64_t *) calloc((size_t) N*Z->nw, sizeof(uint64_t));
+    return Z;
+}
+
+void bitmatrix_free (BitMatrix *Z){
+    free(Z->bits);
+    free(Z);
+}
+
+// Changes the capacity of Z, keeping its first min(K, cap) features. The
+// caller must have cleared the features k>=cap when shrinking.
+void bitmatrix_resize (BitMatrix *Z, int cap){
+    int nw= (cap+63)/64;
+    Z->cap= cap;
+    if (nw==Z->nw){return;}
+    uint64_t *bits= (uint64_t *) calloc((size_t) Z->N*nw, sizeof(uint64_t));
+    int ncopy= (nw<Z->nw) ? nw : Z->nw;
+    for (int n=0; n<Z->N; n++){
+        memcpy(bits+(size_t) n*nw, Z->bits+(size_t) n*Z->nw, ncopy*sizeof(uint64_t));
+    }
+    free(Z->bits);
+    Z->bits= bits;
+    Z->nw= nw;
+}
+
+// From/to the first K rows of a gsl_matrix with N columns
+void bitmatrix_from_dense (BitMatrix *Zb, gsl_matrix *Z, int K){
+    memset(Zb->bits, 0, (size_t) Zb->N*Zb->nw*sizeof(uint64_t));
+    for (int k=0; k<K; k++){
+        for (int n=0; n<Zb->N; n++){
+            if (gsl_matrix_get(Z, k, n)!=0){
+                Zb->bits[(size_t) n*Zb->nw+(k>>6)]|= (uint64_t) 1<<(k&63);
+            }
+        }
+    }
+}
+
+void bitmatrix_to_dense (const BitMatrix *Zb, gsl_matrix *Z, int K){
+    gsl_matrix_set_zero(Z);
+    for (int n=0; n<Zb->N; n++){
+        const uint64_t *zn= Zb->bits+(size_t) n*Zb->nw;
+        for (int k=0; k<K; k++){
+            gsl_matrix_set(Z, k, n, (zn[k>>6]>>(k&63))&1);
+        }
+    }
+}
+
+// From an N x K row-major array of bytes (nonzero means active)
+void bitmatrix_from_bytes (BitMatrix *Zb, const unsigned char *Z, int K){
+    memset(Zb->bits, 0, (size_t) Zb->N*Zb->nw*sizeof(uint64_t));
+    for (int n=0; n<Zb->N; n++){
+        uint64_t *zn= Zb->bits+(size_t) n*Zb->nw;
+        const unsigned char *row= Z+(size_t) n*K;
+        for (int k=0; k<K; k++){
+            if (row[k]){zn[k>>6]|= (uint64_t) 1<<(k&63);}
+        }
+    }
+}
+
+// To an N x K row-major array of doubles
+void bitmatrix_to_rows (const BitMatrix *Zb, double *Z, int K){
+    for (int n=0; n<Zb->N; n++){
+        const uint64_t *zn= Zb->bits+(size_t) n*Zb->nw;
+        double *row= Z+(size_t) n*K;
+        for (int k=0; k<K; k++){
+            row[k]= (zn[k>>6]>>(k&63))&1;
+        }
+    }
+}
+
+// To an N x ceil(K/8) row-major array of bytes, first feature in the most
+// significant bit (the layout of numpy.packbits along the rows)
+void bitmatrix_to_packbits (const BitMatrix *Zb, unsigned char *Z, int K){
+    int nb= (K+7)/8;
+    memset(Z, 0, (size_t) Zb->N*nb);
+    for (int n=0; n<Zb->N; n++){
+        const uint64_t *zn= Zb->bits+(size_t) n*Zb->nw;
+        unsigned char *row= Z+(size_t) n*nb;
+        for (int k=0; k<K; k++){
+            if ((zn[k>>6]>>(k&63))&1){row[k>>3]|= 0x80>>(k&7);}
+        }
+    }
+}
+
+// zn (cap) = column n of Z
+void bitmatrix_unpack_column (const BitMatrix *Z, int n, double *zn){
+    const uint64_t *w= Z->bits+(size_t) n*Z->nw;
+    for (int k=0; k<Z->cap; k++){
+        zn[k]= (w[k>>6]>>(k&63))&1;
+    }
+}
+
+// column n of Z = the first K entries of zn (the others are cleared)
+void bitmatrix_pack_column (BitMatrix *Z, int n, const double *zn, int K){
+    uint64_t *w= Z->bits+(size_t) n*Z->nw;
+    memset(w, 0, Z->nw*sizeof(uint64_t));
+    for (int k=0; k<K; k++){
+        if (zn[k]!=0){w[k>>6]|= (uint64_t) 1<<(k&63);}
+    }
+}
+
+// nest[k] = number of observations with feature k active, k<K
+void bitmatrix_counts (const BitMatrix *Z, int K, int *nest){
+    for (int k=0; k<K; k++){nest[k]=0;}
+    for (int n=0; n<Z->N; n++){
+        const uint64_t *zn= Z->bits+(size_t) n*Z->nw;
+        for (int i=0; i<Z->nw; i++){
+            for (uint64_t b= zn[i]; b; b&= b-1){
+                nest[64*i+LOWEST_BIT(b)]++;
+            }
+        }
+    }
+}
+
+// P (cap x cap) = Z*Z' + a*I, visiting the pairs of active features of
+// every observation
+void bitmatrix_gram (const BitMatrix *Z, int K, gsl_matrix *P, double a){
+    int act[Z->cap];
+    gsl_matrix_set_identity(P);
+    gsl_matrix_scale(P, a);
+    for (int n=0; n<Z->N; n++){
+        const uint64_t *zn= Z->bits+(size_t) n*Z->nw;
+        int na=0;
+        for (int i=0; i<Z->nw; i++){
+            for (uint64_t b= zn[i]; b; b&= b-1){
+                act[na++]= 64*i+LOWEST_BIT(b);
+            }
+        }
+        for (int i=0; i<na; i++){
+            double *Pi= P->data+act[i]*P->tda;
+            for (int j=0; j<na; j++){
+                Pi[act[j]]+= 1;
+            }
+        }
+    }
+}
+
+// lambdad (cap x Rd) = Z*Yd', with Yd of size Rd x N
+void bitmatrix_mult (const BitMatrix *Z, int K, gsl_matrix *Yd, gsl_matrix *lambdad){
+    int Rd= Yd->size1;
+    gsl_matrix_set_zero(lambdad);
+    for (int n=0; n<Z->N; n++){
+        const uint64_t *zn= Z->bits+(size_t) n*Z->nw;
+        for (int i=0; i<Z->nw; i++){
+            for (uint64_t b= zn[i]; b; b&= b-1){
+                double *lk= lambdad->data+(64*i+LOWEST_BIT(b))*lambdad->tda;
+                for (int r=0; r<Rd; r++){
+                    lk[r]+= Yd->data[r*Yd->tda+n];
+                }
+            }
+        }
+    }
+}
+
+// M (Rd x N) = Bd'*Z, with Bd of size K x Rd
+void bitmatrix_tmult (const BitMatrix *Z, int K, gsl_matrix *Bd, gsl_matrix *M){
+    int Rd= Bd->size2;
+    for (int n=0; n<Z->N; n++){
+        const uint64_t *zn= Z->bits+(size_t) n*Z->nw;
+        for (int r=0; r<Rd; r++){
+            M->data[r*M->tda+n]= 0;
+        }
+        for (int i=0; i<Z->nw; i++){
+            for (uint64_t b= zn[i]; b; b&= b-1){
+                const double *Bk= Bd->data+(64*i+LOWEST_BIT(b))*Bd->tda;
+                for (int r=0; r<Rd; r++){
+                    M->data[r*M->tda+n]+= Bk[r];
+                }
+            }
+        }
+    }
+}
+
+// Feature to takes the values of feature from, which is cleared
+void bitmatrix_move (BitMatrix *Z, int from, int to){
+    int i0= from>>6, i1= to>>6;
+    uint64_t b0= (uint64_t) 1<<(from&63), b1= (uint64_t) 1<<(to&63);
+    for (int n=0; n<Z->N; n++){
+        uint64_t *zn= Z->bits+(size_t) n*Z->nw;
+        if (zn[i0]&b0){zn[i1]|= b1;}else{zn[i1]&= ~b1;}
+        zn[i0]&= ~b0;
+    }
+}
+
+SamplerControl *control_alloc (int N, int D, int maxR, int every){
+    SamplerControl *ctrl= new SamplerControl;
+    ctrl->cancel= 0;
+    ctrl->it= 0;
+    ctrl->every= every;
+    ctrl->N= N;
+    ctrl->D= D;
+    ctrl->maxR= maxR;
+    ctrl->K= -1;
+    ctrl->snapit= 0;
+    ctrl->Z= bitmatrix_alloc(N, 1);
+    ctrl->B= NULL;
+    ctrl->s2Y= (double *) calloc(D, sizeof(double));
+    return ctrl;
+}
+
+void control_free (SamplerControl *ctrl){
+    bitmatrix_free(ctrl->Z);
+    free(ctrl->B);
+    free(ctrl->s2Y);
+    delete ctrl;
+}
+
+void control_cancel (SamplerControl *ctrl){
+    ctrl->cancel= 1;
+}
+
+int control_iteration (SamplerControl *ctrl){
+    return ctrl->it;
+}
+
+// Copies the last snapshot into the caller's buffers, Z as N x K rows, B as
+// D x K x maxR and s2Y, and returns its number of features K, -1 if there is
+// none yet. Nothing is copied if K>Kmax, the buffers being too small.
+int control_snapshot (SamplerControl *ctrl, double *Z, double *B, double *s2Y, int *it, int Kmax){
+    std::lock_guard<std::mutex> guard(ctrl->lock);
+    if (ctrl->K<0 || ctrl->K>Kmax){return ctrl->K;}
+    bitmatrix_to_rows(ctrl->Z, Z, ctrl->K);
+    memcpy(B, ctrl->B, (size_t) ctrl->D*ctrl->K*ctrl->maxR*sizeof(double));
+    memcpy(s2Y, ctrl->s2Y, ctrl->D*sizeof(double));
+    *it= ctrl->snapit;
+    return ctrl->K;
+}
+
+// Called by the sampler at the end of iteration it (1-based)
+static void control_store (SamplerControl *ctrl, int it, int last, int K, BitMatrix *Z, gsl_matrix **B, double *s2Y, char *C, int *R){
+    ctrl->it= it;
+    if (!last && (ctrl->every<=0 || it%ctrl->every!=0)){return;}
+    std::lock_guard<std::mutex> guard(ctrl->lock);
+    int N= ctrl->N, maxR= ctrl->maxR;
+    bitmatrix_resize(ctrl->Z, Z->cap);
+    memcpy(ctrl->Z->bits, Z->bits, (size_t) N*Z->nw*sizeof(uint64_t));
+    if (K!=ctrl->K){
+        free(ctrl->B);
+        ctrl->B= (double *) malloc(((size_t) ctrl->D*K*maxR+1)*sizeof(double));
+    }
+    memset(ctrl->B, 0, (size_t) ctrl->D*K*maxR*sizeof(double));
+    for (int d=0; d<ctrl->D; d++){
+        int Rd= (C[d]=='c') ? R[d] : 1;
+        for (int k=0; k<K; k++){
+            for (int r=0; r<Rd; r++){
+                ctrl->B[(d*K+k)*maxR+r]= gsl_matrix_get(B[d], k, r);
+            }
+        }
+        ctrl->s2Y[d]= s2Y[d];
+    }
+    ctrl->K= K;
+    ctrl->snapit= it;
+}
+
+ObsCache *obscache_alloc_csr (const int *ptr, const int *idx, const double *x, int D){
+    ObsCache *obs= (ObsCache *) malloc(sizeof(ObsCache));
+    int nnz= ptr[D];
+    obs->ptr= (int *) malloc((D+1)*sizeof(int));
+    obs->idx= (int *) malloc(nnz*sizeof(int));
+    obs->x= (double *) malloc(nnz*sizeof(double));
+    obs->ylo= (double *) malloc(nnz*sizeof(double));
+    obs->yhi= (double *) malloc(nnz*sizeof(double));
+    memcpy(obs->ptr, ptr, (D+1)*sizeof(int));
+    memcpy(obs->idx, idx, nnz*sizeof(int));
+    memcpy(obs->x, x, nnz*sizeof(double));
+    return obs;
+}
+
+ObsCache *obscache_alloc (double missing, gsl_matrix *X, int N, int D){
+    int *ptr= (int *) malloc((D+1)*sizeof(int));
+    int nnz=0;
+    double xnd;
+    for (int d=0; d<D; d++){
+        for (int n=0; n<N; n++){
+            xnd=gsl_matrix_get (X, d, n);
+            if (!(xnd==missing || gsl_isnan(xnd))){nnz++;}
+        }
+    }
+    int *idx= (int *) malloc(nnz*sizeof(int));
+    double *x= (double *) malloc(nnz*sizeof(double));
+    int j=0;
+    for (int d=0; d<D; d++){
+        ptr[d]=j;
+        for (int n=0; n<N; n++){
+            xnd=gsl_matrix_get (X, d, n);
+            if (xnd==missing || gsl_isnan(xnd)){continue;}
+            idx[j]=n;
+            x[j]=xnd;
+            j++;
+        }
+    }
+    ptr[D]=j;
+    ObsCache *obs= obscache_alloc_csr(ptr, idx, x, D);
+    free(ptr);
+    free(idx);
+    free(x);
+    return obs;
+}
+
+void obscache_transform (ObsCache *obs, char *C, double *f, double *mu, double *w, int D){
+    for (int d=0; d<D; d++){
+        for (int j=obs->ptr[d]; j<obs->ptr[d+1]; j++){
+            double xnd= obs->x[j];
+            obs->yhi[j]=GSL_POSINF;
+            switch(C[d]){
+                case 'g':
+                    obs->ylo[j]=fre_1(xnd, f[d], mu[d], w[d]);
+                    break;
+                case 'p':
+                    obs->ylo[j]=f_1(xnd, f[d], mu[d], w[d]);
+                    break;
+                case 'n':
+                    obs->ylo[j]=f_1(xnd, f[d], mu[d], w[d]);
+                    obs->yhi[j]=f_1(xnd+1, f[d], mu[d], w[d]);
+                    break;
+                default:
+                    obs->ylo[j]=GSL_NEGINF;
+                    break;
+            }
+        }
+    }
+}
+
+void obscache_free (ObsCache *obs){
+    free(obs->ptr);
+    free(obs->idx);
+    free(obs->x);
+    free(obs->ylo);
+    free(obs->yhi);
+    free(obs);
+}
+
+// Log-likelihood of the pseudo-observations ws->yn of observation n if its
+// features were zn (the first K), given Snon, the inverse of Pnon, and the
+// first K rows of lambdanon. Each used row of each dimension d is Gaussian
+// with variance s2Y[d]+zn'*Snon*zn and mean lambdanon'*Snon*zn: the
+// quadratic form is shared by all of them and the means of the D dimensions
+// come out of a single product with the stacked lambdanon.
+static double loglik_zn (gsl_matrix *Snon, gsl_vector *zn, gsl_matrix *Lnon, double *s2Y, const int *col, int D, SamplerWorkspace *ws){
+    int K= zn->size;
+    double q;
+    gsl_vector_view aux= gsl_matrix_subrow (ws->aux, 0, 0, K);
+    gsl_blas_dgemv (CblasTrans, 1, Snon, zn, 0, &aux.vector);
+    gsl_blas_ddot (&aux.vector, zn, &q);
+    gsl_blas_dgemv (CblasTrans, 1, Lnon, &aux.vector, 0, ws->muy);
+    const double *y= ws->yn->data;
+    const double *muy= ws->muy->data;
+    double lik=0;
+    for (int d=0; d<D; d++){
+        double s2y= s2Y[d]+q;
+        double sse=0;
+        for (int j=col[d]; j<col[d+1]; j++){
+            sse+= (y[j]-muy[j])*(y[j]-muy[j]);
+        }
+        lik-= 0.5*sse/s2y + 0.5*(col[d+1]-col[d])*gsl_sf_log(2*M_PI*s2y);
+    }
+    return lik;
+}
+
+int AcceleratedGibbs (int bias, int N, int D, int K, char *C,  int *R, double alpha, double s2B, double *s2Y, gsl_matrix **Y, BitMatrix *Z, gsl_matrix **B, FeatureBuffers *fb, const gsl_rng *seed, SamplerWorkspace *ws, double *tfeatures){
    int flagErr=0;
    int TK=2;
-   gsl_matrix_view Zn;
-   gsl_matrix_view Ydn;
+   int maxK= fb->maxK;
+   const int *col= fb->col;
+   int sumR= col[D];
+   // aliases into fb, refreshed whenever its capacity changes
+   gsl_matrix *P= fb->P;
+   gsl_matrix *Pnon= fb->Pnon;
+   gsl_matrix *lambda= fb->lambda;
+   gsl_matrix *lambdanon= fb->lambdanon;
+   int *nest= fb->nest;
    gsl_matrix_view Pnon_view;
    gsl_matrix_view Lnon_view;
    //gsl_matrix_view P_view;
    //gsl_matrix_view L_view;
-   gsl_matrix *muy;
-   gsl_matrix *s2y_p= gsl_matrix_alloc(1,1);
-   gsl_matrix *aux;
-   gsl_matrix *Snon;
-   double s2y_num;
+   gsl_matrix_view Snon;
+   gsl_vector_view zn;
+   gsl_vector_view Sz;
+   gsl_vector *yn= ws->yn;
    gsl_matrix_memcpy (Pnon, P);
-   for (int d =0; d<D; d++){
-        gsl_matrix_memcpy (lambdanon[d], lambda[d]);
-    }
+   gsl_matrix_memcpy (lambdanon, lambda);
+   // S keeps the inverse of P (or of Pnon while row n is out), updated with
+   // rank-one and block formulas; it is only refactorized once per sweep
+   gsl_matrix *S= ws->Snon;
+   Snon = gsl_matrix_submatrix (S, 0, 0, K, K);
+   Pnon_view = gsl_matrix_submatrix (P, 0, 0, K, K);
+   gsl_matrix_memcpy (&Snon.matrix, &Pnon_view.matrix);
+   inverse(&Snon.matrix, K);
 
    for (int n=0; n<N; n++){
        double p[TK];
-       // Pnon, LambdaNon
-       Zn = gsl_matrix_submatrix (Z, 0, n, K, 1);
-       Pnon_view = gsl_matrix_submatrix (Pnon, 0, 0, K, K);
-       Snon = gsl_matrix_calloc(K,K);
-       gsl_matrix_memcpy (Snon, &Pnon_view.matrix);
-       inverse(Snon, K);
-       matrix_multiply(&Zn.matrix,&Zn.matrix,&Pnon_view.matrix,-1,1,CblasNoTrans,CblasTrans);
+       // z_n is sampled unpacked in ws->zn and packed back into Z at the end
+       bitmatrix_unpack_column (Z, n, ws->zn->data);
+       // pseudo-observations of n, stacked like the columns of lambda
        for (int d =0; d<D; d++){
-               Lnon_view= gsl_matrix_submatrix (lambdanon[d], 0, 0, K, R[d]);
-               Ydn= gsl_matrix_submatrix (Y[d], 0, n, R[d], 1);
-               matrix_multiply(&Zn.matrix,&Ydn.matrix,&Lnon_view.matrix,-1,1,CblasNoTrans,CblasTrans);
+           for (int j=col[d]; j<col[d+1]; j++){
+               yn->data[j]= gsl_matrix_get (Y[d], j-col[d], n);
+           }
        }
+       // Pnon, LambdaNon
+       zn = gsl_matrix_subcolumn (ws->zn, 0, 0, K);
+       Pnon_view = gsl_matrix_submatrix (Pnon, 0, 0, K, K);
+       Snon = gsl_matrix_submatrix (S, 0, 0, K, K);
+       Sz = gsl_vector_subvector (ws->Sz, 0, K);
+       inverse_rank_one_update(&Snon.matrix, &zn.vector, -1, &Sz.vector);
+       gsl_blas_dger (-1, &zn.vector, &zn.vector, &Pnon_view.matrix);
+       Lnon_view= gsl_matrix_submatrix (lambdanon, 0, 0, K, sumR);
+       gsl_blas_dger (-1, &zn.vector, yn, &Lnon_view.matrix);
        // Sampling znk for k=1...K
        for (int k=bias; k<K; k++){
-          if (gsl_matrix_get(&Zn.matrix,k,0)==1){nest[k]--;}
+          if (gsl_vector_get(&zn.vector,k)==1){nest[k]--;}
            if (nest[k]>0){ 
-               aux = gsl_matrix_alloc(1,K);
                // z_nk=0
-               gsl_matrix_set (&Zn.matrix, k, 0, 0);
-               matrix_multiply(&Zn.matrix,Snon,aux,1,0,CblasTrans,CblasNoTrans); 
-               double lik0=0;
-               for (int d =0; d<D; d++){
-                   gsl_matrix_set(s2y_p,0,0,s2Y[d]);
-                   matrix_multiply(aux,&Zn.matrix,s2y_p,1,1,CblasNoTrans,CblasNoTrans);
-                   s2y_num=gsl_matrix_get(s2y_p,0,0);
-                   Ydn= gsl_matrix_submatrix (Y[d], 0, n, R[d], 1);
-                   Lnon_view= gsl_matrix_submatrix (lambdanon[d], 0, 0, K, R[d]);
-                   muy= gsl_matrix_alloc(1,R[d]);
-                   matrix_multiply(aux,&Lnon_view.matrix,muy,1,0,CblasNoTrans,CblasNoTrans);   
-                   if (C[d]=='c'){
-                       for (int r=0; r<R[d]-1; r++){
-                           lik0-=0.5/s2y_num*pow((gsl_matrix_get(&Ydn.matrix,r,0)- gsl_matrix_get(muy,0,r)),2)+0.5*gsl_sf_log(2*M_PI*s2y_num);
-                           }
-                       }else{
-                           lik0-=0.5/s2y_num*pow((gsl_matrix_get(&Ydn.matrix,0,0)- gsl_matrix_get(muy,0,0)),2)+0.5*gsl_sf_log(2*M_PI*s2y_num);
-                       }
-                   gsl_matrix_free(muy);
-               }
+               gsl_vector_set (&zn.vector, k, 0);
+               double lik0= loglik_zn (&Snon.matrix, &zn.vector, &Lnon_view.matrix, s2Y, col, D, ws);
 
                // z_nk=1
-               gsl_matrix_set (&Zn.matrix, k, 0, 1);
-               matrix_multiply(&Zn.matrix,Snon,aux,1,0,CblasTrans,CblasNoTrans);
-               double lik1=0;
-               for (int d =0; d<D; d++){        
-                   gsl_matrix_set(s2y_p,0,0,s2Y[d]);//TODO
-                   matrix_multiply(aux,&Zn.matrix,s2y_p,1,1,CblasNoTrans,CblasNoTrans);
-                   s2y_num=gsl_matrix_get(s2y_p,0,0);
-                   Ydn= gsl_matrix_submatrix (Y[d], 0, n, R[d], 1);
-                   Lnon_view= gsl_matrix_submatrix (lambdanon[d], 0, 0, K, R[d]);
-                   muy= gsl_matrix_alloc(1,R[d]);
-                   matrix_multiply(aux,&Lnon_view.matrix,muy,1,0,CblasNoTrans,CblasNoTrans); 
-                   if (C[d]=='c'){
-                       for (int r=0; r<R[d]-1; r++){
-                           lik1-=0.5/s2y_num*pow((gsl_matrix_get(&Ydn.matrix,r,0)- gsl_matrix_get(muy,0,r)),2)+0.5*gsl_sf_log(2*M_PI*s2y_num);
-                           }
-                   }else{
-                       lik1-=0.5/s2y_num*pow((gsl_matrix_get(&Ydn.matrix,0,0)- gsl_matrix_get(muy,0,0)),2)+0.5*gsl_sf_log(2*M_PI*s2y_num);
-                   }
-                   gsl_matrix_free(muy);
-               }
+               gsl_vector_set (&zn.vector, k, 1);
+               double lik1= loglik_zn (&Snon.matrix, &zn.vector, &Lnon_view.matrix, s2Y, col, D, ws);
 
 //                printf("lik0=%f , lik1=%f \n", lik0, lik1);
                double p0= gsl_sf_log(N-nest[k])+lik0;
@@ -115,69 +620,55 @@ int AcceleratedGibbs (int maxK,int bias, int N, int D, int K, char *C,  int *R,
                     //printf("nest[%d]=%d \n", k,nest[k]);
                     //printf("lik0=%f , lik1=%f \n", lik0, lik1);
                     printf("EXECUTION STOPPED: numerical error at the sampler. \n  Please restart the sampler and if error persists check hyperparameters. \n",n);
+                    bitmatrix_pack_column (Z, n, ws->zn->data, K);
                     return 0;
                     }
                //sampling znk
-               if (drand48()>p1_n){
-                   gsl_matrix_set (&Zn.matrix, k, 0, 0);
+               if (gsl_rng_uniform(seed)>p1_n){
+                   gsl_vector_set (&zn.vector, k, 0);
                    p[0]=lik0;
                }else{
                    nest[k]+=1;
                    p[0]=lik1;
                }
 //                printf("nest[%d]=%d \n", k,nest[k]);
-               gsl_matrix_free(aux);
 //            }else if (nest[k]>=N){
 //                printf("nest[%d]=%d \n", k,nest[k]);
            }else{
-               gsl_matrix_set (&Zn.matrix, k, 0, 0);
+               gsl_vector_set (&zn.vector, k, 0);
            } 
        }
-       gsl_matrix_free(Snon);
 
        // remove empty features
-       int flagDel=0;
-       int Kdel=0;
-       for (int k=0; k<K;k++){
-           if (nest[k]==0 && K-Kdel>1){
-                //printf("K= %d\n",K);
-                Kdel++;
-                flagDel=1;
-                for (int kk=k; kk<K-1; kk++){
-                    gsl_vector_view Zrow= gsl_matrix_row (Z,kk+1);
-                    gsl_matrix_set_row (Z, kk, &Zrow.vector);
-                    nest[kk]=nest[kk+1];
-                }
-            }
-
-       }
-       for (int k=K-Kdel; k<K; k++){
-           gsl_vector_view Zrow= gsl_matrix_row (Z,k);
-           gsl_vector_set_zero (&Zrow.vector);
-           nest[k]=0;
+       double t0= (tfeatures!=NULL) ? trace_clock() : 0;
+       for (int k=0; k<K && K>1;){
+           if (nest[k]==0){
+                features_remove (fb, K, k, Z, ws);
+                K--;
+           }else{
+                k++;
            }
-       K-=Kdel;
+       }
        //printf("K= %d \n",K);
-       if (flagDel){
-           gsl_matrix_set_identity (P);
-           matrix_multiply(Z,Z,P,1,1/s2B,CblasNoTrans,CblasTrans);
-           gsl_matrix_memcpy (Pnon, P);
-           Pnon_view = gsl_matrix_submatrix (Pnon, 0, 0, K, K);
-           Zn = gsl_matrix_submatrix (Z, 0, n, K, 1);
-           matrix_multiply(&Zn.matrix,&Zn.matrix,&Pnon_view.matrix,-1,1,CblasNoTrans,CblasTrans);
-           for (int d =0; d<D; d++){
-                matrix_multiply(Z,Y[d],lambda[d],1,0,CblasNoTrans,CblasTrans);
-                gsl_matrix_memcpy (lambdanon[d], lambda[d]);
-                Lnon_view= gsl_matrix_submatrix (lambdanon[d], 0, 0, K, R[d]);
-                Ydn= gsl_matrix_submatrix (Y[d], 0, n, R[d], 1);
-                matrix_multiply(&Zn.matrix,&Ydn.matrix,&Lnon_view.matrix,-1,1,CblasNoTrans,CblasTrans);
-           }
-       
+
+       // Adding new features (no observation but n has them yet)
+       if (K+TK<maxK && K+TK>fb->cap){
+           int cap= 2*fb->cap;
+           if (cap<K+TK){cap=K+TK;}
+           if (cap>maxK){cap=maxK;}
+           features_resize (fb, cap, Z, B, ws);
+           P= fb->P;
+           Pnon= fb->Pnon;
+           lambda= fb->lambda;
+           lambdanon= fb->lambdanon;
+           nest= fb->nest;
+           S= ws->Snon;
+       }else if (K+TK>=maxK){
+           fb->capped=1;
+       }
+       for (int k=K; k<K+TK && k<fb->cap; k++){
+           gsl_matrix_set (ws->zn, k, 0, 0);
        }
-       
-       // Adding new features
-       gsl_matrix_view Znew= gsl_matrix_submatrix (Z, K, 0, TK, N);
-       gsl_matrix_set_zero (&Znew.matrix);
        
        if (K+TK<maxK){
        double pmax=p[0];
@@ -186,37 +677,16 @@ int AcceleratedGibbs (int maxK,int bias, int N, int D, int K, char *C,  int *R,
            gsl_vector_view Pnon_colum= gsl_matrix_column (Pnon, K+j-1);
            gsl_vector_set_zero (&Pnon_colum.vector);
            Pnon_colum= gsl_matrix_row (Pnon, K+j-1);
-           gsl_vector_set_basis (&Pnon_colum.vector, K+j-1);
+           gsl_vector_set_zero (&Pnon_colum.vector);
+           gsl_matrix_set (Pnon, K+j-1, K+j-1, 1/s2B);
            
-           aux = gsl_matrix_alloc(1,K+j);
-           Pnon_view = gsl_matrix_submatrix (Pnon, 0, 0, K+j, K+j);
-           Snon = gsl_matrix_calloc(K+j,K+j);
-           gsl_matrix_memcpy (Snon, &Pnon_view.matrix);
-           inverse(Snon, K+j);
-           Zn = gsl_matrix_submatrix (Z, 0, n, K+j, 1);
-           gsl_matrix_set (&Zn.matrix, K+j-1, 0, 1);
-           matrix_multiply(&Zn.matrix,Snon,aux,1,0,CblasTrans,CblasNoTrans);
-           double lik=0;
-           for (int d =0; d<D; d++){ 
-               gsl_matrix_set(s2y_p,0,0,s2Y[d]);//TODO
-               matrix_multiply(aux,&Zn.matrix,s2y_p,1,1,CblasNoTrans,CblasNoTrans);
-               s2y_num=gsl_matrix_get(s2y_p,0,0);
-               Ydn= gsl_matrix_submatrix (Y[d], 0, n, R[d], 1);
-               Lnon_view= gsl_matrix_submatrix (lambdanon[d], 0, 0, K+j, R[d]);
-               muy= gsl_matrix_alloc(1,R[d]);
-               matrix_multiply(aux,&Lnon_view.matrix,muy,1,0,CblasNoTrans,CblasNoTrans); 
-               if (C[d]=='c'){
-                   for (int r=0; r<R[d]-1; r++){
-                       lik-=0.5/s2y_num*pow((gsl_matrix_get(&Ydn.matrix,r,0)- gsl_matrix_get(muy,0,r)),2)+0.5*gsl_sf_log(2*M_PI*s2y_num);
-                       }
-               }else{
-                   lik-=0.5/s2y_num*pow((gsl_matrix_get(&Ydn.matrix,0,0)- gsl_matrix_get(muy,0,0)),2)+0.5*gsl_sf_log(2*M_PI*s2y_num);
-               }
-               gsl_matrix_free(muy);
-           }
+           inverse_append_index(S, K+j-1, 1/s2B);
+           Snon = gsl_matrix_submatrix (S, 0, 0, K+j, K+j);
+           zn = gsl_matrix_subcolumn (ws->zn, 0, 0, K+j);
+           gsl_vector_set (&zn.vector, K+j-1, 1);
+           Lnon_view= gsl_matrix_submatrix (lambdanon, 0, 0, K+j, sumR);
+           double lik= loglik_zn (&Snon.matrix, &zn.vector, &Lnon_view.matrix, s2Y, col, D, ws);
            p[j]=lik+j*gsl_sf_log(alpha/N)-gsl_sf_log(factorial(j));
-           gsl_matrix_free(aux);
-           gsl_matrix_free(Snon);
      
            if(pmax<p[j]){pmax=p[j];}
            kk=j;
@@ -231,150 +701,142 @@ int AcceleratedGibbs (int maxK,int bias, int N, int D, int K, char *C,  int *R,
    for (int k=0;k<=kk; k++){
        p[k]=p[k]/den;
    }
-   int Knew=mnrnd(p, kk);
+   int Knew=mnrnd(p, kk, seed);
    if (Knew>0){
        for (int k=K; k<K+Knew; k++){nest[k]=1;}
        }
    K+=Knew;
    }
+   if (tfeatures!=NULL){*tfeatures+= trace_clock()-t0;}
    //Adding Zn
-   Zn = gsl_matrix_submatrix (Z, 0, n, K, 1);
+   bitmatrix_pack_column (Z, n, ws->zn->data, K);
+   zn = gsl_matrix_subcolumn (ws->zn, 0, 0, K);
    Pnon_view = gsl_matrix_submatrix (Pnon, 0, 0, K, K);
-   matrix_multiply(&Zn.matrix,&Zn.matrix,&Pnon_view.matrix,1,1,CblasNoTrans,CblasTrans);
+   Snon = gsl_matrix_submatrix (S, 0, 0, K, K);
+   Sz = gsl_vector_subvector (ws->Sz, 0, K);
+   inverse_rank_one_update(&Snon.matrix, &zn.vector, 1, &Sz.vector);
+   gsl_blas_dger (1, &zn.vector, &zn.vector, &Pnon_view.matrix);
    gsl_matrix_memcpy (P, Pnon);
-   for (int d =0; d<D; d++){
-        Ydn= gsl_matrix_submatrix (Y[d], 0, n, R[d], 1);
-        Lnon_view= gsl_matrix_submatrix (lambdanon[d], 0, 0, K, R[d]);
-        matrix_multiply(&Zn.matrix,&Ydn.matrix,&Lnon_view.matrix,1,1,CblasNoTrans,CblasTrans);
-        gsl_matrix_memcpy (lambda[d], lambdanon[d]);
-   }
+   Lnon_view= gsl_matrix_submatrix (lambdanon, 0, 0, K, sumR);
+   gsl_blas_dger (1, &zn.vector, yn, &Lnon_view.matrix);
+   gsl_matrix_memcpy (lambda, lambdanon);
 
    }
-   gsl_matrix_free(s2y_p);
 
    return K;
 }
 
 
 
-//Sample Y
-void SampleY (double missing, int N, int d, int K, char Cd,  int Rd, double fd, double mud, double wd, double s2Y, double s2u, double s2theta, gsl_matrix *X, gsl_matrix *Z, gsl_matrix *Yd,  gsl_matrix *Bd, gsl_vector *thetad, const gsl_rng *seed){
+//Sample Y: returns 1 on a numerical error (pseudo-observations of the
+// observed cells that are not finite), 0 otherwise
+int SampleY (int N, int d, int K, char Cd,  int Rd, double fd, double mud, double wd, double s2Y, double s2u, double s2theta, BitMatrix *Z, gsl_matrix *Yd,  gsl_matrix *Bd, gsl_vector *thetad, const gsl_rng *seed, const ObsCache *obs, SamplerWorkspace *ws){
     double su= sqrt(s2u);
     double sYd= sqrt(s2Y);
     double stheta= sqrt(s2theta);
-    gsl_matrix_view Zn;
     gsl_matrix_view Bd_view;
+    gsl_matrix_view muy_view;
     gsl_matrix *muy;
     double xnd;
+    // only the observed cells of dimension d are visited here; the missing
+    // ones are drawn by SampleYmissing once s2Y has been updated
+    int jbeg= obs->ptr[d];
+    int jend= obs->ptr[d+1];
+    int n;
+    // muy = Bd'*Z for all the observations at once, stored as Rd x N
+    if (Cd=='c'){
+        Bd_view = gsl_matrix_submatrix (Bd, 0, 0, K, Rd);
+        muy_view = gsl_matrix_submatrix (ws->ZB, 0, 0, Rd, N);
+    }else{
+        Bd_view = gsl_matrix_submatrix (Bd, 0, 0, K, 1);
+        muy_view = gsl_matrix_submatrix (ws->ZB, 0, 0, 1, N);
+    }
+    muy= &muy_view.matrix;
+    bitmatrix_tmult(Z, K, &Bd_view.matrix, muy);
     switch(Cd){
         case 'g':
-            muy= gsl_matrix_alloc(1,1);
-            for (int n=0; n<N; n++){
-                xnd=gsl_matrix_get (X, d, n);
-                Zn = gsl_matrix_submatrix (Z, 0, n, K, 1);
-                Bd_view = gsl_matrix_submatrix (Bd, 0, 0, K, 1);
-                matrix_multiply(&Zn.matrix,&Bd_view.matrix,muy,1,0,CblasTrans,CblasNoTrans); 
-                if (xnd==missing || gsl_isnan(xnd)){
-                    gsl_matrix_set (Yd, 0, n, gsl_matrix_get(muy,0,0)+  gsl_ran_gaussian (seed, sYd));
-                 }else{
-                    gsl_matrix_set (Yd, 0, n, (fre_1(xnd, fd, mud, wd)/s2u + gsl_matrix_get(muy,0,0)/s2Y)/(1/s2Y+1/s2u) +  gsl_ran_gaussian (seed, sqrt(1/(1/s2Y+1/s2u))));
-                }
+            for (int j=jbeg; j<jend; j++){
+                n= obs->idx[j];
+                gsl_matrix_set (Yd, 0, n, (obs->ylo[j]/s2u + gsl_matrix_get(muy,0,n)/s2Y)/(1/s2Y+1/s2u) +  gsl_ran_gaussian (seed, sqrt(1/(1/s2Y+1/s2u))));
             }
-            gsl_matrix_free(muy);    
             
             break;
             
         case 'p': 
-            muy= gsl_matrix_alloc(1,1);
-            for (int n=0; n<N; n++){
-                xnd=gsl_matrix_get (X, d, n);
-                Zn = gsl_matrix_submatrix (Z, 0, n, K, 1);
-                Bd_view = gsl_matrix_submatrix (Bd, 0, 0, K, 1);
-                matrix_multiply(&Zn.matrix,&Bd_view.matrix,muy,1,0,CblasTrans,CblasNoTrans);
-                if (xnd==missing || gsl_isnan(xnd)){
-                     gsl_matrix_set (Yd, 0, n, gsl_matrix_get(muy,0,0)+  gsl_ran_gaussian (seed, sYd));
-                }else{
-                    gsl_matrix_set (Yd, 0, n, (f_1(xnd, fd, mud, wd)/s2u + gsl_matrix_get(muy,0,0)/s2Y)/(1/s2Y+1/s2u) +  gsl_ran_gaussian (seed, sqrt(1/(1/s2Y+1/s2u))));
-                }
+            for (int j=jbeg; j<jend; j++){
+                n= obs->idx[j];
+                gsl_matrix_set (Yd, 0, n, (obs->ylo[j]/s2u + gsl_matrix_get(muy,0,n)/s2Y)/(1/s2Y+1/s2u) +  gsl_ran_gaussian (seed, sqrt(1/(1/s2Y+1/s2u))));
             }
-            gsl_matrix_free(muy); 
             break;
             
-        case 'n': 
-            muy= gsl_matrix_alloc(1,1);
-            for (int n=0; n<N; n++){
-                xnd=gsl_matrix_get (X, d, n);
-                Zn = gsl_matrix_submatrix (Z, 0, n, K, 1);
-                Bd_view = gsl_matrix_submatrix (Bd, 0, 0, K, 1);
-                matrix_multiply(&Zn.matrix,&Bd_view.matrix,muy,1,0,CblasTrans,CblasNoTrans);
-                if (xnd==missing || gsl_isnan(xnd)){
-                     gsl_matrix_set (Yd, 0, n, gsl_matrix_get(muy,0,0)+  gsl_ran_gaussian (seed, sYd));
-                }else{
-                    gsl_matrix_set (Yd, 0, n, truncnormrnd(gsl_matrix_get(muy,0,0), sYd, f_1(xnd, fd, mud, wd),f_1(xnd+1, fd, mud, wd)));
-                }
-                if (isinf(gsl_matrix_get(Yd, 0, n)) || isnan(gsl_matrix_get(Yd, 0, n)) ){
-                     printf("EXECUTION STOPPED: the distribution of attribute %d (%d in Matlab) leads to numerical errors at the sampler. \n                   Have you considered applying a pre-processing transformation to this attribute? \n",d, d+1);
-                     break;
-                }
+        case 'n': {
+            // gather the means of the observed entries, draw them all at
+            // once between the bounds of ObsCache and scatter the result
+            double *mu= ws->TN->data;
+            for (int j=jbeg; j<jend; j++){
+                mu[j-jbeg]= gsl_matrix_get(muy,0,obs->idx[j]);
+            }
+            if (truncnormrnd_n(jend-jbeg, mu, sYd, obs->ylo+jbeg, obs->yhi+jbeg, mu, seed)>0){
+                return 1;
+            }
+            for (int j=jbeg; j<jend; j++){
+                gsl_matrix_set (Yd, 0, obs->idx[j], mu[j-jbeg]);
             }
-            gsl_matrix_free(muy); 
             break;
+        }
             
         case 'c': 
-            muy= gsl_matrix_alloc(1,Rd);
-            for (int n=0; n<N; n++){
-                xnd=gsl_matrix_get (X, d, n);   
-                Zn = gsl_matrix_submatrix (Z, 0, n, K, 1);
-                Bd_view = gsl_matrix_submatrix (Bd, 0, 0, K, Rd);
-                matrix_multiply(&Zn.matrix,&Bd_view.matrix,muy,1,0,CblasTrans,CblasNoTrans);
-                if (xnd==missing || gsl_isnan(xnd)){
-                    for(int r=0; r<Rd; r++){
-                        gsl_matrix_set (Yd, r, n, gsl_matrix_get(muy,0,r)+gsl_ran_gaussian (seed, sYd));
-                    }
-                }else{
-                    double maxY=0;
-                    double ytrue=gsl_matrix_get (Yd, xnd-1, n);
-                    for(int r=0; r<Rd; r++){
-                        double ydr= gsl_matrix_get (Yd, r, n);
-                        if ((ydr!=ytrue) & (ydr>maxY)){maxY=ydr;}
-                    }
-                    gsl_matrix_set (Yd, xnd-1, n, truncnormrnd(gsl_matrix_get(muy,0,xnd-1), sYd, maxY, GSL_POSINF));
-                    for(int r=0; r<Rd; r++){
-                        if (r!=xnd-1){
-                            gsl_matrix_set (Yd, r, n, truncnormrnd(gsl_matrix_get(muy,0,r), sYd, GSL_NEGINF, gsl_matrix_get (Yd, xnd-1, n)));
-                        }
+            for (int j=jbeg; j<jend; j++){
+                n= obs->idx[j];
+                xnd= obs->x[j];
+                double maxY=0;
+                double ytrue=gsl_matrix_get (Yd, xnd-1, n);
+                for(int r=0; r<Rd; r++){
+                    double ydr= gsl_matrix_get (Yd, r, n);
+                    if ((ydr!=ytrue) & (ydr>maxY)){maxY=ydr;}
+                }
+                ytrue= truncnormrnd(gsl_matrix_get(muy,xnd-1,n), sYd, maxY, GSL_POSINF, seed);
+                if (!gsl_finite(ytrue)){return 1;}
+                gsl_matrix_set (Yd, xnd-1, n, ytrue);
+                for(int r=0; r<Rd; r++){
+                    if (r!=xnd-1){
+                        double ydr= truncnormrnd(gsl_matrix_get(muy,r,n), sYd, GSL_NEGINF, ytrue, seed);
+                        if (!gsl_finite(ydr)){return 1;}
+                        gsl_matrix_set (Yd, r, n, ydr);
                     }
                 }
             }
-            gsl_matrix_free(muy);
             break;
           case 'o': 
                 // Sample Y
-                gsl_vector *Ymax= gsl_vector_calloc (Rd); 
-                gsl_vector *Ymin= gsl_vector_alloc (Rd); 
+                gsl_vector_view Ymax_view= gsl_vector_subvector (ws->Ymax, 0, Rd);
+                gsl_vector_view Ymin_view= gsl_vector_subvector (ws->Ymin, 0, Rd);
+                gsl_vector *Ymax= &Ymax_view.vector;
+                gsl_vector *Ymin= &Ymin_view.vector;
+                gsl_vector_set_zero (Ymax);
                 gsl_vector_set_all (Ymin, GSL_POSINF);
-                muy= gsl_matrix_alloc(1,1);
-                for (int n=0; n<N; n++){
-                    xnd=gsl_matrix_get (X, d, n);
-                    Zn = gsl_matrix_submatrix (Z, 0, n, K, 1);
-                    Bd_view = gsl_matrix_submatrix (Bd, 0, 0, K, 1);
-                    
-                    matrix_multiply(&Zn.matrix,&Bd_view.matrix,muy,1,0,CblasTrans,CblasNoTrans);
-                    if (xnd==missing || gsl_isnan(xnd)){                        
-                         gsl_matrix_set (Yd, 0, n, gsl_matrix_get(muy,0,0)+gsl_ran_gaussian (seed, sYd));
-                    }else if (xnd==1){
-                         gsl_matrix_set(Yd, 0, n, truncnormrnd(gsl_matrix_get(muy,0,0), sYd, GSL_NEGINF, gsl_vector_get (thetad, xnd-1)));
-                         if (gsl_matrix_get(Yd, 0, n)>gsl_vector_get(Ymax,xnd-1)){gsl_vector_set(Ymax,xnd-1,gsl_matrix_get(Yd, 0, n));}
-                         if (gsl_matrix_get(Yd, 0, n)<gsl_vector_get(Ymin,xnd-1)){gsl_vector_set(Ymin,xnd-1,gsl_matrix_get(Yd, 0, n));}
-                    }else{
-                         gsl_matrix_set(Yd, 0, n, truncnormrnd(gsl_matrix_get(muy,0,0), sYd, gsl_vector_get (thetad, xnd-2), gsl_vector_get (thetad, xnd-1)));
-                         if (gsl_matrix_get(Yd, 0, n)>gsl_vector_get(Ymax,xnd-1)){gsl_vector_set(Ymax,xnd-1,gsl_matrix_get(Yd, 0, n));}
-                         if (gsl_matrix_get(Yd, 0, n)<gsl_vector_get(Ymin,xnd-1)){gsl_vector_set(Ymin,xnd-1,gsl_matrix_get(Yd, 0, n));}
-                    }
-                    
+                {
+                double *mu= gsl_matrix_ptr(ws->TN, 0, 0);
+                double *lo= gsl_matrix_ptr(ws->TN, 1, 0);
+                double *hi= gsl_matrix_ptr(ws->TN, 2, 0);
+                for (int j=jbeg; j<jend; j++){
+                    xnd= obs->x[j];
+                    mu[j-jbeg]= gsl_matrix_get(muy,0,obs->idx[j]);
+                    lo[j-jbeg]= (xnd==1)? GSL_NEGINF: gsl_vector_get (thetad, xnd-2);
+                    hi[j-jbeg]= gsl_vector_get (thetad, xnd-1);
+                }
+                if (truncnormrnd_n(jend-jbeg, mu, sYd, lo, hi, mu, seed)>0){
+                    return 1;
+                }
+                for (int j=jbeg; j<jend; j++){
+                    n= obs->idx[j];
+                    xnd= obs->x[j];
+                    gsl_matrix_set(Yd, 0, n, mu[j-jbeg]);
+                    if (gsl_matrix_get(Yd, 0, n)>gsl_vector_get(Ymax,xnd-1)){gsl_vector_set(Ymax,xnd-1,gsl_matrix_get(Yd, 0, n));}
+                    if (gsl_matrix_get(Yd, 0, n)<gsl_vector_get(Ymin,xnd-1)){gsl_vector_set(Ymin,xnd-1,gsl_matrix_get(Yd, 0, n));}
+                }
                 }
                 break; 
-                gsl_matrix_free(muy);
                 
                 //Sample Theta
                 for(int r=1; r<Rd-1; r++){
@@ -384,97 +846,107 @@ void SampleY (double missing, int N, int d, int K, char Cd,  int Rd, double fd,
                     else{xlo=gsl_vector_get(Ymax,r);}
                     if( gsl_vector_get (thetad, r+1)<gsl_vector_get(Ymin,r+1)){xhi=gsl_vector_get (thetad, r+1);}
                     else{xhi=gsl_vector_get(Ymin,r+1);}
-                    gsl_vector_set (thetad, r, truncnormrnd(0, stheta, xlo, xhi));
+                    gsl_vector_set (thetad, r, truncnormrnd(0, stheta, xlo, xhi, seed));
                 }
             
             
         
    
     }
-    
+    return 0;
 }
-double Samples2Y (double missing, int N, int d, int K, char Cd,  int Rd, double fd, double mud, double wd, double s2u, double s2theta, gsl_matrix *X, gsl_matrix *Z, gsl_matrix *Yd,  gsl_matrix *Bd, gsl_vector *thetad, const gsl_rng *seed){
+void SampleYmissing (int N, int d, char Cd,  int Rd, double s2Y, gsl_matrix *Yd, const gsl_rng *seed, const ObsCache *obs, SamplerWorkspace *ws){
+    // Draws the pseudo-observations of the missing cells of dimension d from
+    // N(muy, s2Y), with the means ws->ZB left by SampleY
+    double sYd= sqrt(s2Y);
+    int nr= (Cd=='c') ? Rd : 1;
+    gsl_matrix_view muy_view = gsl_matrix_submatrix (ws->ZB, 0, 0, nr, N);
+    gsl_matrix *muy= &muy_view.matrix;
+    int j= obs->ptr[d];
+    int jend= obs->ptr[d+1];
+    for (int n=0; n<N; n++){
+        if (j<jend && obs->idx[j]==n){j++; continue;}
+        for(int r=0; r<nr; r++){
+            gsl_matrix_set (Yd, r, n, gsl_matrix_get(muy,r,n)+gsl_ran_gaussian (seed, sYd));
+        }
+    }
+}
+
+double Samples2Y (int N, int d, int K, char Cd,  int Rd, double fd, double mud, double wd, double s2u, double s2theta, BitMatrix *Z, gsl_matrix *Yd,  gsl_matrix *Bd, gsl_vector *thetad, const gsl_rng *seed, const ObsCache *obs, SamplerWorkspace *ws){
+    // Uses the predicted means ws->ZB left by SampleY for this same dimension.
+    // Only observed cells enter the update: the missing pseudo-observations
+    // are draws from N(muy, s2Y) and are marginalized out.
     double a=2;
     double b=2;
-    gsl_matrix_view Zn;
-    gsl_matrix_view Bd_view;
-    gsl_matrix *muy;
     double sumY=0;
-    double xnd;
-
-    muy= gsl_matrix_alloc(1,1);
+    double *yd= Yd->data;
+    double *muy= ws->ZB->data;
+    int nobs= obs->ptr[d+1]-obs->ptr[d];
 
-    for (int n=0; n<N; n++){
-        for(int r=0; r<Rd; r++){
-                xnd=gsl_matrix_get (X, d, n);
-                Zn = gsl_matrix_submatrix (Z, 0, n, K, 1);
-                Bd_view = gsl_matrix_submatrix (Bd, 0, 0, K, 1);
-                matrix_multiply(&Zn.matrix,&Bd_view.matrix,muy,1,0,CblasTrans,CblasNoTrans); 
-                sumY+=pow(gsl_matrix_get (Yd, 0, n)-gsl_matrix_get(muy,0,0),2);
-         }
+    for (int j=obs->ptr[d]; j<obs->ptr[d+1]; j++){
+        int n= obs->idx[j];
+        sumY+=(yd[n]-muy[n])*(yd[n]-muy[n]);
     }
-    gsl_matrix_free(muy);
 
-    double precision= gsl_ran_gamma (seed, a+N/2, 1/(b+sumY/2));
+    double precision= gsl_ran_gamma (seed, a+nobs/2.0, 1/(b+sumY/2));
     return 1/precision;
 }
 
 
-int IBPsampler_func (double missing, gsl_matrix *X, char *C, gsl_matrix *Z, gsl_matrix **B, gsl_vector **theta, int *R, double *f, double *mu,  double *w, int maxR, int bias, int N, int D, int K, double alpha, double s2B, double *s2Y, double s2u,int maxK,int Nsim){
-//Starting C function
-
-//     // For debugging, print input parameters
-//     printf("X[0,0]=%f,X[0,1]=%f,X[1,0]=%f\n", gsl_matrix_get(X,0,0), gsl_matrix_get(X,0,1), gsl_matrix_get(X,1,0));
-//     printf("Z[0,0]=%f,Z[0,1]=%f,Z[1,0]=%f\n", gsl_matrix_get(Z,0,0), gsl_matrix_get(Z,0,1), gsl_matrix_get(Z,1,0));
-    //printf("f[0]=%f,mu[1]=%f,w[2]=%f,s2Y[4]=%f\n", f[0], mu[1], w[2],s2Y[3]);
-    printf("N=%d, D=%d, K=%d\n", N, D, K);
-
-    printf("Running inference algorithm (currently inside C++ routine...)\n");
+SamplerState *sampler_alloc (ObsCache *obs, char *C, BitMatrix *Z, gsl_matrix **B, gsl_vector **theta, int *R, double *f, double *mu,  double *w, int maxR, int bias, int N, int D, int K, double alpha, double s2B, double *s2Y, double s2u, int maxK, int nthreads, unsigned long rngseed){
     
        //.....INIZIALIZATION........//
     double s2theta=2;
-    double stheta=sqrt(s2theta);
     //double sY=sqrt(s2Y);
     // random numbers
-    srand48(time(NULL));
-    gsl_rng *seed = gsl_rng_alloc(gsl_rng_taus);
-    time_t clck=time(NULL);
-    gsl_rng_set(seed, clck);
+    // stream 0 drives the serial steps, stream 1+d the updates of dimension d
+    gsl_rng *seed = rng_alloc_stream(rngseed, 0);
     
-    // auxiliary variables
+    // auxiliary variables, sized for the current number of features and
+    // resized with it (Z and the rows of B included)
     int Kest=K;
-    gsl_matrix *P= gsl_matrix_alloc(maxK,maxK);
-    gsl_matrix_set_identity (P);
-    matrix_multiply(Z,Z,P,1,1/s2B,CblasNoTrans,CblasTrans);
-    gsl_matrix *Pnon= gsl_matrix_alloc(maxK,maxK);
+    int cap= features_capacity(Kest, maxK);
+    FeatureBuffers *fb= features_alloc(cap, maxK, D, C, R);
+    bitmatrix_resize (Z, cap);
+    for (int d=0; d<D; d++){
+        B[d]= matrix_resize(B[d], cap, B[d]->size2);
+    }
+    bitmatrix_gram (Z, Kest, fb->P, 1/s2B);
+    int sumR= fb->col[D];
+    SamplerWorkspace *ws= workspace_alloc(N, cap, maxR, sumR);
+    obscache_transform(obs, C, f, mu, w, D);
+    // The B/Y phase runs the dimensions in parallel: one workspace per
+    // thread (ws is the first one) and one random stream per dimension, so
+    // that the chain does not depend on the number of threads
+    if (nthreads<1){nthreads=1;}
+    SamplerWorkspace **wst= (SamplerWorkspace **) malloc(nthreads*sizeof(SamplerWorkspace*));
+    wst[0]= ws;
+    // (the B/Y phase does not use the feature-sized buffers)
+    for (int t=1; t<nthreads; t++){
+        wst[t]= workspace_alloc(N, 1, maxR, sumR);
+    }
+    gsl_rng **seedd= (gsl_rng **) malloc(D*sizeof(gsl_rng*));
+    for (int d=0; d<D; d++){
+        seedd[d]= rng_alloc_stream(rngseed, 1+d);
+    }
     
     // initialize counts
-    int nest[maxK];
-    for (int k=0; k<Kest; k++){
-        double ncount=0;
-        for (int n=0; n<N; n++){
-              if(gsl_matrix_get (Z, k, n)==1){ncount++;}
-        }
-        nest[k]=ncount;
-        //nest[k]=(gsl_matrix_get (P, k, k)-1);
-//         printf("nest[%d]=%d \n", k,nest[k]);
-        }
+    bitmatrix_counts (Z, Kest, fb->nest);
     
     gsl_matrix **Y=(gsl_matrix **) calloc(D,sizeof(gsl_matrix*));
-    gsl_matrix **lambda=(gsl_matrix **) calloc(D,sizeof(gsl_matrix*));
-    gsl_matrix **lambdanon=(gsl_matrix **) calloc(D,sizeof(gsl_matrix*));
     for (int d =0; d<D; d++){
         //Initialize Y !!!!!!
+         int j= obs->ptr[d];
+         int jend= obs->ptr[d+1];
          switch(C[d]){
             double xnd;
             case 'g':
                 Y[d] =gsl_matrix_alloc(1,N); 
                 for (int n=0; n<N; n++){
-                    xnd=gsl_matrix_get (X, d, n);
-                    if (xnd==missing || gsl_isnan(xnd)){
+                    if (j==jend || obs->idx[j]!=n){
                         gsl_matrix_set (Y[d], 0, n, gsl_ran_gaussian (seed, sqrt(s2Y[d])));
                    }else{
-                        gsl_matrix_set(Y[d], 0, n, fre_1(xnd, f[d], mu[d], w[d]));
+                        gsl_matrix_set(Y[d], 0, n, obs->ylo[j++]);
                     }
                 }
 
@@ -483,27 +955,21 @@ int IBPsampler_func (double missing, gsl_matrix *X, char *C, gsl_matrix *Z, gsl_
             case 'p': 
                 Y[d] =gsl_matrix_alloc(1,N); 
                 for (int n=0; n<N; n++){
-                    xnd=gsl_matrix_get (X, d, n);
-
-                    if (xnd==missing || gsl_isnan(xnd)){
+                    if (j==jend || obs->idx[j]!=n){
                          gsl_matrix_set (Y[d], 0, n, gsl_ran_gaussian (seed, sqrt(s2Y[d])));
                     }else{
-                         gsl_matrix_set(Y[d], 0, n, f_1(xnd, f[d], mu[d], w[d]) ); //+gsl_ran_gaussian (seed, s2Y)
+                         gsl_matrix_set(Y[d], 0, n, obs->ylo[j++]); //+gsl_ran_gaussian (seed, s2Y)
                     }
                 }
                 break;
 
             case 'n':
                 Y[d] =gsl_matrix_alloc(1,N); 
-                lambda[d] =gsl_matrix_calloc(maxK,1);
-                matrix_multiply(Z,Y[d],lambda[d],1,0,CblasNoTrans,CblasTrans);
                 for (int n=0; n<N; n++){
-                    xnd=gsl_matrix_get (X, d, n);
-
-                    if (xnd==missing || gsl_isnan(xnd)){
+                    if (j==jend || obs->idx[j]!=n){
                          gsl_matrix_set (Y[d], 0, n, gsl_ran_gaussian (seed, sqrt(s2Y[d])));
                     }else{
-                         gsl_matrix_set(Y[d], 0, n, f_1(xnd,f[d], mu[d], w[d]));// +gsl_ran_beta (seed, 5,1)
+                         gsl_matrix_set(Y[d], 0, n, obs->ylo[j++]);// +gsl_ran_beta (seed, 5,1)
                     }
 //                     printf("ynd = %f ", f_1(xnd,f[d], mu[d], w[d]));
                 }
@@ -513,16 +979,16 @@ int IBPsampler_func (double missing, gsl_matrix *X, char *C, gsl_matrix *Z, gsl_
             case 'c': 
                 Y[d] =gsl_matrix_alloc(R[d],N);
                 for (int n=0; n<N; n++){
-                    xnd=gsl_matrix_get (X, d, n);                   
-                    if (xnd==missing || gsl_isnan(xnd)){
+                    if (j==jend || obs->idx[j]!=n){
                         for(int r=0; r<R[d]; r++){
                             gsl_matrix_set (Y[d], r, n, gsl_ran_gaussian(seed, sqrt(s2Y[d])));
                         }
                     }else{
-                        gsl_matrix_set (Y[d], xnd-1, n, truncnormrnd(0, sqrt(s2Y[d]), 0, GSL_POSINF));
+                        xnd= obs->x[j++];
+                        gsl_matrix_set (Y[d], xnd-1, n, truncnormrnd(0, sqrt(s2Y[d]), 0, GSL_POSINF, seed));
                         for(int r=0; r<R[d]; r++){
                             if (r!=xnd-1){
-                                gsl_matrix_set (Y[d], r, n, truncnormrnd(0, sqrt(s2Y[d]), GSL_NEGINF, gsl_matrix_get (Y[d], xnd-1, n)));
+                                gsl_matrix_set (Y[d], r, n, truncnormrnd(0, sqrt(s2Y[d]), GSL_NEGINF, gsl_matrix_get (Y[d], xnd-1, n), seed));
                             }
                         }
                     }
@@ -532,134 +998,331 @@ int IBPsampler_func (double missing, gsl_matrix *X, char *C, gsl_matrix *Z, gsl_
              case 'o': 
                 Y[d] =gsl_matrix_alloc(R[d],N); 
                 //gsl_vector_set (theta[d], 0, -2*stheta);
-                gsl_vector_view Xd_view = gsl_matrix_row(X, d);
-                double maxX = compute_vector_max(N,missing, &Xd_view.vector);//gsl_vector_max(&Xd_view.vector);
+                double maxX = -1e100;
+                for (int jj=j; jj<jend; jj++){
+                    if (obs->x[jj]>maxX){maxX=obs->x[jj];}
+                }
                 gsl_vector_set (theta[d], 0, -sqrt(s2Y[d]));
                 for(int r=1; r<R[d]-1; r++){
-                    //gsl_vector_set (theta[d], r, truncnormrnd(0, stheta, gsl_vector_get (theta[d], r-1), GSL_POSINF));
-                    gsl_vector_set (theta[d], r, gsl_vector_get (theta[d], r-1)+ (4*sqrt(s2Y[d])/maxX)*drand48());
+                    //gsl_vector_set (theta[d], r, truncnormrnd(0, stheta, gsl_vector_get (theta[d], r-1), GSL_POSINF, seed));
+                    gsl_vector_set (theta[d], r, gsl_vector_get (theta[d], r-1)+ (4*sqrt(s2Y[d])/maxX)*gsl_rng_uniform(seed));
                 }
                 gsl_vector_set (theta[d], R[d]-1, GSL_POSINF);
                 for (int n=0; n<N; n++){
-                    xnd=gsl_matrix_get (X, d, n);
-                    
-                    if (xnd==missing || gsl_isnan(xnd)){
+                    if (j==jend || obs->idx[j]!=n){
                          gsl_matrix_set (Y[d], 0, n, gsl_ran_gaussian (seed, sqrt(s2Y[d])));
-                    }else if (xnd==1){
-                         gsl_matrix_set(Y[d], 0, n, truncnormrnd(0, sqrt(s2Y[d]), GSL_NEGINF, gsl_vector_get (theta[d], xnd-1)));
+                         continue;
+                    }
+                    xnd= obs->x[j++];
+                    if (xnd==1){
+                         gsl_matrix_set(Y[d], 0, n, truncnormrnd(0, sqrt(s2Y[d]), GSL_NEGINF, gsl_vector_get (theta[d], xnd-1), seed));
                     }else{
-                         gsl_matrix_set(Y[d], 0, n, truncnormrnd(0, sqrt(s2Y[d]), gsl_vector_get (theta[d], xnd-2), gsl_vector_get (theta[d], xnd-1)));
+                         gsl_matrix_set(Y[d], 0, n, truncnormrnd(0, sqrt(s2Y[d]), gsl_vector_get (theta[d], xnd-2), gsl_vector_get (theta[d], xnd-1), seed));
                     }
                 }
                  break;
 
         }
-            lambda[d] =gsl_matrix_calloc(maxK,R[d]);
-            matrix_multiply(Z,Y[d],lambda[d],1,0,CblasNoTrans,CblasTrans);
-            lambdanon[d]= gsl_matrix_calloc(maxK,R[d]);        
+            features_lambda (fb, d, Z, Kest, Y[d]);
     }
     
-    printf("Before IT loop...\n");
-    printf("Nsim=%d\n", Nsim);
+    SamplerState *st= (SamplerState *) malloc(sizeof(SamplerState));
+    st->N= N;
+    st->D= D;
+    st->maxR= maxR;
+    st->bias= bias;
+    st->nthreads= nthreads;
+    st->alpha= alpha;
+    st->s2B= s2B;
+    st->s2u= s2u;
+    st->s2theta= s2theta;
+    st->K= Kest;
+    st->it= 0;
+    st->status= 0;
+    st->resync_every= 0;
+    st->nsweep= 0;
+    st->obs= obs;
+    st->C= C;
+    st->R= R;
+    st->f= f;
+    st->mu= mu;
+    st->w= w;
+    st->s2Y= s2Y;
+    st->Z= Z;
+    st->B= B;
+    st->theta= theta;
+    st->Y= Y;
+    st->fb= fb;
+    st->wst= wst;
+    st->seed= seed;
+    st->seedd= seedd;
+    return st;
+}
+
+void sampler_free (SamplerState *st){
+    for (int d=0; d<st->D; d++){
+        gsl_matrix_free(st->Y[d]);
+    }
+    features_free(st->fb);
+    for (int t=0; t<st->nthreads; t++){workspace_free(st->wst[t]);}
+    for (int d=0; d<st->D; d++){gsl_rng_free(st->seedd[d]);}
+    free(st->wst);
+    free(st->seedd);
+    gsl_rng_free(st->seed);
+    free(st->Y);
+    free(st);
+}
+
+void sampler_save_sizes (const SamplerState *st, int *nY, int *sumR, int *cap, int *nrng){
+    *nY= 0;
+    for (int d=0; d<st->D; d++){*nY+= st->Y[d]->size1;}
+    *sumR= st->fb->col[st->D];
+    *cap= st->fb->cap;
+    *nrng= gsl_rng_size(st->seed);
+}
+
+void sampler_save (const SamplerState *st, double *Y, double *P, double *lambda, int *nest, int *counters, unsigned char *rng){
+    FeatureBuffers *fb= st->fb;
+    int N= st->N, cap= fb->cap, sumR= fb->col[st->D];
+    for (int d=0; d<st->D; d++){
+        for (size_t r=0; r<st->Y[d]->size1; r++){
+            memcpy(Y, gsl_matrix_ptr(st->Y[d], r, 0), N*sizeof(double));
+            Y+= N;
+        }
+    }
+    for (int k=0; k<cap; k++){
+        memcpy(P+k*cap, gsl_matrix_ptr(fb->P, k, 0), cap*sizeof(double));
+        memcpy(lambda+k*sumR, gsl_matrix_ptr(fb->lambda, k, 0), sumR*sizeof(double));
+    }
+    memcpy(nest, fb->nest, cap*sizeof(int));
+    counters[0]= st->it;
+    counters[1]= st->status;
+    counters[2]= st->K;
+    counters[3]= cap;
+    counters[4]= fb->capped;
+    counters[5]= st->nsweep;
+    size_t nrng= gsl_rng_size(st->seed);
+    memcpy(rng, gsl_rng_state(st->seed), nrng);
+    for (int d=0; d<st->D; d++){
+        memcpy(rng+(1+d)*nrng, gsl_rng_state(st->seedd[d]), nrng);
+    }
+}
+
+void sampler_load (SamplerState *st, const double *Y, const double *P, const double *lambda, const int *nest, const int *counters, const unsigned char *rng){
+    FeatureBuffers *fb= st->fb;
+    int N= st->N, cap= counters[3], sumR= fb->col[st->D];
+    features_resize (fb, cap, st->Z, st->B, st->wst[0]);
+    for (int d=0; d<st->D; d++){
+        for (size_t r=0; r<st->Y[d]->size1; r++){
+            memcpy(gsl_matrix_ptr(st->Y[d], r, 0), Y, N*sizeof(double));
+            Y+= N;
+        }
+    }
+    for (int k=0; k<cap; k++){
+        memcpy(gsl_matrix_ptr(fb->P, k, 0), P+k*cap, cap*sizeof(double));
+        memcpy(gsl_matrix_ptr(fb->lambda, k, 0), lambda+k*sumR, sumR*sizeof(double));
+    }
+    memcpy(fb->nest, nest, cap*sizeof(int));
+    st->it= counters[0];
+    st->status= counters[1];
+    st->K= counters[2];
+    fb->capped= counters[4];
+    st->nsweep= counters[5];
+    size_t nrng= gsl_rng_size(st->seed);
+    memcpy(gsl_rng_state(st->seed), rng, nrng);
+    for (int d=0; d<st->D; d++){
+        memcpy(gsl_rng_state(st->seedd[d]), rng+(1+d)*nrng, nrng);
+    }
+}
+
+int sampler_step (SamplerState *st, int Nsim, SamplerControl *ctrl, SamplerTrace *trace){
+    int N= st->N, D= st->D, bias= st->bias, nthreads= st->nthreads;
+    double alpha= st->alpha, s2B= st->s2B, s2u= st->s2u, s2theta= st->s2theta;
+    ObsCache *obs= st->obs;
+    char *C= st->C;
+    int *R= st->R;
+    double *f= st->f, *mu= st->mu, *w= st->w, *s2Y= st->s2Y;
+    BitMatrix *Z= st->Z;
+    gsl_matrix **B= st->B;
+    gsl_vector **theta= st->theta;
+    gsl_matrix **Y= st->Y;
+    FeatureBuffers *fb= st->fb;
+    SamplerWorkspace **wst= st->wst, *ws= st->wst[0];
+    gsl_rng *seed= st->seed, **seedd= st->seedd;
+    int sumR= fb->col[D];
+    int Kest= st->K;
+    // a chain stopped by a numerical error stays where it is
+    if (st->status!=0){return Kest;}
+
     //....Body functions....//      
     for (int it=0; it<Nsim; it++){
+        // seconds spent in each phase, only measured with a trace
+        int rec= (trace!=NULL && trace->n<trace->cap);
+        double *tph= rec ? trace->phase+trace->n*TRACE_NPHASES : NULL;
+        double t0=0, t1=0;
+        if (rec){
+            for (int i=0; i<TRACE_NPHASES; i++){tph[i]=0;}
+            t0= trace_clock();
+        }
+        // optional periodic rebuild of P from Z, against the rounding
+        // accumulated by the rank-one updates of the sweeps; Pnon and
+        // lambdanon follow from P and lambda, and lambda is recomputed from
+        // Z at the end of every iteration
+        if (st->resync_every>0 && st->nsweep>=st->resync_every){
+            st->nsweep= 0;
+            bitmatrix_gram (Z, Kest, fb->P, 1/s2B);
+        }
 //         if (it==0){
-        double Kaux=AcceleratedGibbs (maxK,bias,N, D, Kest, C, R, alpha, s2B, s2Y, Y, Z, nest, P, Pnon, lambda, lambdanon);
-        if (Kaux==0){return Kest;}else{Kest= Kaux;}
+        double Kaux=AcceleratedGibbs (bias,N, D, Kest, C, R, alpha, s2B, s2Y, Y, Z, B, fb, seed, ws, rec ? &tph[TRACE_FEATURES] : NULL);
+        if (Kaux==0){
+            st->K= Kest;
+            st->status= 1;
+            return Kest;
+        }else{Kest= Kaux;}
 //         }
-        gsl_matrix_view P_view = gsl_matrix_submatrix (P, 0, 0, Kest, Kest);
-        gsl_matrix *S= gsl_matrix_calloc(Kest,Kest);
-        gsl_matrix_memcpy (S, &P_view.matrix);
-        inverse(S, Kest);
-        gsl_matrix *MuB = gsl_matrix_alloc(Kest,1);
+        if (rec){
+            t1= trace_clock();
+            tph[TRACE_ZSWEEP]= t1-t0-tph[TRACE_FEATURES];
+        }
+        //Sample Bs: one factorization of the posterior precision P and a
+        // single pair of triangular solves for all the columns of B
+        gsl_matrix_view P_view = gsl_matrix_submatrix (fb->P, 0, 0, Kest, Kest);
+        gsl_matrix_view L_view = gsl_matrix_submatrix (ws->L, 0, 0, Kest, Kest);
+        gsl_matrix_memcpy (&L_view.matrix, &P_view.matrix);
+        gsl_linalg_cholesky_decomp (&L_view.matrix);
+        // lambda already stacks the columns of all the dimensions
+        gsl_matrix_view LB_view = gsl_matrix_submatrix (ws->LB, 0, 0, Kest, sumR);
+        gsl_matrix_view lambda_view = gsl_matrix_submatrix (fb->lambda, 0, 0, Kest, sumR);
+        gsl_matrix_memcpy (&LB_view.matrix, &lambda_view.matrix);
+        mvnrnd_precision(&LB_view.matrix, &L_view.matrix, seed);
+        for (int d =0; d<D; d++){
+            int Rd= fb->col[d+1]-fb->col[d];
+            gsl_matrix_view Bd_view = gsl_matrix_submatrix (B[d], 0, 0, Kest, Rd);
+            gsl_matrix_view LBd_view = gsl_matrix_submatrix (ws->LB, 0, fb->col[d], Kest, Rd);
+            gsl_matrix_memcpy (&Bd_view.matrix, &LBd_view.matrix);
+            if (C[d]=='c'){
+                gsl_vector_view Bd_last =  gsl_matrix_subcolumn (B[d], R[d]-1, 0, Kest);
+                gsl_vector_set_zero (&Bd_last.vector);
+            }
+        }
+        if (rec){tph[TRACE_B]= trace_clock()-t1;}
         
+        int nerr=0;
+        #pragma omp parallel for num_threads(nthreads) schedule(dynamic)
         for (int d =0; d<D; d++){
-        //Sample Bs
-             if (C[d]=='c'){
-                 gsl_vector_view Bd_view;
-                 for (int r=0; r<R[d]-1; r++){
-                    gsl_matrix_view L_view= gsl_matrix_submatrix (lambda[d], 0, r, Kest, 1);
-                    matrix_multiply(S,&L_view.matrix,MuB,1,0,CblasNoTrans,CblasNoTrans);
-                    // gsl_vector_view gsl_matrix_subcolumn (gsl_matrix * m,
-                    // size_t j, size_t offset, size_t n)
-                    Bd_view =  gsl_matrix_subcolumn (B[d], r, 0, Kest);
-                    gsl_vector_view MuB_view =  gsl_matrix_column (MuB, 0);
-                    mvnrnd(&Bd_view.vector, S, &MuB_view.vector, Kest, seed);
-//                    if (isinf(compute_vector_mean(K, missing, &Bd_view.vector)) || isnan(compute_vector_mean(K, missing, &Bd_view.vector)) ){
-//                        printf("error: numerical error at sampling B in dimension %d \n",d);
-//                        break;
-//                    }
-
-                 }  
-                 Bd_view =  gsl_matrix_subcolumn (B[d], R[d]-1, 0, Kest);
-                 gsl_vector_set_zero (&Bd_view.vector);
-             }else{
-                gsl_matrix_view Lnon_view= gsl_matrix_submatrix (lambda[d], 0, 0, Kest, 1);
-                matrix_multiply(S,&Lnon_view.matrix,MuB,1,0,CblasNoTrans,CblasNoTrans);
-
-                gsl_vector_view Bd_view =  gsl_matrix_subcolumn (B[d], 0, 0, Kest);
-                gsl_vector_view MuB_view =  gsl_matrix_subcolumn (MuB, 0, 0, Kest);
-                mvnrnd(&Bd_view.vector, S, &MuB_view.vector, Kest, seed);  
-//                if (isinf(compute_vector_mean(K, missing, &Bd_view.vector)) || isnan(compute_vector_mean(K, missing, &Bd_view.vector)) ){
-//                    printf("error: numerical error at sampling B in dimension %d \n",d);
-//                    break;
-//                }
-             }
-
-
+         SamplerWorkspace *wsd= wst[THREAD_NUM];
+         double ta= rec ? trace_clock() : 0;
          //Sample Y  
-         SampleY (missing, N, d, Kest, C[d],  R[d], f[d], mu[d], w[d], s2Y[d], s2u, s2theta, X, Z, Y[d],  B[d], theta[d], seed);
+         if (SampleY (N, d, Kest, C[d],  R[d], f[d], mu[d], w[d], s2Y[d], s2u, s2theta, Z, Y[d],  B[d], theta[d], seedd[d], obs, wsd)){
+            #pragma omp atomic
+            nerr++;
+            continue;
+         }
+         double tb= rec ? trace_clock() : 0;
          if (C[d]!='c' && C[d]!='o'){
-             double aux=Samples2Y (missing, N, d, Kest, C[d],  R[d], f[d], mu[d], w[d], s2u, s2theta, X, Z, Y[d],  B[d], theta[d], seed);
+             double aux=Samples2Y (N, d, Kest, C[d],  R[d], f[d], mu[d], w[d], s2u, s2theta, Z, Y[d],  B[d], theta[d], seedd[d], obs, wsd);
              if (aux!=0 && !isinf(aux) && !isnan(aux) ){
                 s2Y[d]=aux;
              }else{ 
-                return Kest; 
+                #pragma omp atomic
+                nerr++;
+                continue;
                 //printf("ERROR: numerical error at the sampler. \nPlease consider applying a pre-processing transformation for attribute/dimension %d. \n",d);
              }
          }
+         double tc= rec ? trace_clock() : 0;
+         SampleYmissing (N, d, C[d], R[d], s2Y[d], Y[d], seedd[d], obs, wsd);
+         double td= rec ? trace_clock() : 0;
 
          //Update lambda
-         matrix_multiply(Z,Y[d],lambda[d],1,0,CblasNoTrans,CblasTrans);     
+         features_lambda (fb, d, Z, Kest, Y[d]);
+         if (rec){
+             double te= trace_clock();
+             #pragma omp atomic
+             tph[TRACE_Y]+= (tb-ta)+(td-tc);
+             #pragma omp atomic
+             tph[TRACE_S2Y]+= tc-tb;
+             #pragma omp atomic
+             tph[TRACE_LAMBDA]+= te-td;
+         }
 
         }
-        gsl_matrix_free(S);
+        if (nerr>0){
+            st->K= Kest;
+            st->status= 1;
+            return Kest;
+        }
+        st->it++;
+        st->nsweep++;
+        if (rec){
+            int i= trace->n++;
+            trace->time[i]= trace_clock()-t0;
+            trace->K[i]= Kest;
+            memcpy(trace->s2Y+i*D, s2Y, D*sizeof(double));
+        }
+        if (ctrl!=NULL){
+            int stop= ctrl->cancel;
+            control_store(ctrl, st->it, stop || it==Nsim-1, Kest, Z, B, s2Y, C, R);
+            if (stop){break;}
+        }
+        // give back the capacity left by removed features
+        if (fb->cap>16 && 4*(Kest+2)<=fb->cap){
+            int cap= 2*(Kest+2);
+            if (cap<16){cap=16;}
+            features_resize (fb, cap, Z, B, ws);
+        }
         //printf("\n");
         }
-        printf("After IT loop...\n");
+    st->K= Kest;
+    return Kest;
+}
 
-    for (int d=0; d<D; d++){
-        gsl_matrix_free(Y[d]);
-        gsl_matrix_free(lambda[d]);
-        gsl_matrix_free(lambdanon[d]);
-        //gsl_vector_free(theta[d]);
-    }
-    gsl_matrix_free(P);
-    gsl_matrix_free(Pnon);
-    free(lambda);
-    free(lambdanon);
-    free(Y);
+int IBPsampler_obs_func (ObsCache *obs, char *C, BitMatrix *Z, gsl_matrix **B, gsl_vector **theta, int *R, double *f, double *mu,  double *w, int maxR, int bias, int N, int D, int K, double alpha, double s2B, double *s2Y, double s2u,int maxK,int Nsim, int nthreads, unsigned long rngseed, SamplerControl *ctrl){
+    SamplerState *st= sampler_alloc(obs, C, Z, B, theta, R, f, mu, w, maxR, bias, N, D, K, alpha, s2B, s2Y, s2u, maxK, nthreads, rngseed);
+    int Kest= sampler_step(st, Nsim, ctrl, NULL);
+    sampler_free(st);
     return Kest;
 }
 
-int initialize_func (int N, int D, int maxK, double missing, gsl_matrix *X, char *C, gsl_matrix **B, gsl_vector **theta, int *R, double *f, double *mu,  double *w, double *s2Y){
+int initialize_obs_func (int N, int D, const ObsCache *obs, char *C, gsl_matrix **B, gsl_vector **theta, int *R, double *f, double *mu,  double *w, double *s2Y){
 
     int maxR=1;
     double  maxX[D], minX[D], meanX[D],varX[D];
-    gsl_vector_view Xd_view;
     for (int d=0; d<D; d++){
-         Xd_view = gsl_matrix_row(X, d);
-         maxX[d] = compute_vector_max(N,missing, &Xd_view.vector);//gsl_vector_max(&Xd_view.vector);
-         minX[d] = compute_vector_min(N,missing, &Xd_view.vector);;//gsl_vector_min(&Xd_view.vector);
-         meanX[d] = compute_vector_mean(N,missing, &Xd_view.vector);
-         varX[d] = compute_vector_var(N,missing, &Xd_view.vector);
+         // statistics of the observed cells of dimension d
+         int jbeg= obs->ptr[d];
+         int jend= obs->ptr[d+1];
+         double sumX=0;
+         maxX[d]=-1e100;
+         minX[d]=1e100;
+         for (int j=jbeg; j<jend; j++){
+             double xnd= obs->x[j];
+             sumX+= xnd;
+             if (xnd>maxX[d]){maxX[d]=xnd;}
+             if (xnd<minX[d]){minX[d]=xnd;}
+         }
+         if (jend==jbeg){
+             // no observed cell: zero mean and variance (w=1), and two
+             // categories for categorical and ordinal data
+             maxX[d]= (C[d]=='c' || C[d]=='o') ? 2 : 0;
+             minX[d]= 0;
+             meanX[d]= 0;
+             varX[d]= 0;
+         }else{
+             meanX[d] = sumX/(jend-jbeg);
+             sumX=0;
+             for (int j=jbeg; j<jend; j++){
+                 sumX+= pow(obs->x[j]-meanX[d],2);
+             }
+             varX[d] = sumX/(jend-jbeg);
+         }
          mu[d]=1;
          R[d]=1;
          w[d]=1;
           switch(C[d]){
             case 'g':   
                 s2Y[d]=2;
-                B[d] = gsl_matrix_calloc(maxK,1);
+                B[d] = gsl_matrix_calloc(1,1);
                 mu[d]= meanX[d];
                 //w[d]=4/(maxX[d]-mu[d]);
                 if (varX[d]>0){w[d]=1/sqrt(varX[d]);}
@@ -667,7 +1330,7 @@ int initialize_func (int N, int D, int maxK, double missing, gsl_matrix *X, char
                 break;
             case 'p':
                 s2Y[d]=2;
-                B[d] = gsl_matrix_calloc(maxK,1);
+                B[d] = gsl_matrix_calloc(1,1);
                 mu[d]= minX[d]-1e-6;
 //                 w[d]=4/(maxX[d]-mu[d]);
                 if (varX[d]>0){w[d]=1/sqrt(varX[d]);}
@@ -675,7 +1338,7 @@ int initialize_func (int N, int D, int maxK, double missing, gsl_matrix *X, char
                 break;
             case 'n':
                 s2Y[d]=2;
-                B[d] = gsl_matrix_calloc(maxK,1);
+                B[d] = gsl_matrix_calloc(1,1);
                 mu[d]= minX[d]-1;
                 //w[d]=1;
                 //w[d]=4/(maxX[d]-mu[d]);
@@ -685,13 +1348,13 @@ int initialize_func (int N, int D, int maxK, double missing, gsl_matrix *X, char
             case 'c':
                 s2Y[d]=1;
                 R[d]=(int)maxX[d];
-                B[d] = gsl_matrix_calloc(maxK,R[d]);
+                B[d] = gsl_matrix_calloc(1,R[d]);
                 if (R[d]>maxR){maxR=R[d];}
                 break;
             case 'o':
                 s2Y[d]=1;
                 R[d]=(int)maxX[d];
-                B[d] = gsl_matrix_calloc(maxK,1);
+                B[d] = gsl_matrix_calloc(1,1);
                 theta[d] = gsl_vector_alloc(R[d]);
                 if (R[d]>maxR){maxR=R[d];}
                 break;
@@ -706,4 +1369,21 @@ int initialize_func (int N, int D, int maxK, double missing, gsl_matrix *X, char
     return maxR;
 }
 
+int IBPsampler_func (double missing, gsl_matrix *X, char *C, gsl_matrix *Z, gsl_matrix **B, gsl_vector **theta, int *R, double *f, double *mu,  double *w, int maxR, int bias, int N, int D, int K, double alpha, double s2B, double *s2Y, double s2u,int maxK,int Nsim, unsigned long rngseed){
+    // Dense entry point: cells of X equal to missing (or nan) are unobserved
+    ObsCache *obs= obscache_alloc(missing, X, N, D);
+    BitMatrix *Zb= bitmatrix_alloc(N, K);
+    bitmatrix_from_dense(Zb, Z, K);
+    int Kest= IBPsampler_obs_func (obs, C, Zb, B, theta, R, f, mu, w, maxR, bias, N, D, K, alpha, s2B, s2Y, s2u, maxK, Nsim, 1, rngseed, NULL);
+    bitmatrix_to_dense(Zb, Z, Kest);
+    bitmatrix_free(Zb);
+    obscache_free(obs);
+    return Kest;
+}
 
+int initialize_func (int N, int D, double missing, gsl_matrix *X, char *C, gsl_matrix **B, gsl_vector **theta, int *R, double *f, double *mu,  double *w, double *s2Y){
+    ObsCache *obs= obscache_alloc(missing, X, N, D);
+    int maxR= initialize_obs_func (N, D, obs, C, B, theta, R, f, mu, w, s2Y);
+    obscache_free(obs);
+    return maxR;
+}
@@ -1,8 +1,170 @@
+#ifndef INFERENCEFUNCTIONS_H
+#define INFERENCEFUNCTIONS_H
+#include <stdint.h>
+#include <atomic>
+#include <mutex>
 //#include "InferenceFunctions.h"
 //#include "GeneralFunctions.cpp"
 
-int AcceleratedGibbs (int maxK,int bias, int N, int D, int K, char *C,  int *R, double alpha, double s2B, double s2Y, gsl_matrix **Y, gsl_matrix *Z, int *nest, gsl_matrix *P, gsl_matrix *Pnon, gsl_matrix **lambda, gsl_matrix **lambdanon);
-void SampleY (double missing, int N, int D, int K, char Cd,  int Rd, double fd, double mud, double wd, double s2Y,double s2u, double s2theta, gsl_matrix *X, gsl_matrix *Z, gsl_matrix *Yd,  gsl_matrix *Bd, gsl_vector *thetad, const gsl_rng *seed);
-double Samples2Y (double missing, int N, int d, int K, char Cd,  int Rd, double fd, double mud, double wd, double s2u, double s2theta, gsl_matrix *X, gsl_matrix *Z, gsl_matrix *Yd,  gsl_matrix *Bd, gsl_vector *thetad, const gsl_rng *seed);
-int IBPsampler_func (double missing, gsl_matrix *X, char *C, gsl_matrix *Z, gsl_matrix **B, gsl_vector **theta, int *R, double *f, double *mu,  double *w, int maxR, int bias, int N, int D, int K, double alpha, double s2B, double *s2Y,double s2u, int maxK,int Nsim);
-int initialize_func (int N, int D, int maxK, double missing, gsl_matrix *X, char *C, gsl_matrix **B, gsl_vector **theta, int *R, double *f, double *mu,  double *w, double *s2Y);
\ No newline at end of file
+// Buffers shared by the sampling kernels, allocated once per run
+typedef struct {
+    gsl_matrix *Snon;   // cap x cap, inverse of P (Pnon while row n is out)
+    gsl_vector *Sz;     // cap, Snon*Zn
+    gsl_matrix *aux;    // 1 x cap, Zn'*Snon
+    gsl_vector *muy;    // sumR, predicted pseudo-observations of observation n
+    gsl_vector *yn;     // sumR, pseudo-observations of observation n
+    gsl_matrix *L;      // cap x cap, Cholesky factor of P
+    gsl_matrix *LB;     // cap x sumR, stacked lambda / samples of B
+    gsl_vector *Ymax;   // maxR, ordinal bookkeeping
+    gsl_vector *Ymin;   // maxR
+    gsl_matrix *ZB;     // maxR x N, Bd'*Z for all observations of a dimension
+    gsl_matrix *zn;     // cap x 1, column n of Z while it is being sampled
+    gsl_matrix *TN;     // 3 x N, means and bounds of the batched truncated normal draws
+} SamplerWorkspace;
+
+// Binary matrix Z (cap x N) packed by observation: the column z_n is kept
+// in nw= ceil(cap/64) words, feature k being bit k%64 of word k/64. Bits of
+// features k>=K are always zero.
+typedef struct {
+    int N;
+    int cap;            // number of features that fit, resized by bitmatrix_resize
+    int nw;
+    uint64_t *bits;     // N x nw
+} BitMatrix;
+
+// Buffers of the sampler whose size follows the number of features K. They
+// hold cap>=K+2 features, so that the new features proposed for an
+// observation fit, and are regrown or shrunk by features_resize as K
+// changes; maxK only bounds K.
+typedef struct {
+    int cap;
+    int maxK;
+    int D;
+    int capped;                 // 1 once the proposals have been stopped by maxK
+    gsl_matrix *P;              // cap x cap, Z*Z'+I/s2B
+    gsl_matrix *Pnon;           // cap x cap, P without observation n
+    int *col;                   // D+1, dimension d has columns col[d]..col[d+1]-1
+    gsl_matrix *lambda;         // cap x sumR, Z*Yd' of every d (rows Yd used: Rd-1 if 'c', else 1)
+    gsl_matrix *lambdanon;      // cap x sumR, lambda without observation n
+    int *nest;                  // cap, number of observations with each feature
+} FeatureBuffers;
+
+// Observed cells of X, stored by dimension (CSR over the D x N matrix X)
+// together with their values in the pseudo-observation space. The sampler
+// only ever visits these cells; missing ones are never stored.
+typedef struct {
+    int *ptr;       // D+1, observed cells of dimension d are ptr[d]..ptr[d+1]-1
+    int *idx;       // nnz, observation n of each observed cell (increasing)
+    double *x;      // nnz, observed value xnd
+    double *ylo;    // nnz, f^-1(xnd) ('g','p','n')
+    double *yhi;    // nnz, f^-1(xnd+1) ('n'), +inf otherwise
+} ObsCache;
+
+// Link between a running sampler and another thread: the sampler publishes a
+// copy of K, Z, B and s2Y every 'every' iterations and stops after the current
+// iteration once 'cancel' is set. Readers only go through control_snapshot.
+typedef struct {
+    std::atomic<int> cancel;    // set by control_cancel
+    std::atomic<int> it;        // iterations completed so far
+    int every;                  // snapshot period (0: only the last iteration)
+    int N, D, maxR;
+    std::mutex lock;            // guards the snapshot below
+    int K;                      // number of features, -1 before the first snapshot
+    int snapit;                 // iteration the snapshot was taken at
+    BitMatrix *Z;               // K x N
+    double *B;                  // D x K x maxR
+    double *s2Y;                // D
+} SamplerControl;
+
+// Telemetry of sampler_step, recorded only when a SamplerTrace is passed to
+// it. Row i of every buffer describes the i-th iteration recorded; phases
+// run in parallel over dimensions (Y, s2Y, lambda) are summed over threads.
+enum {TRACE_ZSWEEP, TRACE_FEATURES, TRACE_B, TRACE_Y, TRACE_S2Y, TRACE_LAMBDA, TRACE_NPHASES};
+typedef struct {
+    int cap;                    // iterations that fit in the buffers
+    int n;                      // iterations recorded so far
+    double *phase;              // cap x TRACE_NPHASES, seconds spent in each phase
+    double *time;               // cap, wall-clock seconds of the whole iteration
+    int *K;                     // cap, number of features after the iteration
+    double *s2Y;                // cap x D
+} SamplerTrace;
+
+// Sampler kept alive between calls of sampler_step, which carries the chain
+// on from where the previous call stopped: pseudo-observations Y, s2Y, the
+// feature buffers and the random streams are never reset. Z, B, theta, R,
+// f, mu, w, s2Y and obs belong to the caller and must outlive the state.
+typedef struct {
+    int N, D, maxR, bias, nthreads;
+    double alpha, s2B, s2u, s2theta;
+    int K;                      // current number of features
+    int it;                     // iterations run so far
+    int status;                 // 1 once stopped by a numerical error
+    int resync_every;           // sweeps between two rebuilds of P from Z (0: never)
+    int nsweep;                 // sweeps since the last rebuild
+    ObsCache *obs;
+    char *C;
+    int *R;
+    double *f, *mu, *w, *s2Y;
+    BitMatrix *Z;
+    gsl_matrix **B;
+    gsl_vector **theta;
+    gsl_matrix **Y;             // D, pseudo-observations (Rd x N)
+    FeatureBuffers *fb;
+    SamplerWorkspace **wst;     // nthreads, wst[0] holds the feature-sized buffers
+    gsl_rng *seed;              // stream of the serial steps
+    gsl_rng **seedd;            // D, stream of each dimension
+} SamplerState;
+
+SamplerControl *control_alloc (int N, int D, int maxR, int every);
+void control_free (SamplerControl *ctrl);
+void control_cancel (SamplerControl *ctrl);
+int control_iteration (SamplerControl *ctrl);
+int control_snapshot (SamplerControl *ctrl, double *Z, double *B, double *s2Y, int *it, int Kmax);
+BitMatrix *bitmatrix_alloc (int N, int cap);
+void bitmatrix_free (BitMatrix *Z);
+void bitmatrix_resize (BitMatrix *Z, int cap);
+void bitmatrix_from_dense (BitMatrix *Zb, gsl_matrix *Z, int K);
+void bitmatrix_to_dense (const BitMatrix *Zb, gsl_matrix *Z, int K);
+void bitmatrix_from_bytes (BitMatrix *Zb, const unsigned char *Z, int K);
+void bitmatrix_to_rows (const BitMatrix *Zb, double *Z, int K);
+void bitmatrix_to_packbits (const BitMatrix *Zb, unsigned char *Z, int K);
+void bitmatrix_unpack_column (const BitMatrix *Z, int n, double *zn);
+void bitmatrix_pack_column (BitMatrix *Z, int n, const double *zn, int K);
+void bitmatrix_counts (const BitMatrix *Z, int K, int *nest);
+void bitmatrix_gram (const BitMatrix *Z, int K, gsl_matrix *P, double a);
+void bitmatrix_mult (const BitMatrix *Z, int K, gsl_matrix *Yd, gsl_matrix *lambdad);
+void bitmatrix_tmult (const BitMatrix *Z, int K, gsl_matrix *Bd, gsl_matrix *M);
+void bitmatrix_move (BitMatrix *Z, int from, int to);
+SamplerWorkspace *workspace_alloc (int N, int cap, int maxR, int sumR);
+void workspace_free (SamplerWorkspace *ws);
+int features_capacity (int K, int maxK);
+FeatureBuffers *features_alloc (int cap, int maxK, int D, char *C, int *R);
+void features_free (FeatureBuffers *fb);
+void features_lambda (FeatureBuffers *fb, int d, const BitMatrix *Z, int K, gsl_matrix *Yd);
+void features_resize (FeatureBuffers *fb, int cap, BitMatrix *Z, gsl_matrix **B, SamplerWorkspace *ws);
+void features_remove (FeatureBuffers *fb, int K, int k, BitMatrix *Z, SamplerWorkspace *ws);
+ObsCache *obscache_alloc (double missing, gsl_matrix *X, int N, int D);
+ObsCache *obscache_alloc_csr (const int *ptr, const int *idx, const double *x, int D);
+void obscache_transform (ObsCache *obs, char *C, double *f, double *mu, double *w, int D);
+void obscache_free (ObsCache *obs);
+int AcceleratedGibbs (int bias, int N, int D, int K, char *C,  int *R, double alpha, double s2B, double *s2Y, gsl_matrix **Y, BitMatrix *Z, gsl_matrix **B, FeatureBuffers *fb, const gsl_rng *seed, SamplerWorkspace *ws, double *tfeatures);
+int SampleY (int N, int d, int K, char Cd,  int Rd, double fd, double mud, double wd, double s2Y, double s2u, double s2theta, BitMatrix *Z, gsl_matrix *Yd,  gsl_matrix *Bd, gsl_vector *thetad, const gsl_rng *seed, const ObsCache *obs, SamplerWorkspace *ws);
+double Samples2Y (int N, int d, int K, char Cd,  int Rd, double fd, double mud, double wd, double s2u, double s2theta, BitMatrix *Z, gsl_matrix *Yd,  gsl_matrix *Bd, gsl_vector *thetad, const gsl_rng *seed, const ObsCache *obs, SamplerWorkspace *ws);
+void SampleYmissing (int N, int d, char Cd,  int Rd, double s2Y, gsl_matrix *Yd, const gsl_rng *seed, const ObsCache *obs, SamplerWorkspace *ws);
+int IBPsampler_func (double missing, gsl_matrix *X, char *C, gsl_matrix *Z, gsl_matrix **B, gsl_vector **theta, int *R, double *f, double *mu,  double *w, int maxR, int bias, int N, int D, int K, double alpha, double s2B, double *s2Y,double s2u, int maxK,int Nsim, unsigned long rngseed);
+SamplerState *sampler_alloc (ObsCache *obs, char *C, BitMatrix *Z, gsl_matrix **B, gsl_vector **theta, int *R, double *f, double *mu,  double *w, int maxR, int bias, int N, int D, int K, double alpha, double s2B, double *s2Y, double s2u, int maxK, int nthreads, unsigned long rngseed);
+int sampler_step (SamplerState *st, int Nsim, SamplerControl *ctrl, SamplerTrace *trace);
+// Checkpoints: sampler_save copies the part of the state that sampler_alloc
+// does not rebuild from the data, Z, B, theta and s2Y, i.e. Y (nY x N, the
+// Yd stacked), P (cap x cap), lambda (cap x sumR), nest (cap), the counters
+// {it, status, K, cap, capped, nsweep} and the D+1 random streams (nrng bytes
+// each), with the sizes given by sampler_save_sizes. sampler_load puts it
+// back into a sampler allocated on the same data, Z, B, theta and s2Y.
+void sampler_save_sizes (const SamplerState *st, int *nY, int *sumR, int *cap, int *nrng);
+void sampler_save (const SamplerState *st, double *Y, double *P, double *lambda, int *nest, int *counters, unsigned char *rng);
+void sampler_load (SamplerState *st, const double *Y, const double *P, const double *lambda, const int *nest, const int *counters, const unsigned char *rng);
+void sampler_free (SamplerState *st);
+int IBPsampler_obs_func (ObsCache *obs, char *C, BitMatrix *Z, gsl_matrix **B, gsl_vector **theta, int *R, double *f, double *mu,  double *w, int maxR, int bias, int N, int D, int K, double alpha, double s2B, double *s2Y,double s2u, int maxK,int Nsim, int nthreads, unsigned long rngseed, SamplerControl *ctrl);
+int initialize_obs_func (int N, int D, const ObsCache *obs, char *C, gsl_matrix **B, gsl_vector **theta, int *R, double *f, double *mu,  double *w, double *s2Y);
+int initialize_func (int N, int D, double missing, gsl_matrix *X, char *C, gsl_matrix **B, gsl_vector **theta, int *R, double *f, double *mu,  double *w, double *s2Y);
+#endif
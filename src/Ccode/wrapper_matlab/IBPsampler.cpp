@@ -17,6 +17,7 @@
 #define input_Nsim prhs[8]
 #define input_maxK prhs[9]
 #define input_missing prhs[10]
+#define input_seed prhs[11]
 
 //*********************************OUTPUTS**************************//
 #define output_Z plhs[0]
@@ -31,7 +32,7 @@ void mexFunction( int nlhs, mxArray* plhs[], int nrhs, const mxArray* prhs[] ) {
     //..................CHECKING INPUTS AND OUTPUTS.............//
     /* Matrices are arranged per column */
 
-    if (nrhs!=11) {
+    if (nrhs!=12) {
         mexErrMsgTxt("Invalid number of arguments\n");
     }
 
@@ -69,15 +70,12 @@ void mexFunction( int nlhs, mxArray* plhs[], int nrhs, const mxArray* prhs[] ) {
     int maxK = mxGetScalar(input_maxK);
     int Nsim = mxGetScalar(input_Nsim);
     double missing = mxGetScalar(input_missing);
+    unsigned long seed = mxGetScalar(input_seed);
 
+    // Z is kept bit-packed by the sampler, which grows it as K does
     gsl_matrix_view Zview = gsl_matrix_view_array(Z_dou, K,N);
-    gsl_matrix *Zm = &Zview.matrix;
-    gsl_matrix *Z= gsl_matrix_calloc(maxK,N);
-    for (int i=0;i<N;i++){
-        for (int k=0; k<K; k++){
-        gsl_matrix_set (Z, k, i,gsl_matrix_get (Zm, k, i));
-        }
-    }
+    BitMatrix *Z= bitmatrix_alloc(N, (K>0) ? K : 1);
+    bitmatrix_from_dense(Z, &Zview.matrix, K);
     double  f[D];
     for (int d=0; d<D; d++){
       C[d] = tolower(C[d]);//convert to lower case
@@ -94,20 +92,18 @@ void mexFunction( int nlhs, mxArray* plhs[], int nrhs, const mxArray* prhs[] ) {
     gsl_vector **theta=(gsl_vector **) calloc(D,sizeof(gsl_vector*));
     double w[D],mu[D],s2Y[D];
     int R[D];
-    printf("In C++: Transforming input data... ");
-    int maxR=initialize_func (N,  D,  maxK, missing,  X, C, B, theta, R, f, mu,  w, s2Y);
-    printf("done\n");
+    int maxR=initialize_func (N,  D, missing,  X, C, B, theta, R, f, mu,  w, s2Y);
     //int maxR = 1;
     //for (int d=0; d<D; d++){
     //  w[d] = 1;
     //  mu[d]= 0;
     //  R[d] = 1;
     // }
-    printf("maxR=%d\n", maxR);
 
   //...............Inference Function.......................//
-    printf("In C++: Running Inference Routine... ");
-   int Kest = IBPsampler_func (missing, X, C, Z, B, theta, R, f, mu, w, maxR, bias, N, D, K, alpha, s2B, s2Y, s2u, maxK, Nsim);
+   ObsCache *obs= obscache_alloc(missing, X, N, D);
+   int Kest = IBPsampler_obs_func (obs, C, Z, B, theta, R, f, mu, w, maxR, bias, N, D, K, alpha, s2B, s2Y, s2u, maxK, Nsim, 1, seed, NULL);
+   obscache_free(obs);
 
    //...............SET OUTPUT POINTERS.......................//
     output_Z = mxCreateDoubleMatrix(Kest,N,mxREAL);
@@ -123,13 +119,7 @@ void mexFunction( int nlhs, mxArray* plhs[], int nrhs, const mxArray* prhs[] ) {
     output_Theta = mxCreateDoubleMatrix(D, maxR,mxREAL);
     double *pT=mxGetPr(output_Theta);
 
-    Zview = gsl_matrix_submatrix (Z, 0, 0, Kest, N);    
-    for (int i=0;i<N;i++){
-        for (int k=0; k<Kest; k++){
-            pZ[Kest*i+k]=(&Zview.matrix)->data[k*N+i];
-            //pgu[i]=xPLS[i];
-        }
-    }
+    bitmatrix_to_rows(Z, pZ, Kest);
 
     int idx_tmp;
     for (int d=0; d<D; d++){
@@ -179,7 +169,7 @@ void mexFunction( int nlhs, mxArray* plhs[], int nrhs, const mxArray* prhs[] ) {
             gsl_vector_free(theta[d]);
         }
     }
-    gsl_matrix_free(Z);
+    bitmatrix_free(Z);
     free(B);
     free(theta);
 
@@ -5,17 +5,65 @@ from cymem.cymem cimport Pool
 # import both numpy and the Cython declarations for numpy
 import numpy as np
 cimport numpy as np
+import threading
+import time
+import warnings
 
 # declare the interface to the C code
 #cdef extern void c_multiply (double* array, double value, int m, int n)
 cdef extern from "stdio.h":
     int tolower(int c)
 
+cdef extern from "../core/GeneralFunctions.h":
+    unsigned long rng_split_seed (unsigned long seed, unsigned long stream)
+
+cdef extern from "../core/InferenceFunctions.h":
+    ctypedef struct ObsCache:
+        pass
+    ObsCache *obscache_alloc (double missing, gsl_matrix *X, int N, int D)
+    ObsCache *obscache_alloc_csr (int *ptr, int *idx, double *x, int D)
+    void obscache_free (ObsCache *obs)
+    ctypedef struct BitMatrix:
+        pass
+    BitMatrix *bitmatrix_alloc (int N, int cap)
+    void bitmatrix_free (BitMatrix *Z)
+    void bitmatrix_from_bytes (BitMatrix *Zb, unsigned char *Z, int K)
+    void bitmatrix_to_rows (BitMatrix *Zb, double *Z, int K)
+    void bitmatrix_to_packbits (BitMatrix *Zb, unsigned char *Z, int K)
+    ctypedef struct SamplerControl:
+        int N, D, maxR
+    SamplerControl *control_alloc (int N, int D, int maxR, int every)
+    void control_free (SamplerControl *ctrl)
+    void control_cancel (SamplerControl *ctrl)
+    int control_iteration (SamplerControl *ctrl)
+    int control_snapshot (SamplerControl *ctrl, double *Z, double *B, double *s2Y, int *it, int Kmax) nogil
+    # Same as initialize_func/IBPsampler_func, reading X from its observed cells
+    int initialize_obs_func (int N, int D, ObsCache *obs, char *C, gsl_matrix **B, gsl_vector **theta, int *R, double *f, double *mu,  double *w, double *s2Y)
+    ctypedef struct FeatureBuffers:
+        int maxK, capped
+    ctypedef struct SamplerState:
+        int K, it, status, resync_every
+        FeatureBuffers *fb
+    ctypedef struct SamplerTrace:
+        int cap, n
+        double *phase
+        double *time
+        int *K
+        double *s2Y
+    enum: TRACE_NPHASES
+    SamplerState *sampler_alloc (ObsCache *obs, char *C, BitMatrix *Z, gsl_matrix **B, gsl_vector **theta, int *R, double *f, double *mu, double *w, int maxR, int bias, int N, int D, int K, double alpha, double s2B, double *s2Y, double s2u, int maxK, int nthreads, unsigned long rngseed)
+    int sampler_step (SamplerState *st, int Nsim, SamplerControl *ctrl, SamplerTrace *trace) nogil
+    void sampler_free (SamplerState *st)
+    void sampler_save_sizes (SamplerState *st, int *nY, int *sumR, int *cap, int *nrng)
+    void sampler_save (SamplerState *st, double *Y, double *P, double *lam, int *nest, int *counters, unsigned char *rng)
+    void sampler_load (SamplerState *st, double *Y, double *P, double *lam, int *nest, int *counters, unsigned char *rng)
+    int IBPsampler_obs_func (ObsCache *obs, char *C, BitMatrix *Z, gsl_matrix **B, gsl_vector **theta, int *R, double *f, double *mu, double *w, int maxR, int bias, int N, int D, int K, double alpha, double s2B, double *s2Y, double s2u, int maxK,int Nsim, int nthreads, unsigned long rngseed, SamplerControl *ctrl) nogil
+
 cdef extern from "../core/InferenceFunctions.h":
-    int initialize_func (int N, int D, int maxK, double missing, gsl_matrix *X, char *C, gsl_matrix **B, gsl_vector **theta, int *R, double *f, double *mu,  double *w, double *s2Y)
+    int initialize_func (int N, int D, double missing, gsl_matrix *X, char *C, gsl_matrix **B, gsl_vector **theta, int *R, double *f, double *mu,  double *w, double *s2Y)
 
 cdef extern from "../core/InferenceFunctions.h":
-    int IBPsampler_func (double missing, gsl_matrix *X, char *C, gsl_matrix *Z, gsl_matrix **B, gsl_vector **theta, int *R, double *f, double *mu, double *w, int maxR, int bias, int N, int D, int K, double alpha, double s2B, double *s2Y, double s2u, int maxK,int Nsim)
+    int IBPsampler_func (double missing, gsl_matrix *X, char *C, gsl_matrix *Z, gsl_matrix **B, gsl_vector **theta, int *R, double *f, double *mu, double *w, int maxR, int bias, int N, int D, int K, double alpha, double s2B, double *s2Y, double s2u, int maxK,int Nsim, unsigned long rngseed)
     # This is the C++ function to perform inference for the GLFM model
     # Inputs:
     #           missing: value of missings, cannot be nan, should be an integer
@@ -35,24 +83,520 @@ cdef extern from "../core/InferenceFunctions.h":
     #           s2B: variance for feature values
     #           s2Y: variance for pseudo-observations
     #           s2u: auxiliary noise # TODO: Better explain
-    #           maxK: maximum number of latent features (to allocate memory)
+    #           maxK: maximum number of latent features (memory grows with K)
     #           Nsim: number of iterations (inside C++ code)
+    #           rngseed: seed of the random streams of the sampler
     # Outputs:
     #           Kest: number of inferred active features
 
-@cython.boundscheck(False)
-@cython.wraparound(False)
-def infer(np.ndarray[double, ndim=2, mode="c"] Xin not None,\
-        Cin not None, np.ndarray[double, ndim=2, mode="c"] Zin not None,\
+# phases timed by the trace of the sampler, in the order of SamplerTrace
+TRACE_PHASES = ('Z', 'features', 'B', 'Y', 's2Y', 'lambda')
+
+def split_seed(unsigned long seed, unsigned long stream):
+    """
+    Seed of the independent substream 'stream' of seed 'seed' (e.g. one for
+    each chain of a multi-chain run)
+    """
+    return rng_split_seed(seed, stream)
+
+cdef class InferenceHandle:
+    """
+    Handle of an inference routine running in a background thread, returned
+    by infer_async. The sampler runs without the GIL; this object can be
+    polled for snapshots of its state and asked to stop.
+    """
+    cdef SamplerControl* ctrl
+    cdef int every, Kmax
+    cdef bint stop
+    cdef object thread, output, error
+
+    def __cinit__(self, int every):
+        self.ctrl = NULL
+        self.every = every
+        self.Kmax = 1
+        self.stop = False
+        self.thread = None
+        self.output = None
+        self.error = None
+
+    def __dealloc__(self):
+        if self.ctrl != NULL:
+            control_free(self.ctrl)
+
+    cdef attach(self, int N, int D, int K, int maxR):
+        # called by the worker before entering the sampler
+        self.ctrl = control_alloc(N, D, maxR, self.every)
+        self.Kmax = max(K, 1)
+        if self.stop:
+            control_cancel(self.ctrl)
+
+    def _run(self, args, kwargs):
+        try:
+            self.output = infer(*args, handle=self, **kwargs)
+        except Exception as e:
+            self.error = e
+
+    def cancel(self):
+        """
+        Ask the sampler to stop after its current iteration; result() then
+        returns the state reached so far
+        """
+        self.stop = True
+        if self.ctrl != NULL:
+            control_cancel(self.ctrl)
+
+    def cancelled(self):
+        return self.stop
+
+    def done(self):
+        return self.thread is not None and not self.thread.is_alive()
+
+    def iteration(self):
+        """
+        Number of iterations completed so far
+        """
+        if self.ctrl == NULL:
+            return 0
+        return control_iteration(self.ctrl)
+
+    def snapshot(self):
+        """
+        Copy of the state published by the sampler every 'snapshot_every'
+        iterations (and at the last one), as a dict with keys 'it', 'K',
+        'Z' [N*K], 'B' [D*K*maxR] and 's2Y' [D]; None until the first one
+        """
+        if self.ctrl == NULL:
+            return None
+        cdef int K, it
+        cdef np.ndarray[double, ndim=2, mode="c"] Z
+        cdef np.ndarray[double, ndim=3, mode="c"] B
+        cdef np.ndarray[double, ndim=1, mode="c"] s2Y = np.empty(self.ctrl.D)
+        cdef double* Zp
+        cdef double* Bp
+        cdef double* s2Yp = &s2Y[0]
+        while True:
+            # buffers for Kmax features, grown when the sampler has more
+            Z = np.empty((self.ctrl.N, self.Kmax))
+            B = np.empty((self.ctrl.D, self.Kmax, self.ctrl.maxR))
+            Zp = &Z[0,0]
+            Bp = &B[0,0,0]
+            with nogil:
+                K = control_snapshot(self.ctrl, Zp, Bp, s2Yp, &it, self.Kmax)
+            if K <= self.Kmax:
+                break
+            self.Kmax = 2*K
+        if K < 0:
+            return None
+        return {'it': it, 'K': K, 'Z': Z.ravel()[:K*self.ctrl.N].reshape(-1,K),\
+                'B': B.ravel()[:B.shape[0]*K*self.ctrl.maxR].reshape(-1,K,self.ctrl.maxR),\
+                's2Y': s2Y}
+
+    def result(self, timeout=None):
+        """
+        Wait for the sampler to finish and return the outputs of infer
+        """
+        self.thread.join(timeout)
+        if self.thread.is_alive():
+            raise RuntimeError('inference still running after %s s' % timeout)
+        if self.error is not None:
+            raise self.error
+        return self.output
+
+def infer_async(*args, **kwargs):
+    """
+    Same as infer, but returns at once: the sampler runs in a background
+    thread with the GIL released. Takes the arguments of infer plus
+        snapshot_every: period (in iterations) of the snapshots of K, Z, B
+                        and s2Y made available through the handle
+    Output:
+        InferenceHandle with methods result(), done(), cancel(),
+        iteration() and snapshot()
+    """
+    handle = InferenceHandle(kwargs.pop('snapshot_every', 10))
+    handle.thread = threading.Thread(target=handle._run, args=(args, kwargs))
+    handle.thread.daemon = True
+    handle.thread.start()
+    return handle
+
+cdef class Sampler:
+    """
+    Sampler kept alive between calls: the data is transformed and the C++
+    state (pseudo-observations, s2Y, feature buffers and random streams)
+    allocated once, and every call of step() carries the chain on from
+    where the previous one stopped. step(n) then step(m) gives the same
+    chain as infer with Nsim=n+m and the same seed.
+    Takes the arguments of infer but Nsim, packed and handle (the seed
+    drawn when none is given is kept in the attribute seed), plus
+        trace: record the time spent in each phase of every iteration,
+               together with K and s2Y (see get_trace); without it nothing
+               is measured
+    A sampler is not meant to be stepped from two threads at once.
+    """
+    cdef SamplerState* st
+    cdef ObsCache* obs
+    cdef BitMatrix* Z
+    cdef gsl_matrix** B
+    cdef gsl_vector** theta
+    cdef Pool mem
+    cdef int N, D, maxR, verbose
+    cdef bint running, capped
+    cdef object C, R, F, mu, w, s2Y
+    cdef object trace
+    cdef readonly object seed
+
+    def __cinit__(self, *args, **kwargs):
+        self.st = NULL
+        self.obs = NULL
+        self.Z = NULL
+        self.B = NULL
+        self.theta = NULL
+        self.running = False
+        self.capped = False
+        self.trace = None
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def __init__(self, Xin not None, Cin not None, Zin not None,\
+            np.ndarray[double, ndim=1, mode="c"] Fin, int bias=0,\
+            double s2u=1.0, double s2B=1.0, double alpha=1.0, int maxK=50,\
+            double missing=-1, int verbose=0, int num_threads=1,\
+            seed=None, int trace=0, int resync_every=0):
+        tinit = time.time()
+        cdef int N, D, K
+        cdef gsl_matrix_view Xview
+        cdef np.ndarray[np.uint8_t, ndim=2, mode="c"] Zbytes
+        cdef np.ndarray[double, ndim=2, mode="c"] Xdense
+        cdef np.ndarray[np.int32_t, ndim=1, mode="c"] Xptr, Xidx
+        cdef np.ndarray[double, ndim=1, mode="c"] Xval
+
+        N, D = Xin.shape[1], Xin.shape[0]
+        K = Zin.shape[1]
+        if verbose:
+            print 'N=%d, D=%d, K=%d\n' % (N, D, K)
+            print Xin
+            print Zin
+
+        if len(Cin) != D:
+            raise Exception('Size of C and X are not consistent!')
+        if Zin.shape[0] != N:
+            raise Exception('Size of Z and X are not consistent!')
+        self.N = N
+        self.D = D
+        self.verbose = verbose
+        if seed is None: # a new chain for every sampler
+            seed = np.random.randint(2**31-1)
+        self.seed = seed
+
+        # the sampler keeps Z bit-packed, 64 features per word
+        Zbytes = np.ascontiguousarray(np.asarray(Zin) != 0).view(np.uint8)
+        self.Z = bitmatrix_alloc(N, max(K, 1))
+        bitmatrix_from_bytes(self.Z, <unsigned char*> Zbytes.data, K)
+
+        C = ''
+        for d in xrange(D):
+            C += chr( tolower(ord(Cin[d])) ) # convert to lower case
+        self.C = C
+
+        # index of the observed cells of X, by dimension
+        if hasattr(Xin, 'tocsr'): # scipy.sparse input
+            Xs = Xin.tocsr()
+            Xs.sort_indices()
+            Xptr = np.ascontiguousarray(Xs.indptr, dtype=np.int32)
+            Xidx = np.ascontiguousarray(Xs.indices, dtype=np.int32)
+            Xval = np.ascontiguousarray(Xs.data, dtype=np.float64)
+            self.obs = obscache_alloc_csr(<int*> Xptr.data, <int*> Xidx.data,\
+                    <double*> Xval.data, D)
+        else:
+            Xdense = Xin
+            Xview = gsl_matrix_view_array(&Xdense[0,0],D,N)
+            self.obs = obscache_alloc(missing, &Xview.matrix, N, D)
+
+        self.mem = Pool()
+        self.B = <gsl_matrix**>self.mem.alloc(D, sizeof(gsl_matrix*))
+        self.theta = <gsl_vector**>self.mem.alloc(D, sizeof(gsl_vector*))
+
+        # the C++ state keeps pointers to these arrays
+        cdef np.ndarray[double, ndim=1, mode="c"] F = Fin.copy()
+        cdef np.ndarray[double, ndim=1, mode="c"] w = np.empty(D)
+        cdef np.ndarray[double, ndim=1, mode="c"] mu = np.empty(D)
+        cdef np.ndarray[double, ndim=1, mode="c"] s2Y = np.empty(D)
+        cdef np.ndarray[np.int32_t, ndim=1, mode="c"] R = np.empty(D,dtype=np.int32)
+        self.F, self.w, self.mu, self.s2Y, self.R = F, w, mu, s2Y, R
+        if verbose:
+            print "In C++: transforming input data..."
+        self.maxR = initialize_obs_func(N, D, self.obs, C, self.B, self.theta,\
+                <int*> R.data, &F[0], &mu[0], &w[0], &s2Y[0])
+        if verbose:
+            print "done\n"
+
+        if verbose:
+            print "maxR = %d" % self.maxR
+
+        cdef char* Cc = C
+        self.st = sampler_alloc(self.obs, Cc, self.Z, self.B, self.theta,\
+            <int*> R.data, &F[0], &mu[0], &w[0], self.maxR, bias, N, D, K,\
+            alpha, s2B, &s2Y[0], s2u, maxK, num_threads, <unsigned long> seed)
+        self.st.resync_every = resync_every
+        if trace:
+            self.trace = {'init': time.time() - tinit, 'time': [], 'K': [],\
+                    's2Y': [], 'phase': []}
+
+    def __dealloc__(self):
+        self.close()
+
+    cdef int _step(self, int n_iter, InferenceHandle handle) except -1:
+        if self.st == NULL:
+            raise RuntimeError('the sampler has been closed')
+        if self.running:
+            raise RuntimeError('the sampler is already running')
+        cdef SamplerControl* ctrl = NULL
+        if handle is not None:
+            handle.attach(self.N, self.D, self.st.K, self.maxR)
+            ctrl = handle.ctrl
+        # buffers of the trace of these n_iter iterations
+        cdef SamplerTrace tr
+        cdef SamplerTrace* trp = NULL
+        cdef np.ndarray[double, ndim=2, mode="c"] tphase
+        cdef np.ndarray[double, ndim=1, mode="c"] ttime
+        cdef np.ndarray[np.int32_t, ndim=1, mode="c"] tK
+        cdef np.ndarray[double, ndim=2, mode="c"] ts2Y
+        if self.trace is not None and n_iter > 0:
+            tphase = np.zeros((n_iter,TRACE_NPHASES))
+            ttime = np.zeros(n_iter)
+            tK = np.zeros(n_iter, dtype=np.int32)
+            ts2Y = np.zeros((n_iter,self.D))
+            tr.cap = n_iter
+            tr.n = 0
+            tr.phase = &tphase[0,0]
+            tr.time = &ttime[0]
+            tr.K = <int*> tK.data
+            tr.s2Y = &ts2Y[0,0]
+            trp = &tr
+        # the sampler does not touch Python objects: release the GIL while
+        # it runs, so that several chains can run in parallel threads
+        cdef int Kest
+        cdef int status = self.st.status
+        self.running = True
+        try:
+            with nogil:
+                Kest = sampler_step(self.st, n_iter, ctrl, trp)
+        finally:
+            self.running = False
+        if trp != NULL:
+            self.trace['phase'].append(tphase[:tr.n])
+            self.trace['time'].append(ttime[:tr.n])
+            self.trace['K'].append(tK[:tr.n])
+            self.trace['s2Y'].append(ts2Y[:tr.n])
+        if self.st.fb.capped and not self.capped:
+            self.capped = True
+            warnings.warn('maxK=%d features reached, no new features will be proposed'\
+                    % self.st.fb.maxK)
+        if self.st.status != 0 and status == 0:
+            warnings.warn('numerical error at the sampler, the chain stopped at '\
+                    'iteration %d: consider a pre-processing transformation '\
+                    'of the data' % self.st.it)
+        return Kest
+
+    def step(self, int n_iter):
+        """
+        Runs n_iter more iterations of the sampler and returns the number
+        of features. Once stopped by a numerical error, the chain stays
+        where it is
+        """
+        return self._step(n_iter, None)
+
+    def get_trace(self):
+        """
+        Telemetry recorded so far (None if the sampler was built without
+        trace), as a dict with
+            init: seconds spent transforming the data and setting up the
+                  sampler
+            time: [n] wall-clock seconds of each iteration
+            iters_per_sec: [n] iterations per second
+            K: [n] number of features after each iteration
+            s2Y: [n*D] s2Y after each iteration
+            phase: dict with, for each phase of TRACE_PHASES, the seconds
+                   spent in it at each iteration [n] (summed over threads
+                   for the per-dimension phases Y, s2Y and lambda)
+            total: dict with the cumulative seconds of init and every phase
+        """
+        if self.trace is None:
+            return None
+        tr = self.trace
+        cat = lambda x, shape: np.concatenate(x) if len(x) else np.zeros(shape)
+        phase = cat(tr['phase'], (0,len(TRACE_PHASES)))
+        out = {'init': tr['init'], 'time': cat(tr['time'], 0),\
+                'K': cat(tr['K'], 0).astype(np.int32),\
+                's2Y': cat(tr['s2Y'], (0,self.D))}
+        out['iters_per_sec'] = 1.0 / np.maximum(out['time'], 1e-12)
+        out['phase'] = dict((name, phase[:,i]) for (i, name) in enumerate(TRACE_PHASES))
+        out['total'] = dict((name, phase[:,i].sum()) for (i, name) in enumerate(TRACE_PHASES))
+        out['total']['init'] = tr['init']
+        return out
+
+    def iteration(self):
+        """
+        Number of iterations run so far
+        """
+        if self.st == NULL:
+            return 0
+        return self.st.it
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def get_state(self, int packed=0):
+        """
+        Current state of the sampler, as the outputs of infer:
+        (Z_out, B_out, theta_out, mu, w, s2Y)
+        """
+        if self.st == NULL:
+            raise RuntimeError('the sampler has been closed')
+        cdef int N = self.N, D = self.D, maxR = self.maxR
+        cdef int Kest = self.st.K
+        C = self.C
+        cdef np.ndarray[np.int32_t, ndim=1, mode="c"] R = self.R
+
+        cdef np.ndarray[double, ndim=3] B_out = np.zeros((D,Kest,maxR))
+        cdef np.ndarray[double, ndim=2] theta_out = np.zeros((D,maxR))
+
+        cdef np.ndarray Z_out
+        if packed:
+            Z_out = np.empty((N,(Kest+7)//8), dtype=np.uint8)
+            bitmatrix_to_packbits(self.Z, <unsigned char*> Z_out.data, Kest)
+        else:
+            Z_out = np.empty((N,Kest))
+            bitmatrix_to_rows(self.Z, <double*> Z_out.data, Kest)
+
+        cdef double[:,::1] Bd
+        cdef int idx_tmp
+        if self.verbose:
+            print "B_out[D,Kest,maxR] where D=%d, Kest=%d, maxR=%d" % (D,Kest,maxR)
+        for d in xrange(D):
+            if (C[d] == 'o'):
+                idx_tmp = 1
+            else:
+                idx_tmp = R[d]
+            if Kest > 0:
+                Bd = <double[:self.B[d].size1,:self.B[d].tda]> self.B[d].data
+                B_out[d,:,:idx_tmp] = Bd[:Kest,:idx_tmp]
+
+        for d in xrange(D):
+            if (C[d]=='o' and R[d] > 1):
+                theta_out[d,:R[d]-1] = <double[:R[d]-1]> self.theta[d].data
+
+        return (Z_out,B_out,theta_out,self.mu.copy(),self.w.copy(),\
+                self.s2Y.copy())
+
+    def checkpoint(self):
+        """
+        Copy of the full state of the sampler (random streams included), as
+        a dict of arrays that can be saved with np.savez: 'Z' (packed as in
+        get_state), 'B', 'theta', 'mu', 'w', 's2Y', the pseudo-observations
+        'Y', 'P', 'lambda', 'nest', 'counters' and 'rng'
+        """
+        if self.st == NULL:
+            raise RuntimeError('the sampler has been closed')
+        cdef int nY, sumR, cap, nrng
+        sampler_save_sizes(self.st, &nY, &sumR, &cap, &nrng)
+        cdef np.ndarray[double, ndim=2, mode="c"] Y = np.empty((nY,self.N))
+        cdef np.ndarray[double, ndim=2, mode="c"] P = np.empty((cap,cap))
+        cdef np.ndarray[double, ndim=2, mode="c"] lam = np.empty((cap,sumR))
+        cdef np.ndarray[np.int32_t, ndim=1, mode="c"] nest = np.empty(cap,dtype=np.int32)
+        cdef np.ndarray[np.int32_t, ndim=1, mode="c"] counters = np.empty(6,dtype=np.int32)
+        cdef np.ndarray[np.uint8_t, ndim=2, mode="c"] rng = np.empty((self.D+1,nrng),dtype=np.uint8)
+        sampler_save(self.st, <double*> Y.data, <double*> P.data,\
+                <double*> lam.data, <int*> nest.data, <int*> counters.data,\
+                <unsigned char*> rng.data)
+        (Z, B, theta, mu, w, s2Y) = self.get_state(packed=1)
+        for d in xrange(self.D):
+            if (self.C[d]=='o' and self.R[d] > 1):
+                theta[d,self.R[d]-1] = np.inf
+        return {'Z': Z, 'B': B, 'theta': theta, 'mu': mu, 'w': w, 's2Y': s2Y,\
+                'Y': Y, 'P': P, 'lambda': lam, 'nest': nest,\
+                'counters': counters, 'rng': rng}
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def restore(self, ckpt):
+        """
+        Puts back the state saved by checkpoint() into a sampler built on
+        the same data with Zin= np.unpackbits(ckpt['Z'], axis=1)[:,:K]; the
+        chain then goes on as if it had never stopped
+        """
+        if self.st == NULL:
+            raise RuntimeError('the sampler has been closed')
+        cdef int nY, sumR, cap, nrng
+        sampler_save_sizes(self.st, &nY, &sumR, &cap, &nrng)
+        cdef np.ndarray[np.int32_t, ndim=1, mode="c"] counters =\
+                np.ascontiguousarray(ckpt['counters'], dtype=np.int32)
+        cap = counters[3]
+        if counters.shape[0] != 6 or counters[2] != self.st.K\
+                or ckpt['Y'].shape != (nY,self.N)\
+                or ckpt['lambda'].shape != (cap,sumR)\
+                or ckpt['rng'].shape != (self.D+1,nrng):
+            raise Exception('Checkpoint and sampler are not consistent!')
+        cdef np.ndarray[double, ndim=2, mode="c"] Y = np.ascontiguousarray(ckpt['Y'], dtype=np.float64)
+        cdef np.ndarray[double, ndim=2, mode="c"] P = np.ascontiguousarray(ckpt['P'], dtype=np.float64)
+        cdef np.ndarray[double, ndim=2, mode="c"] lam = np.ascontiguousarray(ckpt['lambda'], dtype=np.float64)
+        cdef np.ndarray[np.int32_t, ndim=1, mode="c"] nest = np.ascontiguousarray(ckpt['nest'], dtype=np.int32)
+        cdef np.ndarray[np.uint8_t, ndim=2, mode="c"] rng = np.ascontiguousarray(ckpt['rng'], dtype=np.uint8)
+        sampler_load(self.st, <double*> Y.data, <double*> P.data,\
+                <double*> lam.data, <int*> nest.data, <int*> counters.data,\
+                <unsigned char*> rng.data)
+
+        cdef int K = self.st.K
+        cdef np.ndarray[np.int32_t, ndim=1, mode="c"] R = self.R
+        cdef double[:,::1] Bd
+        cdef double[:,:,::1] B = np.ascontiguousarray(ckpt['B'], dtype=np.float64)
+        cdef double[:,::1] theta = np.ascontiguousarray(ckpt['theta'], dtype=np.float64)
+        C = self.C
+        for d in xrange(self.D):
+            Bd = <double[:self.B[d].size1,:self.B[d].tda]> self.B[d].data
+            if K > 0:
+                Bd[:K,:self.B[d].size2] = B[d,:K,:self.B[d].size2]
+            if (C[d]=='o' and R[d] > 1):
+                (<double[:R[d]]> self.theta[d].data)[:] = theta[d,:R[d]]
+        self.s2Y[:] = ckpt['s2Y']
+
+    def close(self):
+        """
+        Frees the C++ state; the sampler cannot be stepped afterwards
+        """
+        if self.running:
+            raise RuntimeError('the sampler is still running')
+        if self.st != NULL:
+            sampler_free(self.st)
+            self.st = NULL
+        if self.B != NULL:
+            for d in xrange(self.D):
+                if self.B[d] != NULL:
+                    gsl_matrix_free(self.B[d])
+                if (self.C[d] == 'o' and self.theta[d] != NULL):
+                    gsl_vector_free(self.theta[d])
+            self.B = NULL
+            self.theta = NULL
+        if self.Z != NULL:
+            bitmatrix_free(self.Z)
+            self.Z = NULL
+        if self.obs != NULL:
+            obscache_free(self.obs)
+            self.obs = NULL
+
+def infer(Xin not None,\
+        Cin not None, Zin not None,\
         np.ndarray[double, ndim=1, mode="c"] Fin, int bias=0, double s2u=1.0,\
         double s2B=1.0, double alpha=1.0, int Nsim=100,\
-        int maxK=50, double missing=-1, int verbose=0):#\
+        int maxK=50, double missing=-1, int verbose=0, int num_threads=1,\
+        seed=None, int packed=0, InferenceHandle handle=None,\
+        int resync_every=0):#\
     """
     Function to call inference routine for GLFM model from Python code
     Inputs:
-        Xin: observation matrix ( numpy array [D*N] )
+        Xin: observation matrix ( numpy array [D*N] ), or a scipy.sparse
+             matrix [D*N] whose stored entries are the observed cells (all
+             the others are missing)
         Cin: string array of length D
-        Zin: latent feature binary matrix (numpy array [K*N] )
+        Zin: latent feature binary matrix (numpy array [N*K], any layout)
         Fin: vector of transform functions indicators
 
         *** (the following are optional parameters) ***
@@ -62,158 +606,42 @@ def infer(np.ndarray[double, ndim=2, mode="c"] Xin not None,\
         s2B: variance for feature values
         alpha: mass parameter for the IBP
         Nsim: number of iterations
-        maxK: máximum number of latent features (for memory allocation)
+        maxK: máximum number of latent features (memory follows the current K)
         missing: value of missings (should be an integer or nan) # TODO: check
+        num_threads: number of threads for the update of B and Y, which is
+                     split across dimensions (needs an OpenMP build)
+        seed: seed of the sampler; the same seed gives the same chain
+              (None: drawn from numpy.random, a different chain every call)
+        packed: return Z bit-packed (see Z_out)
+        resync_every: sweeps between two rebuilds from Z of the Gram matrix
+                      Z'Z+I/s2B, otherwise only updated incrementally
+                      (0: never)
+        handle: set by infer_async to follow and cancel the run
     Outputs:
         B_out: feature matrix: np.array of dimensions (D,Kest,maxR) where D is
                the number of dimensions, Kest is the number of inferred latent
                features, and maxR is the maximum number of categories
-        Z_out: activation matrix: np.arry of dimensions (Kest,N) where Kest is
-               the number of inferred latent features, and N = number of obs.
+        Z_out: activation matrix: np.array of dimensions (N,Kest) where Kest
+               is the number of inferred latent features, and N = number of
+               obs. With packed=1, a uint8 array (N,ceil(Kest/8)) with the
+               layout of np.packbits(Z_out, axis=1)
         theta_out: auxiliary variables for ordinal variables, ndarray of size
                    (D,maxR) where D = nr. of dimensions, maxR = max nr. of
                    categories
     """
-    #print X_in.flags['C_CONTIGUOUS']
-    #X_in = np.ascontiguousarray(X_in)
-    #print X_in.flags['C_CONTIGUOUS']
-
-    # cdef gsl_matrix * B = gsl_matrix_alloc(dim, m)
-    cdef int N, D, K
-    cdef gsl_matrix_view Xview, Zview
-    cdef gsl_matrix* X
-    cdef gsl_matrix* Zm
-
-    N, D = Xin.shape[1], Xin.shape[0]
-    K = Zin.shape[0]
-    if verbose:
-        print 'N=%d, D=%d, K=%d\n' % (N, D, K)
-        print Xin
-        print Zin
-
-    ## transpose input matrices in order to be able to call inner C function
-    #cdef np.ndarray[double, ndim=2, mode="c"] Xin = Xin_in.transpose()
-    #cdef np.ndarray[double, ndim=2, mode="c"] Zin = Zin_in.transpose()
-
-    if len(Cin) != D:
-        raise Exception('Size of C and X are not consistent!')
-
-    Zview = gsl_matrix_view_array(&Zin[0,0], K,N)
-    Zm = &Zview.matrix # we need to allocate input matrix Z to [maxK*N] matrix
-    cdef gsl_matrix* Z = gsl_matrix_calloc(maxK,N)
-    for i in xrange(N):
-        for k in xrange(K):
-             gsl_matrix_set (Z, k, i,gsl_matrix_get (Zm, k, i))
-
-    C = ''
-    for d in xrange(D):
-        C += chr( tolower(ord(Cin[d])) ) # convert to lower case
-
-    ##...............BODY CODE.......................##
-
-    Xview = gsl_matrix_view_array(&Xin[0,0],D,N)
-    X = &Xview.matrix
-
-    cdef Pool mem = Pool()
-    cdef gsl_matrix** B = <gsl_matrix**>mem.alloc(D, sizeof(gsl_matrix*));
-    cdef gsl_vector** theta = <gsl_vector**>mem.alloc(D, sizeof(gsl_vector*));
-
-    cdef np.ndarray[double, ndim=1, mode="c"] w = np.empty(D)
-    cdef np.ndarray[double, ndim=1, mode="c"] mu = np.empty(D)
-    cdef np.ndarray[double, ndim=1, mode="c"] s2Y = np.empty(D)
-    cdef np.ndarray[np.int32_t, ndim=1, mode="c"] R = np.empty(D,dtype=np.int32)
-    print "In C++: transforming input data..."
-    cdef int maxR = initialize_func(N, D, maxK, missing, X, C, B, theta,\
-            <int*> R.data, &Fin[0], &mu[0], &w[0], &s2Y[0])
-    print "done\n"
-    #cdef int maxR = 1
-    #cdef np.ndarray[double, ndim=1, mode="c"] Win = np.empty(D)
-
-    if verbose:
-        print "maxR = %d" % maxR
-
-    ##...............Inference Function.......................##
-    print '\nEntering C++: Running Inference Routine...\n'
-    cdef int Kest = IBPsampler_func(missing, X, C, Z, B, theta,\
-            <int*> R.data, &Fin[0], &mu[0], &w[0],\
-            maxR, bias,  N, D, K, alpha, s2B, &s2Y[0], s2u, maxK, Nsim);
-    print '\nBack to Python: OK\n'
-
-    #print "w[0]=%.2f, w[1]=%.2f\n" % (float(w[0]), float(w[1]))
-
-    ##...............Set Output Pointers.......................##
-    cdef np.ndarray[double, ndim=2] Z_out = np.zeros((Kest,N))
-    cdef np.ndarray[double, ndim=3] B_out = np.zeros((D,Kest,maxR))
-    cdef np.ndarray[double, ndim=2] theta_out = np.zeros((D,maxR))
-    #cdef np.ndarray[double, ndim=1] mu_out = np.zeros(D)
-    #cdef np.ndarray[double, ndim=1] w_out = np.zeros(D)
-    #cdef np.ndarray[double, ndim=1] s2Y_out = np.zeros(D)
-
-    if verbose:
-        print "Kest=%d, N=%d\n" % (Kest,N)
-
-    # #Zview = gsl_matrix_submatrix(Z, 0, 0, Kest, N)
-    #print 'N=%d, K=%d, Kest=%d' % (N,K,Kest)
-    for i in xrange(N):
-        for k in xrange(Kest):
-            #print 'k=%d, i=%d' % (k,i)
-            Z_out[k,i] = gsl_matrix_get(Z,k,i)
-            #Z_out[k,i] = (&Zview.matrix)->data[k*N+i]
-    if verbose:
-        print "Z_out loaded"
-
-    cdef gsl_matrix_view Bd_view
-    cdef gsl_matrix* BT
-    cdef int idx_tmp
-    print "B_out[D,Kest,maxR] where D=%d, Kest=%d, maxR=%d" % (D,Kest,maxR)
-    for d in xrange(D):
-        #print 'd=%d, R[d]=%d' % (d,R[d])
-        if (C[d] == 'o'):
-            idx_tmp = 1
-        else:
-            idx_tmp = R[d]
-        Bd_view =  gsl_matrix_submatrix(B[d], 0, 0, Kest, idx_tmp)
-        BT = gsl_matrix_alloc(idx_tmp,Kest)
-        gsl_matrix_transpose_memcpy (BT, &Bd_view.matrix)
-        for k in xrange(Kest):
-            #print 'k=%d' % k
-            for i in xrange(idx_tmp):
-                #print 'i=%d' % i
-                B_out[d,k,i] = gsl_matrix_get(BT,i,k)
-        gsl_matrix_free(BT)
-    if verbose:
-        print "B_out loaded"
-
-    for d in xrange(D):
-        for i in xrange(maxR):
-            if (C[d]=='o' and i<(R[d]-1)):
-                theta_out[d,i] = gsl_vector_get(theta[d],i)
-    if verbose:
-        print "theta_out loaded"
-
-#    for d in xrange(D):
-#        mu_out[d] = gsl_vector_get(mu,d)
-#    if verbose:
-#        print "mu_out loaded"
-#
-#    for d in xrange(D):
-#        w_out[d] = gsl_vector_get(w,d)
-#    if verbose:
-#        print "w_out loaded"
-#
-#    for d in xrange(D):
-#        s2Y_out[d] = gsl_vector_get(s2Y,d)
-#    if verbose:
-#        print "s2Y_out loaded"
-
-    ##..... Free memory.....##
-    for d in xrange(D):
-        gsl_matrix_free(B[d])
-        if (C[d] == 'o'):
-            gsl_vector_free(theta[d])
-    gsl_matrix_free(Z)
-
-    return (Z_out,B_out,theta_out,mu, w, s2Y)
+    sampler = Sampler(Xin, Cin, Zin, Fin, bias=bias, s2u=s2u, s2B=s2B,\
+            alpha=alpha, maxK=maxK, missing=missing, verbose=verbose,\
+            num_threads=num_threads, seed=seed, resync_every=resync_every)
+    try:
+        ##...............Inference Function.......................##
+        if verbose:
+            print '\nEntering C++: Running Inference Routine...\n'
+        sampler._step(Nsim, handle)
+        if verbose:
+            print '\nBack to Python: OK\n'
+        return sampler.get_state(packed)
+    finally:
+        sampler.close()
 
 #    cdef gsl_vector_view Xd_view
 #    for d in xrange(D):
@@ -3,6 +3,9 @@ from Cython.Distutils import Extension
 from Cython.Distutils import build_ext
 import cython_gsl
 import numpy
+import os
+import shutil
+import tempfile
 
 # Remove the "-Wstrict-prototypes" compiler option, which isn't valid for C++.
 import distutils.sysconfig
@@ -11,6 +14,36 @@ for key, value in cfg_vars.items():
     if type(value) == str:
         cfg_vars[key] = value.replace("-Wstrict-prototypes", "")
 
+def has_openmp():
+    """Check whether the compiler accepts -fopenmp (Apple clang does not)."""
+    from distutils.ccompiler import new_compiler
+    from distutils.errors import CompileError, LinkError
+    compiler = new_compiler()
+    distutils.sysconfig.customize_compiler(compiler)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        src = os.path.join(tmpdir, "omp_test.c")
+        with open(src, "w") as f:
+            f.write("#include <omp.h>\nint main(void) { return omp_get_max_threads() < 1; }\n")
+        objs = compiler.compile([src], output_dir=tmpdir, extra_postargs=["-fopenmp"])
+        compiler.link_executable(objs, os.path.join(tmpdir, "omp_test"),
+                                 extra_postargs=["-fopenmp"])
+        return True
+    except (CompileError, LinkError):
+        return False
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+# <atomic>, <mutex> and <chrono> need C++11; OpenMP is optional, the core
+# guards on _OPENMP and falls back to a serial loop over dimensions.
+compile_args = ["-w", "-std=c++11"] # -w suppresses warnings
+link_args = []
+if has_openmp():
+    compile_args.append("-fopenmp")
+    link_args.append("-fopenmp")
+else:
+    print("warning: compiler does not support OpenMP, building without it")
+
 setup(
     include_dirs = [cython_gsl.get_include(), numpy.get_include()],
     cmdclass = {'build_ext': build_ext},
@@ -20,5 +53,6 @@ setup(
             libraries=cython_gsl.get_libraries(),
             library_dirs=[cython_gsl.get_library_dir()],
             include_dirs=[cython_gsl.get_cython_include_dir()],
-            extra_compile_args=["-w"])] # this line suppresses warnings
+            extra_compile_args=compile_args,
+            extra_link_args=link_args)]
     )
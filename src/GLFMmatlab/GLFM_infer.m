@@ -89,7 +89,7 @@ function hidden = GLFM_infer(data,varargin)
     %% call .cpp wrapper function
     tic;
     [Z B theta mu w s2Y]= IBPsampler(data.X,data.C, hidden.Z, params.bias, func, ...
-        params.s2u, params.s2B, params.alpha, params.Niter, params.maxK, params.missing);
+        params.s2u, params.s2B, params.alpha, params.Niter, params.maxK, params.missing, params.seed);
     hidden.time = toc;
     fprintf('Elapsed time %.2f seconds.', hidden.time );
 
@@ -13,6 +13,7 @@ function params = init_default_params(data, params)
     if ~isfield(params,'maxK'), params.maxK = size(data.X,2); end % max number of latent features for memory allocation inside C++ routine
     if ~isfield(params,'verbose'), params.verbose = 1; end % plot info in command line
     if ~isfield(params,'numS'), params.numS = 100; end % number of points to plot in PDF
+    if ~isfield(params,'seed'), params.seed = randi(2^31-1); end % seed of the sampler (same seed, same chain)
 
     % parameters for optional external transformation
     if ~isfield(params,'t'), params.t = cell(1,size(data.X,2) ); end % eventual external transform of obs. X = params.t{d}(Xraw)
@@ -3,6 +3,7 @@ import random
 
 import matplotlib.pyplot as plt
 from scipy.stats import norm
+import scipy.sparse as sp
 
 import pdb
 from IPython import embed
@@ -17,6 +18,11 @@ import GLFMlib # python wrapper library in order to run C++ inference routine
 import mapping_functions as mf
 
 import copy
+import hashlib
+import threading
+import zlib
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 
 def infer(data,hidden=dict(), params=dict()):
     """
@@ -26,6 +32,8 @@ def infer(data,hidden=dict(), params=dict()):
             X: input data N*D where:
                 N = number of observations
                 D = number of dimensions
+               It can also be a scipy.sparse matrix, whose stored entries are
+               the observed cells (all the others are treated as missing)
             C: string array indicating types of data ('g': real,'p': positive real,
                 'c': categorical; 'o': ordinal; 'n': count data)
         hidden (optional): dictionary containing latent variables
@@ -37,9 +45,31 @@ def infer(data,hidden=dict(), params=dict()):
             s2B: noise variance for prior over elements of matrix B
             alpha: concentration parameter of the Indian Buffet Process
             Niter: number of simulations
-            maxK: maximum number of features for memory allocation
+            maxK: maximum number of features (memory follows the current number)
             missing: value for missings (should be an integer, not nan)
             verbose: indicator to print more information
+            num_threads: number of threads for the (per-dimension) update of
+                    B and Y
+            seed: seed of the sampler and of the initial Z (None: drawn from
+                    numpy.random, a different chain every call); the same
+                    seed gives the same chain
+            n_chains: number of independent chains (see infer_chains)
+            resync_every: iterations between two rebuilds from Z of the
+                    matrix Z'Z+I/s2B, otherwise updated incrementally
+                    (0: never)
+            checkpoint: file (npz) where the full state of the sampler is
+                    saved, random streams included (None: no checkpoints)
+            checkpoint_every: iterations between two checkpoints (0: none)
+            checkpoint_seconds: seconds between two checkpoints (0: none);
+                    a checkpoint is also saved at the last iteration
+            resume: checkpoint file to pick the run up from (True: the one
+                    in params['checkpoint']); the chain goes on as if it
+                    had not stopped, up to Niter iterations in total
+            trace: record where the sampler spends its time (see
+                    GLFMlib.Sampler.get_trace), returned in hidden['trace']
+            callback: function called every callback_every iterations with
+                    the trace so far (a dict of arrays)
+            callback_every: period of the calls to callback (default: 10)
 
     Output:
         hidden:
@@ -50,9 +80,18 @@ def infer(data,hidden=dict(), params=dict()):
             mu: mean parameter for internal transformation
             w: scale parameter for internal transformation
             s2Y: inferred noise variance for pseudo-observations Y
+            seed: seed used by the sampler
+            trace: (if params['trace']) seconds spent in initialization and
+                    in each phase of every iteration (Z sweep, feature birth
+                    and death, B, Y, s2Y, lambda), with K, s2Y and
+                    iterations/sec per iteration
+        If params['n_chains'] > 1, the output is that of infer_chains
     """
     # complete dictionary params with default values
     params = init_default_params(data, params) # complete unspecified fields
+    params = draw_seed(params)
+    if params['n_chains'] > 1:
+        return infer_chains(data, hidden, params)
 
     # check input syntax
     assert(type(data) is dict), "input 'data' should be a dictionary."
@@ -67,44 +106,42 @@ def infer(data,hidden=dict(), params=dict()):
 
     # if Z does not exist, initialize
     if not(hidden.has_key('Z')):
-        hidden['Z'] = 1.0*(np.random.rand(N,2) > 0.8)
-        if params['bias'] == 1: # add bias if requested
-            hidden['Z'] = np.concatenate((np.ones((N,1)), hidden['Z']),axis=1)
+        hidden['Z'] = initial_Z(N, params)
 
-    tmp_data = copy.deepcopy(data) #np.copy(data).tolist()
-
-    # replace nan by missing values
-    tmp_data['X'][np.isnan(tmp_data['X'])] = params['missing']
-
-    # change labels for categorical and ordinal vars such that categories
-    # start counting at 1 and all of them are bigger than 0
-    for d in xrange(D):
-        if (tmp_data['C'][d]=='c' or tmp_data['C'][d]=='o'):
-            mask = tmp_data['X'][:,d] != params['missing']
-            uniqueVal = np.unique(tmp_data['X'][mask,d])
-            Xaux = np.zeros(N)
-            for i in xrange(len(uniqueVal)):
-                Xaux[tmp_data['X'][:,d] == uniqueVal[i]] = i+1
-            Xaux[map(lambda x: not x, mask)] = params['missing']
-            tmp_data['X'][:,d] = Xaux
-
-    # eventually, apply external transform specified by the user
-    for r in xrange(tmp_data['X'].shape[1]):
-        if not(params['t'][r] == None): # there is an external transform
-            tmp_data['X'][:,r] = params['t_1'][r](tmp_data['X'][:,r])
-            tmp_data['C'] = tmp_data['C'][:r] + params['ext_dataType'][r] + tmp_data['C'][(r+1):]
-
-    # prepare input data for C++ inference routine
-    Fin = np.ones(tmp_data['X'].shape[1]) # choose internal transform function (for positive)
-    Xin = np.ascontiguousarray( tmp_data['X'].transpose() ) # specify way to store matrices
-    Zin = np.ascontiguousarray( hidden['Z'].transpose() )   # to be compatible with C code
+    if data.has_key('input'): # prepared once for all chains by infer_chains
+        (Xin, tmp_C, R_obs) = data['input']
+    elif sp.issparse(data['X']):
+        (Xin, tmp_C, R_obs) = prepare_sparse_input(data, params)
+    else:
+        (Xin, tmp_C, R_obs) = prepare_dense_input(data, params)
+    Fin = np.ones(D) # choose internal transform function (for positive)
+    Zin = hidden['Z'] # [N*K], as the C code takes it
+    ckpt = None
+    if params['resume'] is not None:
+        ckpt = load_checkpoint(params['checkpoint'] if params['resume'] is True\
+                else params['resume'])
+        assert (str(ckpt['C']) == tmp_C and ckpt['Y'].shape[1] == N),\
+                "checkpoint does not match the input data"
+        K = ckpt['counters'][2]
+        Zin = np.unpackbits(ckpt['Z'], axis=1)[:,:K].astype(np.float64)
+        params = dict(params)
+        params['seed'] = int(ckpt['seed'])
     tinit = time.time() # start counting time
 
     # RUN C++ routine
-    (Z_out,B_out,Theta_out,mu_out,w_out,s2Y_out) = \
-            GLFMlib.infer(Xin, tmp_data['C'], Zin, Fin, params['bias'], params['s2u'],\
-            params['s2B'], params['alpha'], params['Niter'],\
-            params['maxK'], params['missing'], params['verbose'])
+    sampler = GLFMlib.Sampler(Xin, tmp_C, Zin, Fin, params['bias'],\
+            params['s2u'], params['s2B'], params['alpha'], params['maxK'],\
+            params['missing'], params['verbose'], params['num_threads'],\
+            params['seed'], params['trace'] or params['callback'] is not None,\
+            params['resync_every'])
+    try:
+        if ckpt is not None:
+            sampler.restore(ckpt)
+        run_sampler(sampler, tmp_C, params)
+        (Z_out,B_out,Theta_out,mu_out,w_out,s2Y_out) = sampler.get_state()
+        trace = sampler.get_trace()
+    finally:
+        sampler.close()
 
     tlast = time.time()
 
@@ -113,20 +150,254 @@ def infer(data,hidden=dict(), params=dict()):
         print '\n\tElapsed time: %.2f seconds.\n' % hidden['time']
 
     # wrap output values inside hidden
-    hidden['Z'] = Z_out.transpose()
+    hidden['Z'] = Z_out
     hidden['B'] = B_out
     hidden['theta'] = Theta_out
     hidden['mu'] = mu_out
     hidden['w'] = w_out
     hidden['s2Y'] = s2Y_out
+    hidden['seed'] = params['seed']
+    if params['trace']:
+        hidden['trace'] = trace
 
-    hidden['R'] = [None] * D
-    for d in xrange(D):
-        if (data['C'][d] == 'c' or data['C'][d] == 'o'):
-            hidden['R'][d] = np.unique( data['X']\
-                    [(data['X'][:,d] != params['missing']) & (~np.isnan(data['X'][:,d])),d] )
+    hidden['R'] = R_obs
     return hidden
 
+def draw_seed(params):
+    """
+    Copy of params with a seed: params['seed'] if given, otherwise a new one
+    drawn from numpy.random (the dict of the caller is left untouched, so
+    that every call without a seed runs a different chain)
+    """
+    if params['seed'] is not None:
+        return params
+    params = dict(params)
+    params['seed'] = np.random.randint(2**31-1)
+    return params
+
+def initial_Z(N, params):
+    """
+    Random initial feature activation matrix (N*2, plus the bias column if
+    params['bias'] == 1), drawn from the seed of the sampler
+    """
+    rs = np.random.RandomState(params['seed'] % 2**32)
+    Z = 1.0*(rs.rand(N,2) > 0.8)
+    if params['bias'] == 1: # add bias if requested
+        Z = np.concatenate((np.ones((N,1)), Z),axis=1)
+    return Z
+
+def run_sampler(sampler, C, params):
+    """
+    Runs a GLFMlib.Sampler up to params['Niter'] iterations in total. Every
+    params['callback_every'] iterations, params['callback'] (if any) is
+    called with the trace so far. A checkpoint is saved into
+    params['checkpoint'] every params['checkpoint_every'] iterations and/or
+    params['checkpoint_seconds'] seconds, and at the end: the state is
+    copied between two steps and written by a background thread while the
+    sampler goes on.
+    """
+    path = params['checkpoint']
+    every = params['checkpoint_every'] if path is not None else 0
+    seconds = params['checkpoint_seconds'] if path is not None else 0
+    callback = params['callback']
+    cb_every = params['callback_every'] if callback is not None else 0
+    writer = None
+    tlast = time.time()
+    while sampler.iteration() < params['Niter']:
+        it = sampler.iteration()
+        nsteps = params['Niter'] - it
+        if seconds > 0:
+            nsteps = 1
+        for m in [every, cb_every]:
+            if m > 0:
+                nsteps = min(nsteps, m - it % m)
+        sampler.step(nsteps)
+        if sampler.iteration() == it: # stopped by a numerical error
+            break
+        it = sampler.iteration()
+        if cb_every > 0 and (it % cb_every == 0 or it == params['Niter']):
+            callback(sampler.get_trace())
+        if path is None:
+            continue
+        if (every > 0 and it % every == 0) or it == params['Niter'] or\
+                (seconds > 0 and time.time() - tlast >= seconds):
+            ckpt = sampler.checkpoint()
+            ckpt['seed'] = params['seed']
+            ckpt['C'] = C
+            if writer is not None:
+                writer.join()
+            writer = threading.Thread(target=save_checkpoint, args=(path, ckpt))
+            writer.start()
+            tlast = time.time()
+            if params['verbose']:
+                print 'Checkpoint at iteration %d' % it
+    if writer is not None:
+        writer.join()
+
+def save_checkpoint(path, ckpt):
+    """
+    Writes the dict of arrays ckpt into the npz file path (uncompressed),
+    through a temporary file so that path always holds a whole checkpoint
+    """
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        np.savez(f, **ckpt)
+    if os.name == 'nt' and os.path.exists(path):
+        os.remove(path)
+    os.rename(tmp, path)
+
+def load_checkpoint(path):
+    """
+    Reads a checkpoint written by save_checkpoint, as a dict of arrays
+    """
+    with np.load(path) as f:
+        return dict(f)
+
+def infer_chains(data, hidden=dict(), params=dict()):
+    """
+    Runs params['n_chains'] independent chains of the sampler concurrently,
+    one thread each (the C++ routine releases the GIL while it runs).
+    Inputs: same as infer. All chains start from hidden['Z'] if given, and
+        otherwise from their own random initialization; chain c is seeded
+        (initial Z included) with GLFMlib.split_seed(params['seed'], c) and
+        checkpointed into (resumed from) the file params['checkpoint']
+        (params['resume']) followed by '.c'. The input of the C++ routine
+        is prepared once and shared by the chains (in data['input'] of a
+        copy of data)
+    Outputs:
+        hiddens: list with the hidden dictionary of each chain
+        X_map: N*D pooled MAP estimate of the observations (see computeMAP_pooled)
+    """
+    params = draw_seed(init_default_params(data, params)) # complete unspecified fields
+    data_c = dict(data) # shared by all chains
+    if sp.issparse(data['X']):
+        data_c['input'] = prepare_sparse_input(data, params)
+    else:
+        data_c['input'] = prepare_dense_input(data, params)
+
+    chains = []
+    for c in xrange(params['n_chains']):
+        params_c = dict(params)
+        params_c['n_chains'] = 1
+        params_c['seed'] = GLFMlib.split_seed(params['seed'], c)
+        # one checkpoint file for each chain
+        if params['checkpoint'] is not None:
+            params_c['checkpoint'] = '%s.%d' % (params['checkpoint'], c)
+        if params['resume'] is not None and params['resume'] is not True:
+            params_c['resume'] = '%s.%d' % (params['resume'], c)
+        chains.append((dict(hidden), params_c))
+
+    pool = ThreadPool(len(chains))
+    try:
+        hiddens = pool.map(lambda chain: infer(data_c, chain[0], chain[1]), chains)
+    finally:
+        pool.close()
+        pool.join()
+
+    X_map = computeMAP_pooled(data['C'], hiddens, params)
+    return (hiddens, X_map)
+
+def prepare_dense_input(data, params):
+    """
+    Builds the input of the C++ inference routine from a dense data matrix,
+    as a single transformed copy of X. The result is cached in data['cache']
+    and reused while data['X'] is the same array, with the same values (a
+    CRC32 of X is checked, so that changes in place are seen), and the
+    transforms do not change; deleting data['cache'] frees the copy
+    Inputs:
+        data: dictionary whose matrix X (N*D, C or Fortran order) uses nan
+              or params['missing'] for the missing cells
+        params: dictionary of simulation parameters
+    Outputs:
+        Xin: numpy array D*N (C order) with missing cells set to
+             params['missing'], categories relabelled to 1..R and external
+             transforms applied
+        C: string array of datatypes after external transforms
+        R: list of length D with the sorted categories of the observed
+           cells of categorical and ordinal dimensions (None otherwise)
+    """
+    X = data['X']
+    key = (data['C'], params['missing'], tuple(params['t_1']),\
+            tuple(params.get('ext_dataType', [])), X.shape, X.dtype, array_crc(X))
+    if data.has_key('cache') and data['cache'][0] is X \
+            and data['cache'][1] == key:
+        return data['cache'][2]
+    (N, D) = X.shape
+    C = data['C']
+    R = [None] * D
+    Xin = np.empty((D, N))
+    for d in xrange(D):
+        Xd = Xin[d] # view: X is only copied here, one column at a time
+        Xd[:] = X[:,d]
+        Xd[np.isnan(Xd)] = params['missing']
+        # categories start counting at 1
+        if (C[d] == 'c' or C[d] == 'o'):
+            mask = Xd != params['missing']
+            if not mask.any():
+                raise ValueError('dimension %d has no observed cells, its '\
+                        'categories are unknown' % d)
+            R[d] = np.unique(Xd[mask])
+            Xd[mask] = np.searchsorted(R[d], Xd[mask]) + 1
+        # eventually, apply external transform specified by the user
+        if not(params['t'][d] == None):
+            Xd[:] = params['t_1'][d](Xd)
+            C = C[:d] + params['ext_dataType'][d] + C[(d+1):]
+    data['cache'] = (X, key, (Xin, C, R))
+    return (Xin, C, R)
+
+def array_crc(X):
+    """
+    CRC32 of the values of the 2-dimensional array X (nan included)
+    """
+    if X.flags.c_contiguous:
+        return zlib.crc32(X)
+    if X.flags.f_contiguous:
+        return zlib.crc32(X.T)
+    crc = 0
+    for d in xrange(X.shape[1]): # one column at a time
+        crc = zlib.crc32(np.ascontiguousarray(X[:,d]), crc)
+    return crc
+
+def prepare_sparse_input(data, params):
+    """
+    Builds the input of the C++ inference routine from a sparse data matrix
+    Inputs:
+        data: dictionary whose matrix X (N*D) is a scipy.sparse matrix, the
+              stored entries being the observed cells
+        params: dictionary of simulation parameters
+    Outputs:
+        Xin: observed cells as a scipy.sparse.csr_matrix of size D*N
+        C: string array of datatypes after external transforms
+        R: list of length D with the sorted categories of the observed
+           cells of categorical and ordinal dimensions (None otherwise)
+    """
+    X = sp.csc_matrix(data['X'], dtype=np.float64, copy=True)
+    X.sort_indices()
+    # stored nan values are treated as missing
+    nan_mask = np.isnan(X.data)
+    if nan_mask.any():
+        X = X.tocoo()
+        keep = ~np.isnan(X.data)
+        X = sp.csc_matrix((X.data[keep], (X.row[keep], X.col[keep])), shape=X.shape)
+        X.sort_indices()
+    D = X.shape[1]
+    C = data['C']
+    R = [None] * D
+    for d in xrange(D):
+        Xd = X.data[X.indptr[d]:X.indptr[d+1]] # view of the observed cells
+        # categories start counting at 1
+        if (C[d] == 'c' or C[d] == 'o'):
+            if len(Xd) == 0:
+                raise ValueError('dimension %d has no observed cells, its '\
+                        'categories are unknown' % d)
+            R[d] = np.unique(Xd)
+            Xd[:] = np.searchsorted(R[d], Xd) + 1
+        # eventually, apply external transform specified by the user
+        if not(params['t'][d] == None):
+            Xd[:] = params['t_1'][d](Xd)
+            C = C[:d] + params['ext_dataType'][d] + C[(d+1):]
+    return (X.T.tocsr(), C, R)
+
 def complete(data, hidden=dict(), params=dict()):
     """
     Inputs:
@@ -145,7 +416,7 @@ def complete(data, hidden=dict(), params=dict()):
             s2B: noise variance for prior over elements of matrix B
             alpha: concentration parameter of the Indian Buffet Process
             Niter: number of simulations
-            maxK: maximum number of features for memory allocation
+            maxK: maximum number of features (memory follows the current number)
             missing: value for missings (should be an integer, not nan)
             verbose: indicator to print more information
     Output:
@@ -159,6 +430,10 @@ def complete(data, hidden=dict(), params=dict()):
             mu: mean parameter for internal transformation
             w: scale parameter for internal transformation
             s2Y: inferred noise variance for pseudo-observations Y
+            seed: seed used by the sampler
+        If params['n_chains'] > 1, hidden is the list of hidden structures of
+        the chains and missing values are completed with their pooled MAP
+        estimate (see computeMAP_pooled)
     """
     # complete dictionary params
     params = init_default_params(data, params) # complete unspecified fields
@@ -178,18 +453,120 @@ def complete(data, hidden=dict(), params=dict()):
 
     # Run Inference
     hidden = infer(data,hidden,params)
+    if params['n_chains'] > 1: # impute with the predictions pooled over the chains
+        (hidden, X_map) = hidden
+        Xcompl = np.copy(data['X'])
+        miss = np.isnan(Xcompl) | (Xcompl == params['missing'])
+        Xcompl[miss] = X_map[miss]
+        return (Xcompl,hidden)
 
-    tmp_data = copy.deepcopy(data) # np.copy(data).tolist()
-    # Just in case there is any nan (also considered as missing)
-    tmp_data['X'][np.isnan(tmp_data['X'])] = params['missing']
+    # nan is also considered as missing
+    Xcompl = np.copy(data['X'])
+    miss = np.isnan(Xcompl) | (Xcompl == params['missing'])
+    # one call of computeMAP for all the missing cells of each dimension
+    for d in miss.any(axis=0).nonzero()[0]:
+        rows = miss[:,d].nonzero()[0]
+        Xcompl[rows,d] = computeMAP( data['C'], hidden['Z'][rows,:], hidden, params, [d] )[:,0]
+    return (Xcompl,hidden)
 
-    [xx_miss, yy_miss] = (tmp_data['X'] == params['missing']).nonzero()
+def pattern_ids(Zp):
+    """
+    Maps the rows of Zp to the distinct patterns among them
+    Input:
+        Zp: P*K matrix of feature activation
+    Outputs:
+        patterns: numP*K matrix with the distinct rows of Zp
+        ids: P vector with the row of patterns of each row of Zp
+        keys: numP list with the bytes of each pattern (its key in pattern_cache)
+    """
+    Zp = np.ascontiguousarray(np.atleast_2d(Zp), dtype=np.float64)
+    if Zp.shape[0] == 0 or Zp.shape[1] == 0:
+        return (Zp[:1,:], np.zeros(Zp.shape[0], dtype=int), [''] * min(Zp.shape[0],1))
+    if ((Zp == 0) | (Zp == 1)).all(): # binary rows: packed into 64-bit words
+        (rows, Zp) = pack_patterns(Zp)
+        prefix = 'b'
+    else:
+        rows = Zp.view('V%d' % (Zp.itemsize*Zp.shape[1])).ravel()
+        prefix = 'v'
+    (_, first, ids) = np.unique(rows, return_index=True, return_inverse=True)
+    patterns = Zp[first,:]
+    return (patterns, ids, [prefix + r.tostring() for r in rows[first]])
 
-    Xcompl=np.copy(tmp_data['X'])
-    for ii in xrange(len(xx_miss)): # for each missing
-        if tmp_data['X'][xx_miss[ii],yy_miss[ii]] == params['missing']: # will always be the case
-            Xcompl[xx_miss[ii],yy_miss[ii]] = computeMAP( tmp_data['C'], hidden['Z'][xx_miss[ii],:], hidden, params, [ yy_miss[ii] ] )
-    return (Xcompl,hidden)
+def snapshot_key(hidden, params=dict()):
+    """
+    Fingerprint of the part of hidden (and params) that the predictions of
+    computePDF and compute_log_likelihood depend on
+    """
+    h = hashlib.sha1()
+    for name in ('B', 'theta', 'mu', 'w', 's2Y'):
+        a = np.ascontiguousarray(hidden[name], dtype=np.float64)
+        h.update(str(a.shape))
+        h.update(a.tostring())
+    h.update(str([0 if r is None else len(r) for r in hidden['R']]))
+    h.update(repr(params.get('s2u')))
+    return h.hexdigest()
+
+class PatternCache(object):
+    """
+    Least recently used cache of per-pattern predictions (pdf values over a
+    domain and categorical/ordinal probability vectors). There is one entry
+    per (snapshot_key, kind of prediction, dimension, ...), holding the
+    values of the patterns computed so far, one row each, and the row of
+    each pattern; the entries take about maxbytes at most
+    """
+    def __init__(self, maxbytes=2**27):
+        self.maxbytes = maxbytes
+        self.nbytes = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def lookup(self, key, keys, patterns, compute):
+        """
+        Values of compute (a function of a block of patterns returning one
+        value or row per pattern) on the rows of patterns, whose bytes are
+        keys; only the patterns missing from the entry key are computed
+        """
+        if len(keys) == 0:
+            return compute(patterns)
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.nbytes -= entry[2]
+        (index, values) = ({}, None) if entry is None else entry[:2]
+        rows = np.array([index.get(k, -1) for k in keys])
+        todo = (rows < 0).nonzero()[0]
+        if len(todo) > 0:
+            new = compute(patterns[todo,:])
+            n0 = 0 if values is None else values.shape[0]
+            values = new if values is None else np.concatenate((values, new))
+            rows[todo] = n0 + np.arange(len(todo))
+            index.update(zip([keys[i] for i in todo], rows[todo]))
+        # the index costs about the size of a key plus 100 bytes per pattern
+        nbytes = values.nbytes + len(index) * (len(keys[0]) + 100)
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.nbytes -= old[2]
+            if nbytes <= self.maxbytes:
+                self.entries[key] = (index, values, nbytes)
+                self.nbytes += nbytes
+            while self.nbytes > self.maxbytes:
+                self.nbytes -= self.entries.popitem(last=False)[1][2]
+        return values[rows]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+pattern_cache = PatternCache() # shared by computePDF and compute_log_likelihood
+
+def few_patterns(ids, keys):
+    """
+    Whether the rows mapped to ids hold few enough distinct patterns (keys)
+    for computing once per pattern to pay off
+    """
+    return 4*len(keys) <= len(ids)
 
 def computeMAP(C, Zp, hidden, params=dict(), idxsD=[]):
     """
@@ -226,49 +603,97 @@ def computeMAP(C, Zp, hidden, params=dict(), idxsD=[]):
     assert (K2 == K), "Incongruent sizes between Zp and hidden['B']: number of latent variables should not be different"
 
     X_map = np.zeros((P,len(idxsD))) # output matrix
+    Zp = np.atleast_2d(Zp)
     for dd in xrange(len(idxsD)): # for each dimension
         d = idxsD[dd]
         if params.has_key('t'): # if external transformations have been defined
             if not(params['t'][d] == None): # there is an external transform for data type d
                 C = C[:d] + params['ext_dataType'][d] + C[(d+1):]
 
-        if not(C[d] == 'c'):
-            aux = np.inner(Zp, hidden['B'][d,:,0])
-
-        if C[d] == 'g':
-            X_map[:,dd] = mf.f_g( aux, hidden['mu'][d], hidden['w'][d] )
-        elif C[d] == 'p':
-            X_map[:,dd] = mf.f_p( aux, hidden['mu'][d], hidden['w'][d] )
-        elif C[d] == 'n':
-            X_map[:,dd] = mf.f_n( aux, hidden['mu'][d], hidden['w'][d] )
-        elif C[d] == 'c':
-            X_map[:,dd] = mf.f_c( np.inner(Zp, hidden['B'][d,:,\
-                    range(int(hidden['R'][d].shape[0])) ]) )
-        elif C[d] == 'o':
-            X_map[:,dd] = mf.f_o( aux, hidden['theta'][d,range(int(hidden['R'][d].shape[0]-1))] )
-        else:
-            raise ValueError('Unknown data type')
-        if (sum(np.isnan(X_map[:,dd])) > 0):
+        X_map[:,dd] = computeMAP_dim(C[d], Zp, hidden, d)
+        if np.isnan(X_map[:,dd]).any():
             raise ValueError('Some values are nan!')
         if params.has_key('t'):
             if not(params['t'][d] == None): # there is an external transform for data type d
                 X_map[:,dd] = params['t'][d]( X_map[:,dd] )
     return X_map
 
+def computeMAP_dim(Cd, Zp, hidden, d):
+    """
+    MAP estimate of dimension d, of type Cd, for every row of Zp (P*K)
+    """
+    if not(Cd == 'c'):
+        aux = np.inner(Zp, hidden['B'][d,:,0])
+
+    if Cd == 'g':
+        return mf.f_g( aux, hidden['mu'][d], hidden['w'][d] )
+    elif Cd == 'p':
+        return mf.f_p( aux, hidden['mu'][d], hidden['w'][d] )
+    elif Cd == 'n':
+        return mf.f_n( aux, hidden['mu'][d], hidden['w'][d] )
+    elif Cd == 'c':
+        return mf.f_c( np.inner(Zp, hidden['B'][d,:,\
+                range(int(hidden['R'][d].shape[0])) ]) )
+    elif Cd == 'o':
+        return mf.f_o( aux, hidden['theta'][d,range(int(hidden['R'][d].shape[0]-1))] )
+    else:
+        raise ValueError('Unknown data type')
+
+def computeMAP_pooled(C, hiddens, params=dict(), idxsD=[], idxsN=[]):
+    """
+    Pooled MAP estimate of the training observations over several chains
+    Inputs:
+      C: 1*D string with data types, D = number of dimensions
+      hiddens: list of hidden structures, one per chain (see infer_chains)
+    ----------------(optional) ------------------
+          - idxsD: dimensions to infer
+          - idxsN: observations to infer
+    Outputs:
+      X_map: Ni*Di matrix with the average of the MAP estimates of the chains
+             for real and positive real data, and their most frequent value
+             (the smallest one in a tie) for count, categorical and ordinal
+             data
+    """
+    if (len(idxsD) == 0): # no dimension specified, infer all dimensions
+        idxsD = range(hiddens[0]['B'].shape[0])
+    if (len(idxsN) == 0): # no observation specified, infer all of them
+        idxsN = range(hiddens[0]['Z'].shape[0])
+
+    # n_chains * Ni * Di
+    X_maps = np.array([ computeMAP(C, hidden['Z'][idxsN,:], hidden, params, idxsD)\
+            for hidden in hiddens ])
+    X_map = np.mean(X_maps, 0)
+    for dd in xrange(len(idxsD)):
+        d = idxsD[dd]
+        if params.has_key('t') and not(params['t'][d] == None):
+            continue # external transforms map to real values
+        if (C[d] == 'n' or C[d] == 'c' or C[d] == 'o'):
+            X_map[:,dd] = mode_columns(X_maps[:,:,dd])
+    return X_map
+
+def mode_columns(A):
+    """
+    Most frequent value of each column of A (n_chains*N), the smallest one
+    in a tie, with one comparison of every pair of rows (n_chains is small)
+    """
+    A = np.sort(A, 0)
+    counts = (A[:,np.newaxis,:] == A[np.newaxis,:,:]).sum(1)
+    return A[np.argmax(counts, 0), np.arange(A.shape[1])]
+
 def computePDF(data, Zp, hidden, params, d):
     """
     Function to compute probability density function for dimension d
     """
-    print "dim=%d\n" % d
-    tmp_data = copy.deepcopy(data) #np.copy(data).tolist()
-    tmp_data['X'][np.isnan(tmp_data['X'][:,d]),d] = params['missing']
+    Xd = data['X'][:,d] # view
+    Xobs = Xd[~np.isnan(Xd) & (Xd != params['missing'])] # observed values
+    C = data['C']
 
     # compute x-domain [mm MM] to compute pdf
-    mm = np.min(tmp_data['X'][tmp_data['X'][:,d] != params['missing'], d]) # min value
-    MM = np.max(tmp_data['X'][tmp_data['X'][:,d] != params['missing'], d]) # max value
+    mm = np.min(Xobs) # min value
+    MM = np.max(Xobs) # max value
 
     if (params['t'][d] != None): # if there is an external transformation
-        tmp_data['C'] = tmp_data['C'][:d] + params['ext_dataType'][d] + tmp_data['C'][d+1:]
+        C = C[:d] + params['ext_dataType'][d] + C[d+1:]
         mm = params['t_1'][d](mm)
         MM = params['t_1'][d](MM)
 
@@ -281,43 +706,71 @@ def computePDF(data, Zp, hidden, params, d):
     K = hidden['B'].shape[1]
     assert (K2 == K), "Incongruent sizes between Zp and hidden['B']: number of latent variables should not be different"
 
-    if (tmp_data['C'][d] == 'g') or (tmp_data['C'][d] == 'p'):
+    if (C[d] == 'g') or (C[d] == 'p'):
         numS = 100
         xd = np.linspace(mm, MM, num=numS)
-    elif (tmp_data['C'][d] == 'n'):
+    elif (C[d] == 'n'):
         xd = np.array( range(int(mm),int(MM)+1) )
         numS = len(xd)
     else:
-        xd = np.unique(tmp_data['X'][tmp_data['X'][:,d] != params['missing'], d])
+        xd = np.unique(Xobs)
         numS = len(xd) # number of labels for categories or ordinal data
-    pdf = np.zeros((P,numS))
+    if (C[d] == 'c') or (C[d] == 'o'):
+        key = ('pmf', C[d], d)
+        compute = lambda Zu: computePMF_patterns(C[d], Zu, hidden, d)
+    else:
+        key = ('pdf', C[d], d, xd.tostring())
+        compute = lambda Zu: computePDF_patterns(C[d], xd, Zu, hidden, params, d)
+    # with few distinct rows in Zp, pdfs are computed once per pattern; those
+    # of categorical and ordinal data are the probability vectors of
+    # compute_log_likelihood
+    (patterns, ids, keys) = pattern_ids(Zp)
+    if few_patterns(ids, keys):
+        pdf = pattern_cache.lookup((snapshot_key(hidden, params),) + key, keys,
+                patterns, compute)[ids]
+    else:
+        pdf = compute(np.atleast_2d(Zp))
+    assert (np.sum(np.isnan(pdf)) == 0), "Some values are nan!"
+
+    if params.has_key('t'):
+        if (params['t'][d] != None): # we have used a special transform beforehand
+            xd = params['t'][d](xd) # if there was an external transformation, transform pdf
+            pdf = pdf * np.abs( params['dt_1'][d](xd) )
+    return (xd,pdf)
 
-    for p in xrange(P):
-        if tmp_data['C'][d] == 'g':
-            pdf[p,:] = mf.pdf_g(xd,Zp[p,:], hidden['B'][d,:,0],\
+def computePDF_patterns(Cd, xd, Zu, hidden, params, d):
+    """
+    pdf of dimension d, of type Cd ('g', 'p' or 'n'), at the points xd for
+    every row of Zu (U*K)
+    """
+    pdf = np.zeros((Zu.shape[0],len(xd)))
+    for p in xrange(Zu.shape[0]):
+        if Cd == 'g':
+            pdf[p,:] = mf.pdf_g(xd,Zu[p,:], hidden['B'][d,:,0],\
                     hidden['mu'][d], hidden['w'][d], hidden['s2Y'][d], params['s2u'])
-        elif tmp_data['C'][d] == 'p':
-            pdf[p,:] = mf.pdf_p(xd,Zp[p,:], hidden['B'][d,:,0],\
+        elif Cd == 'p':
+            pdf[p,:] = mf.pdf_p(xd,Zu[p,:], hidden['B'][d,:,0],\
                     hidden['mu'][d], hidden['w'][d], hidden['s2Y'][d], params['s2u'])
-        elif tmp_data['C'][d] == 'n':
-            pdf[p,:] = mf.pdf_n(xd,Zp[p,:], hidden['B'][d,:,0],\
+        elif Cd == 'n':
+            pdf[p,:] = mf.pdf_n(xd,Zu[p,:], hidden['B'][d,:,0],\
                     hidden['mu'][d], hidden['w'][d], hidden['s2Y'][d])
-        elif tmp_data['C'][d] == 'c':
-            pdf[p,:] = mf.pdf_c(Zp[p,:], hidden['B'][d,:,range(
-                    int(hidden['R'][d].shape[0]))], hidden['s2Y'][d])
-        elif tmp_data['C'][d] == 'o':
-            pdf[p,:] = mf.pdf_o(Zp[p,:], hidden['B'][d,:,0],\
-                    hidden['theta'][d,range(
-                    int(hidden['R'][d].shape[0]-1))], hidden['s2Y'][d])
         else:
             raise ValueError('Unknown data type')
-        assert (np.sum(np.isnan(pdf)) == 0), "Some values are nan!"
+    return pdf
 
-    if params.has_key('t'):
-        if (params['t'][d] != None): # we have used a special transform beforehand
-            xd = params['t'][d](xd) # if there was an external transformation, transform pdf
-            pdf = pdf * np.abs( params['dt_1'][d](xd) )
-    return (xd,pdf)
+def computePMF_patterns(Cd, Zu, hidden, d):
+    """
+    Probability vector of dimension d, of type Cd ('c' or 'o'), for every
+    row of Zu (U*K): U*R matrix
+    """
+    if Cd == 'c':
+        return mf.pdf_c_batch(Zu, hidden['B'][d,:,range(
+                int(hidden['R'][d].shape[0]))], hidden['s2Y'][d])
+    elif Cd == 'o':
+        return mf.pdf_o(Zu, hidden['B'][d,:,0], hidden['theta'][d,range(
+                int(hidden['R'][d].shape[0]-1))], hidden['s2Y'][d])
+    else:
+        raise ValueError('Unknown data type')
 
 def compute_log_likelihood(
         Xtrue_ND,
@@ -344,139 +797,121 @@ def compute_log_likelihood(
     D = Xtrue_ND.shape[1]
 
     lik = np.zeros(Xtrue_ND.shape)
+    obs = ~np.isnan(Xtrue_ND) # cells whose log-lik is computed
+    # with few distinct rows in Z, probability vectors of categorical and
+    # ordinal data are computed once per pattern
+    (patterns, ids, keys) = pattern_ids(hidden['Z'])
+    if few_patterns(ids, keys):
+        snapshot = snapshot_key(hidden, params)
 
-    # Apply external transformation if any
-    Xtrue_transformed_ND = Xtrue_ND.copy()
     for d in xrange(D):
+        rows = obs[:,d].nonzero()[0]
+        if len(rows) == 0:
+            continue
+        xd = Xtrue_ND[rows,d]
+        Cd = C[d]
         if (params['t'][d] != None): # if there is an external transformation
             # change type of dimension d by external data type
-            C = C[:d]+params['ext_dataType'][d]+C[d+1:]
-            mask = (~np.isnan(Xtrue_ND[:,d]))
-            Xtrue_transformed_ND[mask,d] = params['t_1'][d](Xtrue_ND[mask,d])
-
-    # Find coordinates of all non missing values
-    lik_cords = np.argwhere(~np.isnan(Xtrue_ND)).tolist()
-    lik_cords = [tuple(l) for l in lik_cords]
-
-    unique_maps = [None] * D
-    for d in xrange(D):
-        # Ensure that tnd is mapped to the correct low label
-        if (C[d] == 'c') | (C[d] == 'o'):
-            unique_vals = np.unique(Xtrue_ND[:, d])
+            Cd = params['ext_dataType'][d]
+            xd = params['t_1'][d](xd)
+        if Cd == 'c' or Cd == 'o':
+            # Ensure that xd is mapped to the correct low label
             # Categories have to start at 1
-            unique_map = dict(zip(unique_vals, range(1, len(unique_vals) + 1)))
-            unique_maps[d] = (unique_map)
-        #if C[d] == 'o':
-        #    unique_vals = np.unique(Xtrue_ND[:, d])
-        #    # Categories have to start at 1
-        #    unique_map = dict(zip(unique_vals,unique_vals - np.min(unique_vals) + 1))
-        #    unique_maps[d] = (unique_map)
-
-    # Loop over all non missing values, and calculate the log lik.
-    for cord in lik_cords:
-        n = cord[0]  # Get the row ID
-        d = cord[1]  # Get the column ID
-        tnd = Xtrue_transformed_ND[cord]  # Find the true value at the held out coordinate
-
-        # ENSURE that tnd is mapped to the correct low label
-        if C[d] == 'c' or C[d] == 'o':
-            # Proper re-map
-            tnd = unique_maps[d][tnd]
-
-        if C[d] == 'g':
+            xd = np.searchsorted(np.unique(xd), xd) + 1
+
+        if Cd == 'g':
             # Real
-            lik[cord] = mf.pdf_g(tnd,
-                                            hidden['Z'][n, :],
-                                            hidden['B'][d, :, 0],
-                                            hidden['mu'][d],
-                                            hidden['w'][d],
-                                            hidden['s2Y'][d],
-                                            params['s2u'])
-        elif C[d] == 'p':
+            lik[rows,d] = mf.pdf_g(xd, hidden['Z'][rows,:], hidden['B'][d,:,0],
+                    hidden['mu'][d], hidden['w'][d], hidden['s2Y'][d], params['s2u'])
+        elif Cd == 'p':
             # Positive real
-            lik[cord] = mf.pdf_p(tnd,
-                                            hidden['Z'][n, :],
-                                            hidden['B'][d, :, 0],
-                                            hidden['mu'][d],
-                                            hidden['w'][d],
-                                            hidden['s2Y'][d],
-                                            params['s2u'])
-        elif C[d] == 'n':
+            lik[rows,d] = mf.pdf_p(xd, hidden['Z'][rows,:], hidden['B'][d,:,0],
+                    hidden['mu'][d], hidden['w'][d], hidden['s2Y'][d], params['s2u'])
+        elif Cd == 'n':
             # Count
-            lik[cord] = mf.pdf_n(tnd,
-                                            hidden['Z'][n, :],
-                                            hidden['B'][d, :, 0],
-                                            hidden['mu'][d],
-                                            hidden['w'][d],
-                                            hidden['s2Y'][d])
-        elif C[d] == 'c':
-            # Categorical
-            pdf = mf.pdf_c(hidden['Z'][n, :],
-                           hidden['B'][d, :, range(int(hidden['R'][d].shape[0]))],
-                           hidden['s2Y'][d])
-            lik[cord] = pdf[int(tnd - 1)]  # -1 since the max category is indexed by max_val -1
-
-        elif C[d] == 'o':
-            # Ordinal
-            pdf = mf.pdf_o_single(int(tnd - 1), hidden['Z'][n, :],
-                           hidden['B'][d, :, 0],
-                           hidden['theta'][d, range(int(hidden['R'][d].shape[0] - 1))],
-                           hidden['s2Y'][d])
-            lik[cord] = pdf
-            #log_lik[cord] = np.log(pdf[int(tnd - 1)])
+            lik[rows,d] = mf.pdf_n(xd, hidden['Z'][rows,:], hidden['B'][d,:,0],
+                    hidden['mu'][d], hidden['w'][d], hidden['s2Y'][d])
+        elif Cd == 'c' or Cd == 'o':
+            # Categorical or ordinal
+            compute = lambda Zu: computePMF_patterns(Cd, Zu, hidden, d)
+            if few_patterns(ids, keys):
+                pdf = pattern_cache.lookup((snapshot, 'pmf', Cd, d), keys,
+                        patterns, compute)
+                prow = ids[rows]
+            else:
+                pdf = compute(hidden['Z'][rows,:])
+                prow = np.arange(len(rows))
+            lik[rows,d] = pdf[prow, xd - 1] # -1 since the max category is indexed by max_val -1
         else:
             raise ValueError('Unknown data type')
 
-    assert (np.isnan(lik).sum() == 0), "Some values are nan!"
+        # transform lik pdf_y (pseudo-obs) into lik pdf_x
+        if (params['t'][d] != None): # we have used a special transform beforehand
+            lik[rows,d] = lik[rows,d] * np.abs(
+                params['dt_1'][d](Xtrue_ND[rows,d]) )
 
-    # transform lik pdf_y (pseudo-obs) into lik pdf_x
-    for d in xrange(D):
-        if params.has_key('t'):
-            if (params['t'][d] != None): # we have used a special transform beforehand
-                mask = (~np.isnan(Xtrue_ND[:,d]))
-                lik[mask,d] = lik[mask,d] * np.abs(
-                    params['dt_1'][d](Xtrue_ND[mask,d]) )
+    assert (np.isnan(lik).sum() == 0), "Some values are nan!"
 
     # finally, apply log transform
-    for d in xrange(D):
-        lik[mask,d] = np.log(lik[mask,d])
+    lik[obs] = np.log(lik[obs])
     return lik
 
-def get_feature_patterns_sorted(Z):
+def get_feature_patterns_sorted(Z, top=None, verbose=0):
     """
     Function to compute list of activation patterns. Returns sorted list
     Input:
         Z: N*K binary matrix
+      ----------------(optional) ------------------
+        top: number of patterns to return (the most frequent ones); the
+             observations with any other pattern are assigned to -1
+        verbose: print each pattern with its number of observations
     Outputs:
         patterns: numP*K: list of patterns
         C: assignment vector of length N*1 with pattern id for each observation
         L: numP*1 vector with num. of observations per pattern
     """
-    N = Z.shape[0]
-    C = np.zeros(N)
-
-    patterns = np.vstack({tuple(row) for row in Z})
-    numP = patterns.shape[0]
-    L = np.zeros(numP)
-    for r in xrange(numP): # for each pattern
-        pat = patterns[r,:]
-        mask = np.sum(np.tile(pat,(N,1)) == Z, axis=1) == Z.shape[1]
-        C[mask] = r
-        L[r] = sum(mask)
-        #print '%d. %s: %d' % (r, str(patterns[r,:]), L[r])
-
-    # sort arrays
-    idxs = L.argsort()
-    idxs = np.flipud(idxs)
+    (keys, Z) = pack_patterns(Z)
+    (_, first, C, L) = np.unique(keys, return_index=True, return_inverse=True,\
+            return_counts=True)
+    patterns = Z[first,:]
+
+    # sort arrays (by decreasing number of observations)
+    idxs = np.argsort(-L, kind='mergesort')
+    rank = np.empty(len(idxs), dtype=int)
+    rank[idxs] = np.arange(len(idxs))
+    C = rank[C]
     L = L[idxs]
     patterns = patterns[idxs,:]
+    if top is not None:
+        patterns = patterns[:top,:]
+        L = L[:top]
+        C[C >= top] = -1
+    numP = patterns.shape[0]
 
-    print '\n'
-    for r in xrange(numP): # for each pattern
-        print '%d. %s: %d' % (r, str(patterns[r,:]), L[r])
+    if verbose:
+        print '\n'
+        for r in xrange(numP): # for each pattern
+            print '%d. %s: %d' % (r, str(patterns[r,:]), L[r])
 
     return (patterns,C,L)
 
+def pack_patterns(Z):
+    """
+    Packs each row of the binary matrix Z (N*K) into ceil(K/64) 64-bit words
+    Outputs:
+        keys: N vector with the packed rows (uint64 if K <= 64, otherwise
+              void scalars of the words of the row), equal for equal rows
+        Z: Z as a 2-dimensional array
+    """
+    Z = np.atleast_2d(Z)
+    (N,K) = Z.shape
+    nw = max(1, (K+63) // 64)
+    bits = np.zeros((N,8*nw), dtype=np.uint8)
+    bits[:,:(K+7)//8] = np.packbits(Z != 0, axis=1)
+    if nw == 1:
+        return (bits.view(np.uint64).ravel(), Z)
+    return (bits.view('V%d' % (8*nw)).ravel(), Z)
+
 def plotPatterns(data, hidden, params, patterns, colors=[], styles=[],\
         leg=[], idxD=[]):
     """
@@ -623,6 +1058,28 @@ def init_default_params(data, params):
         params['maxK'] = D
     if not(params.has_key('verbose')):
         params['verbose'] = 1
+    if not(params.has_key('num_threads')):
+        params['num_threads'] = 1
+    if not(params.has_key('seed')):
+        params['seed'] = None # drawn by each call of infer
+    if not(params.has_key('n_chains')):
+        params['n_chains'] = 1
+    if not(params.has_key('resync_every')):
+        params['resync_every'] = 0
+    if not(params.has_key('checkpoint')):
+        params['checkpoint'] = None
+    if not(params.has_key('checkpoint_every')):
+        params['checkpoint_every'] = 0
+    if not(params.has_key('checkpoint_seconds')):
+        params['checkpoint_seconds'] = 0
+    if not(params.has_key('resume')):
+        params['resume'] = None
+    if not(params.has_key('trace')):
+        params['trace'] = 0
+    if not(params.has_key('callback')):
+        params['callback'] = None
+    if not(params.has_key('callback_every')):
+        params['callback_every'] = 10
 
     # parameters for optional external transformation
     if not(params.has_key('t')):
@@ -4,6 +4,7 @@
 # -------------------------------------------------------------------------
 import numpy as np
 from scipy.stats import norm
+from scipy.special import ndtr
 
 import pdb
 
@@ -30,10 +31,7 @@ def f_c(y):
     # input argument y: [N*R]
     # output: x [N*1]
     assert (len(y.shape) > 1), 'there is only one category, this dimension does not make sense'
-    x = np.zeros(y.shape[0])
-    for i in xrange(y.shape[0]):
-        val = max(y[i,:])
-        x[i] = np.where(y[i,:] == val)[0][0] + 1
+    x = np.argmax(y, axis=1) + 1.0 # first category with the largest value
     # [a,x] = max(y,[],2);
     return x
 
@@ -125,7 +123,7 @@ def pdf_g(X,Zp, Bd, mu , w, s2y, s2u):
     pdf = norm.pdf( df_1(X) , np.dot(Zp,Bd) , np.sqrt(s2y + s2u)) * w
     return pdf
 
-def pdf_c(Zn,B,s2y,numMC_samples=100):
+def pdf_c(Zn,B,s2y,num_nodes=32):
     """
     Function to compute pdf of a categorical variable. It returns the whole
     pdf, a probability vector of length R (number of categories)
@@ -138,22 +136,41 @@ def pdf_c(Zn,B,s2y,numMC_samples=100):
       Zn: [K], binary vector of feature assignment,
           where K: number of latent features
       s2y: scalar, variance of auxiliary noise
+      num_nodes: number of Gauss-Hermite nodes of the expectation over u
     """
+    return pdf_c_batch(np.reshape(Zn,(1,-1)), B, s2y, num_nodes)[0]
 
+def pdf_c_batch(Zp,B,s2y,num_nodes=32):
+    """
+    Categorical pdf of Eq. (4) for a block of feature activation vectors,
+    p(x=r|Zp) = E_u[ prod_{j!=r} Phi(u + Zp*(B[r,:]-B[j,:])) ] with
+    u ~ N(0,s2y), the expectation being computed by Gauss-Hermite quadrature
+
+    Inputs:
+      Zp: [P*K], binary feature activation vectors
+      B: [R*K]  feature weight matrix (dictionary)
+      s2y: scalar, variance of auxiliary noise
+      num_nodes: number of Gauss-Hermite nodes
+    Output:
+      pdf: [P*R], probability vector of every row of Zp
+    """
     R = B.shape[0]
-    pdf = np.zeros(R)
-    uV = np.sqrt(s2y) * np.random.randn(numMC_samples) # mean for u = 0
-    for r in xrange(R):
-        tmp = np.ones((1,numMC_samples))
-        # we compute the expectation using Monte Carlo samples
-        for j in xrange(R):
-            if (j==r):
-                continue
-            tmp = tmp * norm.cdf(uV + np.kron( np.ones(numMC_samples), \
-                    np.inner(Zn,B[r,:]-B[j,:]) ) )
-            #aux = aux .* normcdf( u + Zp*(B(:,r) - B(:,j)) );
-        pdf[r] = np.mean(tmp,1)
-    pdf = pdf / sum(pdf)
+    nodes, weights = np.polynomial.hermite.hermgauss(num_nodes)
+    uV = np.sqrt(2.0*s2y) * nodes # nodes for u ~ N(0,s2y)
+    weights = weights / np.sqrt(np.pi)
+    Y = np.dot(np.reshape(Zp,(-1,B.shape[1])), B.T) # P*R
+    P = Y.shape[0]
+    pdf = np.zeros((P,R))
+    # rows are processed in blocks so that the (rows*R*R*num_nodes) array of
+    # cdf values stays small
+    step = max(1, 2**20 // (R*R*num_nodes))
+    diag = np.eye(R, dtype=bool)
+    for p0 in xrange(0, P, step):
+        diff = Y[p0:p0+step,:,None] - Y[p0:p0+step,None,:] # y_r - y_j
+        diff[:,diag] = np.inf # Phi = 1 for j == r
+        tmp = ndtr(uV + diff[:,:,:,None]).prod(axis=2)
+        pdf[p0:p0+step,:] = np.dot(tmp, weights)
+    pdf = pdf / pdf.sum(axis=1, keepdims=True)
     return pdf
 
 def pdf_n(X,Zn,Bd,mu,w,s2y):
@@ -191,26 +208,21 @@ def pdf_o(Zn,Bd,theta,s2y):
     """
 
     R = len(theta)+1 # number of categories
-    pdf = np.zeros(R)
-    for r in xrange(R):
-        pdf[r] = pdf_o_single(r,Zn,Bd,theta,s2y)
+    # with Zn: [P*K], the output is the P*R matrix of the pdfs of its rows
+    pdf = pdf_o_single(np.arange(R), np.expand_dims(Zn,-2), Bd, theta, s2y)
     return pdf
 
 def pdf_o_single(r,Zn,Bd,theta,s2y):
     """
     Function to compute p(X=r|Z,B) for ordinal value r
+    (r can also be an array of values, one per row of Zn)
     """
     R = len(theta)+1 # number of categories
-    assert (r>=0) and (r<= (len(theta)+1))
-    if (r==0):
-        a = norm.cdf(theta[0],np.inner(Zn,Bd),np.sqrt(s2y))
-        b = 0
-    elif (r==(R-1)):
-        a = 1
-        b = norm.cdf(theta[r-1],np.inner(Zn,Bd),np.sqrt(s2y))
-    else:
-        a = norm.cdf(theta[r],np.inner(Zn,Bd),np.sqrt(s2y))
-        b = norm.cdf(theta[r-1],np.inner(Zn,Bd),np.sqrt(s2y))
+    assert np.all((r>=0) & (r<R))
+    thetaExt = np.concatenate(([-np.inf], theta, [np.inf])) # region r is (thetaExt[r], thetaExt[r+1]]
+    M = np.inner(Zn,Bd)
+    a = norm.cdf(thetaExt[r+1],M,np.sqrt(s2y))
+    b = norm.cdf(thetaExt[r],M,np.sqrt(s2y))
     return (a-b)
 
 
@@ -0,0 +1,109 @@
+"""
+Deterministic regression checks of the sampler: with a fixed seed, the chain
+must not depend on the number of threads, on how the iterations are split
+between calls, on a stop and resume from a checkpoint, or on the input being
+sparse or dense. Run it from this folder: python test_regression.py
+"""
+import os
+import shutil
+import tempfile
+import numpy as np
+import scipy.sparse as sp
+
+import GLFM
+import GLFMlib
+
+KEYS = ['Z', 'B', 'theta', 'mu', 'w', 's2Y']
+
+def same(h1, h2):
+    return all(np.array_equal(h1[k], h2[k]) for k in KEYS)
+
+# small synthetic dataset with every type of data ('g','p','c','o','n')
+rs = np.random.RandomState(0)
+N = 300
+D = 5
+X = rs.randn(N,D)
+X[:,1] = np.abs(X[:,1]) + 0.1
+X[:,2] = (X[:,2] > 0) + 1.0
+X[:,3] = np.floor(np.abs(X[:,3])*2) + 1
+X[:,4] = np.floor(np.abs(X[:,4])*3)
+C = 'gpcon'
+miss = rs.rand(N,D) < 0.2 # missing cells
+X[miss] = np.nan
+
+Niter = 30
+base = {'Niter':Niter, 'maxK':10, 'verbose':0, 'seed':5}
+
+def run(params, Xin=X):
+    return GLFM.infer({'X':Xin.copy(), 'C':C}, dict(), params)
+
+ref = run(dict(base))
+
+# same seed, same chain, whatever the number of threads
+for nt in [1, 2, 4]:
+    params = dict(base)
+    params['num_threads'] = nt
+    assert same(ref, run(params)), 'chain depends on num_threads=%d' % nt
+print 'seed and num_threads: OK'
+
+# step(n) followed by step(m) gives the chain of Nsim=n+m
+Xin = np.where(miss, -1, X).T.copy() # D*N, as the C++ routine takes it
+Zin = (rs.rand(N,2) > 0.5)*1.0
+Fin = np.ones(D)
+kw = dict(maxK=10, missing=-1, seed=11)
+whole = GLFMlib.infer(Xin, C, Zin, Fin, Nsim=Niter, **kw)
+sampler = GLFMlib.Sampler(Xin, C, Zin, Fin, **kw)
+try:
+    sampler.step(13)
+    sampler.step(Niter-13)
+    split = sampler.get_state()
+finally:
+    sampler.close()
+assert all(np.array_equal(a, b) for a, b in zip(whole, split)),\
+        'step(n)+step(m) differs from Nsim=n+m'
+print 'step(n)+step(m): OK'
+
+# a run stopped at a checkpoint and resumed goes on as if it had not stopped
+tmpdir = tempfile.mkdtemp()
+try:
+    path = os.path.join(tmpdir, 'glfm.ckpt')
+    params = dict(base)
+    params['checkpoint'] = path
+    params['Niter'] = 13
+    run(params)
+    params['Niter'] = Niter
+    params['resume'] = True
+    assert same(ref, run(params)), 'resumed chain differs'
+
+    # the periodic rebuild of P from Z keeps its period across a resume
+    params = dict(base)
+    params['resync_every'] = 4
+    ref_resync = run(params)
+    params['checkpoint'] = path
+    params['Niter'] = 13
+    run(params)
+    params['Niter'] = Niter
+    params['resume'] = True
+    assert same(ref_resync, run(params)), 'resumed chain with resync differs'
+
+    params = dict(base)
+    params['n_chains'] = 2
+    (refs, X_map) = run(params)
+    params['checkpoint'] = path
+    params['Niter'] = 13
+    run(params)
+    params['Niter'] = Niter
+    params['resume'] = True
+    (hiddens, X_map2) = run(params)
+    assert all(same(h1, h2) for h1, h2 in zip(refs, hiddens)),\
+            'resumed chains differ'
+    assert np.array_equal(X_map, X_map2), 'pooled MAP of the resumed chains differs'
+finally:
+    shutil.rmtree(tmpdir)
+print 'checkpoint and resume: OK'
+
+# a sparse matrix storing the observed cells gives the chain of the dense one
+(rows, cols) = np.nonzero(~miss)
+Xs = sp.coo_matrix((X[rows,cols], (rows,cols)), shape=(N,D))
+assert same(ref, run(dict(base), Xs)), 'sparse input differs from dense'
+print 'sparse input: OK'
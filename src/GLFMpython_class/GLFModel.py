@@ -5,6 +5,8 @@ import sys
 root = os.path.sep.join(os.path.abspath(__file__).split(os.path.sep)[:-2])
 sys.path.append(root+'/Ccode/wrapper_python/')
 import GLFMlib # python wrapper library in order to run C++ inference routine
+import mapping_functions as mf
+from multiprocessing.pool import ThreadPool
 
 class GLFM:
     """
@@ -19,12 +21,15 @@ class GLFM:
                 weighting matrices (latent features) B (TODO: Give intuition)
         Niter : number of internal iterations for the Gibbs sampler within
                 the C code before return
-        maxK  : max number of latent features to be allocated inside C++
+        maxK  : max number of latent features (C++ buffers grow with K up to it)
         missing : integer value that should be understood as missing value
         verbose : parameter to control how much info should be printed
+        n_chains: number of independent chains run concurrently by infer
+        seed  : seed of the sampler (chain c uses GLFMlib.split_seed(seed, c));
+                None draws a new one for every call of infer
     """
     def __init__(self, alpha=1.0, bias=0, s2y=1.0, s2u=0.001, s2B=1.0,\
-            Niter=100, maxK=50, missing=-1, verbose=0):
+            Niter=100, maxK=50, missing=-1, verbose=0, n_chains=1, seed=None):
         self.alpha = alpha
         self.bias = bias
         self.s2y = s2y
@@ -34,6 +39,8 @@ class GLFM:
         self.maxK = maxK
         self.missing = missing
         self.verbose = verbose
+        self.n_chains = n_chains
+        self.seed = seed
 
     def print_info(self):
         print 'General Latent Feature Model Object:\n'+\
@@ -45,14 +52,111 @@ class GLFM:
                 ('Niter: %d\n' % self.Niter)+\
                 (' maxK: %d\n' % self.maxK)+\
                 ('missing: %d\n' % self.missing)+\
-                ('verbose: %d\n' % self.verbose)
+                ('verbose: %d\n' % self.verbose)+\
+                ('n_chains: %d\n' % self.n_chains)+\
+                (' seed: %s\n' % self.seed)
 
 
     def infer(self, Xin, Cin, Zin):
+        """
+        Runs the sampler on Xin (D*N) starting from Zin (N*K). With
+        n_chains > 1 the chains run concurrently, one thread each (the C++
+        routine releases the GIL), and the output is the pair (list of the
+        outputs of GLFMlib.infer for every chain, N*D pooled MAP estimate of
+        the observations, see computeMAP_pooled)
+        """
         # Generate weights for transformation
         Win = np.ascontiguousarray( 2.0 / np.max(Xin,1) )
-        return GLFMlib.infer(Xin, Cin, Zin, Win, self.bias, self.s2y, self.s2u,\
-            self.s2B, self.alpha, self.Niter, self.maxK, self.missing, self.verbose)
+        seed = self.seed
+        if seed is None: # a different chain for every call
+            seed = np.random.randint(2**31-1)
+        run = lambda seed: GLFMlib.infer(Xin, Cin, Zin, Win, bias=self.bias,\
+            s2u=self.s2u, s2B=self.s2B, alpha=self.alpha, Nsim=self.Niter,\
+            maxK=self.maxK, missing=self.missing, verbose=self.verbose,\
+            seed=seed)
+        if self.n_chains == 1:
+            return run(seed)
+        pool = ThreadPool(self.n_chains)
+        try:
+            outs = pool.map(run, [GLFMlib.split_seed(seed, c)\
+                for c in xrange(self.n_chains)])
+        finally:
+            pool.close()
+            pool.join()
+        hiddens = [self.hidden(out, Xin, Cin) for out in outs]
+        return (outs, self.computeMAP_pooled(Cin, hiddens))
+
+    def hidden(self, out, Xin, Cin):
+        """
+        Output of GLFMlib.infer on Xin (D*N) as the hidden dictionary of the
+        GLFMpython module (see GLFM.infer), e.g. for computeMAP
+        """
+        (Z, B, theta, mu, w, s2Y) = out
+        R = [None] * len(Cin)
+        for d in xrange(len(Cin)):
+            if Cin[d] in 'coCO': # categories take values in {1, ..., R}
+                Xd = Xin[d][Xin[d] != self.missing]
+                R[d] = np.arange(1, np.max(Xd) + 1)
+        return {'Z': Z, 'B': B, 'theta': theta, 'mu': mu, 'w': w,\
+                's2Y': s2Y, 'R': R}
+
+    def computeMAP(self, C, Zp, hidden):
+        """
+        P*D MAP estimate of the observations for the feature activations Zp
+        (P*K), given the hidden dictionary of a run (see hidden)
+        """
+        C = C.lower()
+        Zp = np.atleast_2d(Zp)
+        X_map = np.zeros((Zp.shape[0], len(C)))
+        B = hidden['B']
+        for d in xrange(len(C)):
+            if C[d] == 'c':
+                X_map[:,d] = mf.f_c( np.inner(Zp,\
+                        B[d,:,range(len(hidden['R'][d]))]) )
+                continue
+            aux = np.inner(Zp, B[d,:,0])
+            if C[d] == 'g':
+                X_map[:,d] = mf.f_g(aux, hidden['mu'][d], hidden['w'][d])
+            elif C[d] == 'p':
+                X_map[:,d] = mf.f_p(aux, hidden['mu'][d], hidden['w'][d])
+            elif C[d] == 'n':
+                X_map[:,d] = mf.f_n(aux, hidden['mu'][d], hidden['w'][d])
+            elif C[d] == 'o':
+                X_map[:,d] = mf.f_o(aux,\
+                        hidden['theta'][d,range(len(hidden['R'][d])-1)])
+            else:
+                raise ValueError('Unknown data type')
+        return X_map
+
+    def computeMAP_pooled(self, C, hiddens):
+        """
+        N*D MAP estimate of the observations pooled over the hidden
+        dictionaries of several chains: the average of the chains for real
+        and positive real data, their most frequent value (the smallest one
+        in a tie) for count, categorical and ordinal data
+        """
+        X_maps = np.array([ self.computeMAP(C, hidden['Z'], hidden)\
+                for hidden in hiddens ]) # n_chains * N * D
+        X_map = np.mean(X_maps, 0)
+        for d in xrange(len(C)):
+            if C[d] in 'ncoNCO':
+                A = np.sort(X_maps[:,:,d], 0)
+                counts = (A[:,np.newaxis,:] == A[np.newaxis,:,:]).sum(1)
+                X_map[:,d] = A[np.argmax(counts, 0), np.arange(A.shape[1])]
+        return X_map
+
+    def sampler(self, Xin, Cin, Zin):
+        """
+        Resident sampler on Xin (D*N) starting from Zin (N*K), with the
+        hyperparameters and seed of the model: sampler.step(n_iter) runs
+        n_iter more iterations from where the previous call stopped,
+        sampler.get_state() returns the outputs of GLFMlib.infer and
+        sampler.close() frees it
+        """
+        Win = np.ascontiguousarray( 2.0 / np.max(Xin,1) )
+        return GLFMlib.Sampler(Xin, Cin, Zin, Win, bias=self.bias,\
+            s2u=self.s2u, s2B=self.s2B, alpha=self.alpha, maxK=self.maxK,\
+            missing=self.missing, verbose=self.verbose, seed=self.seed)
 
     def complete_matrix(self, Xmiss, C):
         """
@@ -74,48 +178,22 @@ class GLFM:
                      inferred and completed by the algorithm.
         """
 
-        N = Xmiss.shape[0]
-        D = Xmiss.shape[1]
-        Xmiss[np.isnan(Xmiss)] = missing
-        maxK=50 # maximum number of latent features for space allocation
+        Xin = np.array(Xmiss, dtype=np.float64).T # D*N copy
+        Xin[np.isnan(Xin)] = self.missing
+        Xin = np.ascontiguousarray(Xin)
+        (D, N) = Xin.shape
 
         ## Inference
-        #Zini= 1.0*( np.random.rand(N,2) > 0.8 )
         Kinit = 3
-        Zini = np.ascontiguousarray( (np.random.rand(Kinit,N) > 0.8).astype('float64') )
-        (Zest, B, Theta)= self.infer(Xmiss,C,Zini) # run inference function
-
-        Xcompl=np.copy(Xmiss)
-        [idxs_d, idxs_n] = (Xmiss == missing).nonzero()
-        f_1= lambda x,w: np.log(np.exp(w*x)-1) # called element-wise 
-        f= lambda y,w:  np.log(np.exp(y)+1)/w
-        W = 2 / Xmiss.max(1) # D*1 # TODO: Take care of missing values when taking max
-        for ii in xrange(len(idxs_n)):
-            if Xmiss[idxs_d[ii],idxs_n[ii]] == missing: # will always be the case
-                d = idxs_d[ii] # np.ceil(ii/N)
-                n = idxs_n[ii] # np.mod(ii,N)
-                Br=np.squeeze(B[d,:])
-                aux = Zest[:,n].reshape(-1,1) # Zest(:,n)'
-                if (C[d] != 'c'):
-                    M = np.inner(aux.transpose(),Br)
-                if (C[d] == 'g'):
-                    # branch checked, working
-                    Xcompl[d,n] = M
-                elif (C[d] == 'p'):
-                    Xcompl[d,n] = f(M,W[d])
-                elif (C[d] == 'c'):
-                   Br = np.squeeze(B[d,:,:])
-                   prob = np.zeros((1,R[d]))
-                   Y = np.zeros((1,R[d]))
-                   for r in xrange(R[d]):
-                       Y[r]= np.inner(aux.transpose(),Br[:,r]) # TODO: check
-                   Xcompl[d,n] = np.where(Y == np.max(Y))[0]
-                elif (C[d] == 'o' ):
-                    #Y = aux * Br # TODO: check dimensions
-                    [idx_x, idx_y] = (Theta[d,1:R[d]]>=M).nonzero()
-                    Xcompl[d,n] = idx_x[0] # TODO: verify (x,y) and what if more els?
-                elif (C[d] == 'n'):
-                    Xcompl[d,n] = np.floor(f(M,W[d]))
+        rs = np.random if self.seed is None else np.random.RandomState(self.seed % 2**32)
+        Zini = (rs.rand(N,Kinit) > 0.8).astype('float64')
+        out = self.infer(Xin, C, Zini) # run inference function
+        if self.n_chains > 1: # predictions pooled over the chains
+            X_map = out[1]
+        else:
+            X_map = self.computeMAP(C, out[0], self.hidden(out, Xin, C))
 
+        Xcompl = Xin.T.copy()
+        miss = (Xcompl == self.missing)
+        Xcompl[miss] = X_map[miss]
         return Xcompl
-
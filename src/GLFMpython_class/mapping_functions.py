@@ -142,6 +142,55 @@ def dfpos_1_xi(x, w):
     y = -0.5*(w**0.5) * (x**(-0.5))
     return y
 
+# --------------------------------------------------------
+# Mapping functions of the C++ sampler (Y -> X), as in the
+# GLFMpython module, for the MAP estimates of GLFModel
+# --------------------------------------------------------
+
+def f_g(y, mu, w):
+    # Mapping function for real-valued data
+    #  Y -> X (from pseudo-obversations to data)
+    assert not(w == 0), 'scaling factor should never be 0'
+    x = (y*1.0)/w + mu;
+    return x
+
+def f_p(y, mu, w):
+    # transformation function for positive data
+    # Y -> X (from pseudo-obversations to data)
+    assert not(w == 0), 'scaling factor should never be 0'
+    x = np.log( np.exp(y) + 1 )*1.0/w + mu
+    return x
+
+def f_c(y):
+    # transformation function for categorical data
+    # input argument y: [N*R]
+    # output: x [N*1]
+    assert (len(y.shape) > 1), 'there is only one category, this dimension does not make sense'
+    x = np.argmax(y, axis=1) + 1.0 # first category with the largest value
+    return x
+
+def f_n(y,mu,w):
+    # transformation function for count data
+    # Y -> X (from pseudo-obversations to data)
+    assert not(w == 0), 'scaling factor should never be 0'
+    x = np.floor( f_p(y,mu,w) )
+    return x
+
+def f_o(y, theta):
+    # Mapping function for ordinal data
+    # Inputs:
+    #       y: [1*R] Pseudo-observations
+    #   theta: [1*(R-1)] Thresholds that divide the real line into R regions
+    x = np.zeros(y.shape[0]) # column vector
+    for j in xrange(len(theta)):
+        if (j == 0):
+            mask = (y <= theta[0])
+        else:
+            mask = (y > theta[j-1]) * (y <= theta[j])
+        x[mask] = j + 1
+    x[x == 0] = len(theta) # last ordinal category
+    return x
+
 # ------------------------------------------
 # Functions to compute pdf values
 # ------------------------------------------